@@ -28,6 +28,18 @@ if not os.path.isfile(CFG_NAME):
     __config__.set("window", "ypos", "200")
     __config__.add_section("io")
     __config__.set("io", "project_file", "None")
+    __config__.set("io", "journal_file", os.path.join(CONFDIR, "npl.journal"))
+    __config__.set("io", "autosave_file",
+                   os.path.join(CONFDIR, "autosave.npl"))
+    __config__.set("io", "autosave_interval", "60")
+    __config__.add_section("history")
+    __config__.set("history", "max_megabytes", "64")
+    __config__.set("history", "max_steps", "200")
+    __config__.add_section("executor")
+    __config__.set("executor", "threads", "2")
+    __config__.set("executor", "processes", "2")
+    __config__.add_section("view")
+    __config__.set("view", "waterfall_offset", "0.3")
 
     with open(CFG_NAME, "w") as cfg_file:
         __config__.write(cfg_file)
@@ -4,18 +4,158 @@ and providing callback connection for changing Spectrums."""
 
 import uuid
 import re
+import itertools
+from contextlib import contextmanager
 
 import numpy as np
 
 from npl.processing import (
     calculate_background, moving_average, get_energy_at_maximum,
-    normalize, RegionFitModelIface)
+    normalize, get_common_grid, resample, RegionFitModelIface)
+
+
+# upper 32 bits are random per session, lower 32 bits count up
+_SIDS = itertools.count((uuid.uuid4().int & 0xffffffff) << 32)
+
+
+def new_sid():
+    """Returns a new unique 64 bit id."""
+    return next(_SIDS)
+
+
+def convert(ftype, value):
+    """Converts value to ftype if possible (e.g. strings from user input),
+    returns value unchanged otherwise."""
+    if ftype is None or value is None or isinstance(value, ftype):
+        return value
+    try:
+        return ftype(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def to_number(value):
+    """Returns value as float, 0 if that is impossible."""
+    value = convert(float, value)
+    if isinstance(value, float):
+        return value
+    return 0.
+
+
+def combine_spectra(spectra, operation="average", reference=None):
+    """Returns new Spectrum objects made from the raw (calibrated) data of
+    spectra on their common energy grid: "sum" and "average" (weighted by
+    sweeps * dwelltime) give one spectrum, "subtract" gives one spectrum
+    per spectrum with reference subtracted."""
+    # pylint: disable=protected-access
+    if operation not in ("sum", "average", "subtract"):
+        raise ValueError("Unknown operation {}".format(operation))
+    spectra = list(spectra)
+    if operation == "subtract":
+        if reference is None:
+            raise ValueError("subtract needs a reference spectrum")
+        spectra = [spectrum for spectrum in spectra
+                   if spectrum is not reference]
+        allspectra = spectra + [reference]
+    else:
+        allspectra = spectra
+    if not spectra:
+        return []
+
+    energies = [spectrum._energy + spectrum.calibration
+                for spectrum in allspectra]
+    intensities = [spectrum._intensity for spectrum in allspectra]
+    same_grid = all(
+        np.shape(energy) == np.shape(energies[0])
+        and np.array_equal(energy, energies[0]) for energy in energies)
+    if same_grid:
+        energy = energies[0]
+        matrix = np.array(intensities, dtype=float)
+    else:
+        energy = get_common_grid(energies)
+        matrix = resample(energies, intensities, energy)
+
+    names = ", ".join(spectrum.name for spectrum in allspectra)
+    if operation == "subtract":
+        return [Spectrum(
+            energy=energy, intensity=row - matrix[-1],
+            name="{} - {}".format(spectrum.name, reference.name),
+            notes="subtracted: {}".format(names),
+            sweeps=spectrum.sweeps, dwelltime=spectrum.dwelltime,
+            passenergy=spectrum.passenergy)
+                for spectrum, row in zip(spectra, matrix[:-1])]
+
+    times = np.array([to_number(spectrum.sweeps)
+                      * to_number(spectrum.dwelltime)
+                      for spectrum in spectra])
+    if operation == "sum":
+        intensity = matrix.sum(axis=0)
+    elif (times > 0).all():
+        intensity = np.average(matrix, axis=0, weights=times)
+    else:
+        intensity = matrix.mean(axis=0)
+    passenergies = set(spectrum.passenergy for spectrum in spectra)
+    return [Spectrum(
+        energy=energy, intensity=intensity,
+        name="{} of {} spectra".format(operation, len(spectra)),
+        notes="{}: {}".format(operation, names),
+        sweeps=int(sum(to_number(spectrum.sweeps) for spectrum in spectra)),
+        dwelltime=spectra[0].dwelltime,
+        passenergy=passenergies.pop() if len(passenergies) == 1 else 0)]
+
+
+class Observable(object):
+    """Base class for Spectrum, Region and Peak: a compact (slotted) object
+    that notifies observers. The observer list is only allocated when the
+    first observer subscribes."""
+    __slots__ = ("_observers", )
 
+    def __init__(self):
+        self._observers = None
+
+    def subscribe(self, callback):
+        """Bind a new callback to this."""
+        if self._observers is None:
+            self._observers = []
+        self._observers.append(callback)
+
+    def unsubscribe(self, callback):
+        """Unbind the callback."""
+        if not self._observers:
+            raise ValueError("{} is not subscribed".format(callback))
+        self._observers.remove(callback)
 
-class Spectrum(object):
+    def emit(self, keyword, **kwargs):
+        """Emits to all obervers."""
+        if self._observers:
+            for callback in list(self._observers):
+                callback(keyword, self, **kwargs)
+
+    @classmethod
+    def get_slots(cls):
+        """Returns the names of all slots of this class."""
+        return [slot for klass in cls.__mro__
+                for slot in getattr(klass, "__slots__", ())]
+
+    def __getstate__(self):
+        """Observers are not pickled (they are mostly GUI callbacks)."""
+        state = dict((slot, getattr(self, slot)) for slot in self.get_slots()
+                     if hasattr(self, slot))
+        state["_observers"] = None
+        return state
+
+    def __setstate__(self, state):
+        """Restores slots, unknown keys are ignored."""
+        slots = self.get_slots()
+        for slot in slots:
+            setattr(self, slot, None)
+        for key, value in state.items():
+            if key in slots:
+                setattr(self, key, value)
+
+
+class Spectrum(Observable):
     """Stores spectrum data."""
-    # pylint: disable=access-member-before-definition, no-member
-    # pylint: disable=attribute-defined-outside-init
     # pylint: disable=too-many-instance-attributes
     titles = {
         "name": "Name",
@@ -25,19 +165,24 @@ class Spectrum(object):
         "sweeps": "Sweeps",
         "dwelltime": "Dwell [s]",
         "passenergy": "Pass [eV]"}
-    _defaults = {
-        "visibility": "",
-        "name": "",
-        "notes": "",
-        "eis_region": "",
-        "fname": "",
-        "sweeps": 0,
-        "dwelltime": 0,
-        "passenergy": 0,
-        "smoothness": 0,
-        "calibration": 0,
-        "norm": 0}
-    attrs = sorted(list(_defaults.keys()))
+    # (name, type, default)
+    fields = (
+        ("visibility", str, ""),
+        ("name", str, ""),
+        ("notes", str, ""),
+        ("eis_region", str, ""),
+        ("fname", str, ""),
+        ("sweeps", int, 0),
+        ("dwelltime", float, 0),
+        ("passenergy", float, 0),
+        ("smoothness", int, 0),
+        ("calibration", float, 0),
+        ("norm", int, 0))
+    types = dict((name, ftype) for (name, ftype, _default) in fields)
+    attrs = sorted(name for (name, _ftype, _default) in fields)
+    __slots__ = (("sid", "_energy", "energy", "_intensity", "intensity",
+                  "regions", "regionname")
+                 + tuple(name for (name, _ftype, _default) in fields))
 
     def __init__(self, **kwargs):
         super().__init__()
@@ -46,8 +191,7 @@ class Spectrum(object):
             if attr not in kwargs:
                 raise ValueError("Missing property {}".format(attr))
 
-        self._observers = []
-        self.sid = int(uuid.uuid4()) & (1<<64)-1
+        self.sid = new_sid()
         self._energy = kwargs["energy"]
         self.energy = self._energy
         self._intensity = kwargs["intensity"]
@@ -56,21 +200,28 @@ class Spectrum(object):
 
         self.regionname = 0
 
-        for (attr, default) in self._defaults.items():
-            setattr(self, attr, kwargs.get(attr, default))
+        for (attr, ftype, default) in self.fields:
+            setattr(self, attr, convert(ftype, kwargs.get(attr, default)))
 
         if not self.name and self.eis_region:
             self.name = "(R {})".format(self.eis_region)
 
     def set(self, **kwargs):
-        """Change values that alter the spectrum."""
+        """Change values that alter the spectrum. Metadata (see
+        self.titles) can be set, too."""
         calibration = kwargs.get("calibration", None)
         smoothness = kwargs.get("smoothness", None)
         norm = kwargs.get("norm", None)
 
+        for attr in self.titles:
+            if attr in kwargs:
+                setattr(self, attr, convert(self.types[attr], kwargs[attr]))
+
+        data_changed = False
         if calibration is not None and calibration != self.calibration:
             self.calibration = calibration
             self.energy = self._energy + self.calibration
+            data_changed = True
         if (smoothness is not None and smoothness != self.smoothness
                 or norm is not None and norm != self.norm):
             intensity = self._intensity
@@ -81,9 +232,11 @@ class Spectrum(object):
             intensity = normalize(intensity, self.norm)
             intensity = moving_average(intensity, self.smoothness)
             self.intensity = intensity
+            data_changed = True
 
-        for region in self.regions:
-            region.set(spectrum_changed=True)
+        if data_changed:
+            for region in self.regions:
+                region.set(spectrum_changed=True)
 
         self.emit("changed_spectrum", **kwargs)
 
@@ -107,31 +260,48 @@ class Spectrum(object):
         region = Region(**kwargs, spectrum=self)
         self.regions.append(region)
         self.emit("add_region", region=region)
-        for callback in self._observers:
+        for callback in self._observers or ():
+            region.subscribe(callback)
+
+    def insert_region(self, region, index=None):
+        """Puts a region (e.g. one removed before) back into
+        self.regions."""
+        if index is None:
+            index = len(self.regions)
+        self.regions.insert(index, region)
+        region.set(spectrum_changed=True)
+        self.emit("add_region", region=region, index=index)
+        for callback in self._observers or ():
             region.subscribe(callback)
 
     def remove_region(self, region):
         """Removes a region from self.regions."""
+        idx = self.regions.index(region)
         self.regions.remove(region)
-        self.emit("remove_region", region=region)
+        self.emit("remove_region", region=region, index=idx)
+        for callback in self._observers or ():
+            region.unsubscribe(callback)
 
     def clear_regions(self):
         """Removes all regions from self.regions."""
+        regions = list(self.regions)
         self.regions.clear()
         self.emit("remove_region", region=None)
+        for region in regions:
+            for callback in self._observers or ():
+                region.unsubscribe(callback)
 
     def subscribe(self, callback):
-        """Bind a new callback to this."""
-        self._observers.append(callback)
+        """Bind a new callback to this and to all regions."""
+        super().subscribe(callback)
+        for region in self.regions:
+            region.subscribe(callback)
 
     def unsubscribe(self, callback):
         """Unbind the callback."""
-        self._observers.remove(callback)
-
-    def emit(self, keyword, **kwargs):
-        """Emits to all obervers."""
-        for callback in self._observers:
-            callback(keyword, self, **kwargs)
+        super().unsubscribe(callback)
+        for region in self.regions:
+            region.unsubscribe(callback)
 
     def __eq__(self, other):
         """For testing equality."""
@@ -147,11 +317,14 @@ class Spectrum(object):
         return attr
 
 
-class Region(object):
+class Region(Observable):
     """A region is a part of a spectrum."""
     # pylint: disable=too-many-instance-attributes
     bgtypes = ("none", "shirley", "linear")
     peaknames = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    __slots__ = ("sid", "spectrum", "emin", "emax", "bgtype", "energy",
+                 "intensity", "background", "peakname", "peaks", "_model",
+                 "fit_all", "name")
 
     def __init__(self, **kwargs):
         super().__init__()
@@ -160,8 +333,7 @@ class Region(object):
             if attr not in kwargs:
                 raise TypeError("Missing property {}".format(attr))
 
-        self._observers = []
-        self.sid = int(uuid.uuid4()) & (1<<64)-1
+        self.sid = new_sid()
         self.spectrum = kwargs["spectrum"]
         self.emin = None    # these 5 will be set during self.set
         self.emax = None
@@ -175,7 +347,7 @@ class Region(object):
         self.set(bgtype="shirley", emin=kwargs["emin"], emax=kwargs["emax"])
 
         self.peaks = []
-        self.model = RegionFitModelIface(self)
+        self._model = None
         self.fit_all = None
 
         self.name = kwargs.get(
@@ -218,6 +390,14 @@ class Region(object):
 
         self.emit("changed_region", **kwargs)
 
+    def set_background(self, idx1, idx2, background):
+        """Takes a background that was calculated for many regions at once
+        (see SpectrumMatrix) after the spectrum changed."""
+        self.energy = self.spectrum.energy[idx1:idx2]
+        self.intensity = self.spectrum.intensity[idx1:idx2]
+        self.background = background
+        self.emit("changed_region", spectrum_changed=True)
+
     def background_from_energy(self, energy):
         """Returns background intensity at specified energy."""
         index = (np.abs(self.energy - energy)).argmin()
@@ -228,9 +408,24 @@ class Region(object):
         self.model.fit()
         self.emit("fit")
 
+    def set_fit_result(self, params):
+        """Takes Parameters from a fit done elsewhere (see
+        processing.fit_models)."""
+        self.model.set_fit_result(params)
+        self.emit("fit")
+
+    @property
+    def model(self):
+        """The RegionFitModelIface, it is only created when needed."""
+        if self._model is None:
+            self._model = RegionFitModelIface(self)
+        return self._model
+
     @property
     def fit_intensity(self):
         """Fetches the evaluation of the total model from ModelIface."""
+        if self._model is None:
+            return None
         return self.model.get_intensity()
 
     def add_peak(self, **kwargs):
@@ -238,61 +433,83 @@ class Region(object):
         peak = Peak(region=self, **kwargs)
         self.peaks.append(peak)
         self.model.add_peak(peak)
-        self.emit("add_peak")
-        for observer in self._observers:
+        self.emit("add_peak", peak=peak)
+        for observer in self._observers or ():
+            peak.subscribe(observer)
+
+    def insert_peak(self, peak, index=None):
+        """Puts a peak (e.g. one removed before) back into self.peaks,
+        its parameters are initialized from area, fwhm and center."""
+        if index is None:
+            index = len(self.peaks)
+        self.peaks.insert(index, peak)
+        peak.model = self.model
+        self.model.add_peak(peak)
+        self.model.init_params(
+            peak, fwhm=peak.fwhm, area=peak.area, center=peak.center)
+        self.emit("add_peak", peak=peak, index=index)
+        for observer in self._observers or ():
             peak.subscribe(observer)
 
     def remove_peak(self, peak):
         """Removes a peak from self.peaks."""
+        idx = self.peaks.index(peak)
         self.peaks.remove(peak)
         self.model.remove_peak(peak)
-        self.emit("remove_peak")
+        self.emit("remove_peak", peak=peak, index=idx)
+        for observer in self._observers or ():
+            peak.unsubscribe(observer)
 
     def clear_peaks(self):
         """Removes all peaks from this region."""
+        peaks = list(self.peaks)
         self.peaks.clear()
-        self.emit("remove_peak")
+        self._model = None
+        self.emit("remove_peak", peak=None)
+        for peak in peaks:
+            for observer in self._observers or ():
+                peak.unsubscribe(observer)
 
     def subscribe(self, callback):
-        """Bind a new callback to this."""
-        self._observers.append(callback)
+        """Bind a new callback to this and to all peaks."""
+        super().subscribe(callback)
+        for peak in self.peaks:
+            peak.subscribe(callback)
 
     def unsubscribe(self, callback):
         """Unbind the callback."""
-        self._observers.remove(callback)
-
-    def emit(self, keyword, **kwargs):
-        """Emits to all obervers."""
-        for callback in self._observers:
-            callback(keyword, self, **kwargs)
+        super().unsubscribe(callback)
+        for peak in self.peaks:
+            peak.unsubscribe(callback)
 
 
-class Peak(object):
+class Peak(Observable):
     """This object fits a peak in the real spectrum and is defined as part of
     a Region."""
-    # pylint: disable=access-member-before-definition, no-member
-    # pylint: disable=attribute-defined-outside-init
     # pylint: disable=too-many-instance-attributes
-    _defaults = {
-        "name": "",
-        "region": None,
-        "spectrum": None,
-        "model_name": "PseudoVoigt",
-        "area": None,
-        "center": None,
-        "fwhm": None,
-        "params": None,
-        "guess": False}
+    # (name, type, default)
+    fields = (
+        ("name", str, ""),
+        ("spectrum", None, None),
+        ("model_name", str, "PseudoVoigt"),
+        ("area", float, None),
+        ("center", float, None),
+        ("fwhm", float, None),
+        ("params", None, None),
+        ("guess", bool, False))
+    __slots__ = (("sid", "region", "prefix", "model")
+                 + tuple(name for (name, _ftype, _default) in fields))
+
     def __init__(self, **kwargs):
-        self._observers = []
+        super().__init__()
         for attr in ("region",):
             if attr not in kwargs:
                 raise TypeError("Missing property {}".format(attr))
 
-        self.sid = int(uuid.uuid4()) & (1<<64)-1
+        self.sid = new_sid()
         self.region = kwargs["region"]
-        for (attr, default) in self._defaults.items():
-            setattr(self, attr, kwargs.get(attr, default))
+        for (attr, ftype, default) in self.fields:
+            setattr(self, attr, convert(ftype, kwargs.get(attr, default)))
         if not self.name:
             self.name = self.region.peaknames[self.region.peakname]
             self.region.peakname += 1
@@ -322,7 +539,7 @@ class Peak(object):
         if any([attr in kwargs for attr in ["fwhm", "area", "center"]]):
             self.model.init_params(
                 self, fwhm=self.fwhm, area=self.area, center=self.center)
-        self.emit("changed_peak")
+        self.emit("changed_peak", **kwargs)
 
     @property
     def fit_intensity(self):
@@ -348,18 +565,240 @@ class Peak(object):
             self.model.init_params(
                 self, area=self.area, fwhm=self.fwhm, center=self.center)
 
-    def subscribe(self, callback):
-        """Bind a new callback to this."""
-        self._observers.append(callback)
 
-    def unsubscribe(self, callback):
-        """Unbind the callback."""
-        self._observers.remove(callback)
+class SpectrumMatrix(object):
+    """Keeps the raw intensities of spectra that share one energy grid as
+    rows of one contiguous 2D array, Spectrum._intensity is a view into a
+    row and Spectrum._energy is the common grid. Calibration, smoothing,
+    normalization and backgrounds are then computed for all rows at once.
+    Rows are only ever appended, rows of removed spectra are dropped when
+    the matrix is compacted, which copies into a new array, so existing
+    views never change."""
+    processing_attrs = ("calibration", "smoothness", "norm")
 
-    def emit(self, keyword, **kwargs):
-        """Emits to all obervers."""
-        for callback in self._observers:
-            callback(keyword, self, **kwargs)
+    def __init__(self, energy):
+        self.energy = np.array(energy, dtype=float)
+        self.raw = np.empty((1, len(self.energy)))
+        self.spectra = []
+        self._rows = {}
+
+    def __len__(self):
+        return len(self._rows)
+
+    @staticmethod
+    def get_key(energy):
+        """Returns a hashable key for an energy grid."""
+        return np.asarray(energy, dtype=float).tobytes()
+
+    def add(self, spectra):
+        """Copies the raw intensities of spectra into new rows and makes
+        the spectra use views of them."""
+        # pylint: disable=protected-access
+        spectra = [spectrum for spectrum in spectra
+                   if spectrum.sid not in self._rows]
+        if not spectra:
+            return
+        start = len(self.spectra)
+        needed = start + len(spectra)
+        if needed > self.raw.shape[0]:
+            raw = np.empty((max(needed, 2 * self.raw.shape[0]),
+                            len(self.energy)))
+            raw[:start] = self.raw[:start]
+            self.raw = raw
+            self._repoint(self.spectra)
+        self.raw[start:needed] = [spectrum._intensity for spectrum in spectra]
+        for row, spectrum in enumerate(spectra, start):
+            self._rows[spectrum.sid] = row
+        self.spectra.extend(spectra)
+        self._repoint(spectra)
+
+    def remove(self, spectra):
+        """Gives the spectra their own copy of the data and frees their
+        rows."""
+        # pylint: disable=protected-access
+        for spectrum in spectra:
+            row = self._rows.pop(spectrum.sid, None)
+            if row is None:
+                continue
+            self.spectra[row] = None
+            if spectrum.intensity is spectrum._intensity:
+                spectrum._intensity = spectrum._intensity.copy()
+                spectrum.intensity = spectrum._intensity
+            else:
+                spectrum._intensity = spectrum._intensity.copy()
+        if len(self._rows) < len(self.spectra) // 2:
+            self.compact()
+
+    def compact(self):
+        """Drops the rows of removed spectra."""
+        spectra = [spectrum for spectrum in self.spectra
+                   if spectrum is not None]
+        rows = [self._rows[spectrum.sid] for spectrum in spectra]
+        self.raw = self.raw[rows] if rows else self.raw[:1].copy()
+        self.spectra = spectra
+        self._rows = dict(
+            (spectrum.sid, row) for row, spectrum in enumerate(spectra))
+        self._repoint(spectra)
+
+    def _repoint(self, spectra):
+        """Points _energy/_intensity of spectra to the current arrays."""
+        # pylint: disable=protected-access
+        for spectrum in spectra:
+            if spectrum is None:
+                continue
+            row = self.raw[self._rows[spectrum.sid]]
+            if spectrum.intensity is spectrum._intensity:
+                spectrum.intensity = row
+            spectrum._intensity = row
+            if spectrum.energy is spectrum._energy:
+                spectrum.energy = self.energy
+            spectrum._energy = self.energy
+
+    def get_rows(self, spectra):
+        """Returns the row indices of spectra."""
+        return np.array([self._rows[spectrum.sid] for spectrum in spectra],
+                        dtype=int)
+
+    def set(self, spectra, **kwargs):
+        """Spectrum.set for many spectra of this matrix at once. Takes
+        calibration, smoothness and norm, each either a single value or
+        one value per spectrum."""
+        job = self.prepare(spectra, **kwargs)
+        if job is not None:
+            self.compute(job)
+            self.apply(job)
+
+    def prepare(self, spectra, **kwargs):
+        """Collects what set() needs as a job for compute() and apply(),
+        returns None if there is nothing to do."""
+        spectra = list(spectra)
+        return self.prepare_job(
+            self.energy, self.raw, self.get_rows(spectra), spectra, kwargs)
+
+    @staticmethod
+    def prepare_job(energy, raw, rows, spectra, kwargs):
+        """Returns a job for spectra whose raw intensities are raw[rows] on
+        the grid energy, see prepare()."""
+        # pylint: disable=protected-access
+        for key in kwargs:
+            if key not in SpectrumMatrix.processing_attrs:
+                raise TypeError("Unexpected keyword {}".format(key))
+        if not spectra:
+            return None
+        old = dict(
+            (attr, np.array([getattr(spectrum, attr) for spectrum in spectra],
+                            dtype=float))
+            for attr in SpectrumMatrix.processing_attrs)
+        new = dict(old)
+        for attr, value in kwargs.items():
+            if value is not None:
+                new[attr] = np.broadcast_to(
+                    np.asarray(value, dtype=float), rows.shape)
+        return {
+            "energy": energy, "raw": raw, "rows": rows, "spectra": spectra,
+            "kwargs": kwargs, "old": old, "new": new,
+            "bases": [spectrum._intensity for spectrum in spectra],
+            "current": [(spectrum.energy, spectrum.intensity)
+                        for spectrum in spectra],
+            "regions": [[(region, region.emin, region.emax, region.bgtype)
+                         for region in spectrum.regions]
+                        for spectrum in spectra]}
+
+    @staticmethod
+    def compute(job):
+        """Calculates energies, intensities and region backgrounds of a
+        job. Only reads the job, so it can run on another thread."""
+        # pylint: disable=too-many-locals
+        old, new, rows = job["old"], job["new"], job["rows"]
+        energy_changed = new["calibration"] != old["calibration"]
+        intensity_changed = ((new["smoothness"] != old["smoothness"])
+                             | (new["norm"] != old["norm"]))
+        energies = job["energy"] + new["calibration"][energy_changed, None]
+        intensities = np.empty((np.count_nonzero(intensity_changed),
+                                len(job["energy"])))
+        combinations, inverse = np.unique(
+            np.stack((new["smoothness"], new["norm"]),
+                     axis=1)[intensity_changed],
+            axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        changed_rows = rows[intensity_changed]
+        for i, (smoothness, norm) in enumerate(combinations):
+            members = inverse == i
+            intensities[members] = moving_average(
+                normalize(job["raw"][changed_rows[members]], norm), smoothness)
+
+        energy_iter = iter(energies)
+        intensity_iter = iter(intensities)
+        results = []
+        groups = {}
+        for i, (energy, intensity) in enumerate(job["current"]):
+            if energy_changed[i]:
+                energy = next(energy_iter)
+            if intensity_changed[i]:
+                intensity = next(intensity_iter)
+            results.append((energy, intensity))
+            if not energy_changed[i] and not intensity_changed[i]:
+                continue
+            # regions with the same bounds and background type on the same
+            # energies are calculated together
+            for region, emin, emax, bgtype in job["regions"][i]:
+                idx1, idx2 = sorted(np.searchsorted(energy, (emin, emax)))
+                groups.setdefault(
+                    (bgtype, idx1, idx2, new["calibration"][i]), []).append(
+                        (region, energy, intensity))
+        backgrounds = []
+        for (bgtype, idx1, idx2, _calibration), members in groups.items():
+            bgs = calculate_background(
+                bgtype, members[0][1][idx1:idx2],
+                np.array([intensity[idx1:idx2]
+                          for (_region, _energy, intensity) in members]))
+            for i, (region, _energy, _intensity) in enumerate(members):
+                backgrounds.append(
+                    (region, idx1, idx2, None if bgs is None else bgs[i]))
+        job["results"] = results
+        job["changed"] = energy_changed | intensity_changed
+        job["backgrounds"] = backgrounds
+
+    @staticmethod
+    def is_current(job):
+        """True if the spectra of a job did not change since it was
+        prepared."""
+        # pylint: disable=protected-access
+        for i, spectrum in enumerate(job["spectra"]):
+            energy, intensity = job["current"][i]
+            if (spectrum._intensity is not job["bases"][i]
+                    or spectrum.energy is not energy
+                    or spectrum.intensity is not intensity):
+                return False
+            for attr in SpectrumMatrix.processing_attrs:
+                if getattr(spectrum, attr) != job["old"][attr][i]:
+                    return False
+            if [(region, region.emin, region.emax, region.bgtype)
+                    for region in spectrum.regions] != job["regions"][i]:
+                return False
+        return True
+
+    @staticmethod
+    def apply(job):
+        """Sets the results of a computed job and emits the signals,
+        returns False (and changes nothing) if the job is outdated."""
+        if not SpectrumMatrix.is_current(job):
+            return False
+        new = job["new"]
+        for i, spectrum in enumerate(job["spectra"]):
+            for attr in SpectrumMatrix.processing_attrs:
+                setattr(spectrum, attr, convert(
+                    Spectrum.types[attr], new[attr][i].item()))
+            if job["changed"][i]:
+                spectrum.energy, spectrum.intensity = job["results"][i]
+        for region, idx1, idx2, background in job["backgrounds"]:
+            region.set_background(idx1, idx2, background)
+        for spectrum in job["spectra"]:
+            spectrum.emit("changed_spectrum", **dict(
+                (attr, getattr(spectrum, attr))
+                for (attr, value) in job["kwargs"].items()
+                if value is not None))
+        return True
 
 
 class SpectrumContainer(list):
@@ -367,71 +806,310 @@ class SpectrumContainer(list):
     spectrum_attrs = ["name", "sid", "visibility", "name", "notes",
                       "eis_region", "fname", "sweeps", "dwelltime",
                       "passenergy", "energy", "intensity"]
+    structural_signals = ("add_spectrum", "add_spectra", "remove_spectrum",
+                          "clear_container")
+
     def __init__(self):
         super().__init__()
         self._observers = []
+        self._immediate_observers = []
+        self._batch_depth = 0
+        self._batch_events = []
         self.altered = True
         self.title = Spectrum.title
+        # sid -> spectrum and sid -> index maps, the latter is rebuilt
+        # lazily after operations that shift indices
+        self._spectra_by_sid = {}
+        self._indices = {}
+        # energy grid key -> SpectrumMatrix and sid -> SpectrumMatrix
+        self.matrices = {}
+        self._matrix_by_sid = {}
+
+    def _attach(self, spectra):
+        """Moves the data of spectra into the SpectrumMatrix of their
+        energy grid."""
+        # pylint: disable=protected-access
+        groups = {}
+        for spectrum in spectra:
+            energy = np.asarray(spectrum._energy)
+            if (spectrum.sid in self._matrix_by_sid or energy.ndim != 1
+                    or np.shape(spectrum._intensity) != energy.shape):
+                continue
+            key = SpectrumMatrix.get_key(energy)
+            groups.setdefault(key, []).append(spectrum)
+        for key, group in groups.items():
+            if key not in self.matrices:
+                self.matrices[key] = SpectrumMatrix(group[0]._energy)
+            matrix = self.matrices[key]
+            matrix.add(group)
+            for spectrum in group:
+                self._matrix_by_sid[spectrum.sid] = matrix
+
+    def _detach(self, spectra):
+        """Takes spectra out of their SpectrumMatrix."""
+        groups = {}
+        for spectrum in spectra:
+            matrix = self._matrix_by_sid.pop(spectrum.sid, None)
+            if matrix is not None:
+                groups.setdefault(id(matrix), (matrix, []))[1].append(
+                    spectrum)
+        for matrix, group in groups.values():
+            matrix.remove(group)
+            if not matrix:
+                del self.matrices[SpectrumMatrix.get_key(matrix.energy)]
+
+    def set_spectra(self, spectra, **kwargs):
+        """Spectrum.set for many spectra at once: calibration, smoothness
+        and norm (single values or one value per spectrum) are applied to
+        whole SpectrumMatrix rows at once."""
+        with self.batch():
+            for matrix, spectra_, values in self._group_by_matrix(
+                    spectra, kwargs):
+                if matrix is not None:
+                    matrix.set(spectra_, **values)
+                    continue
+                for j, spectrum in enumerate(spectra_):
+                    spectrum.set(**dict(
+                        (attr, value[j] if np.ndim(value) else value)
+                        for (attr, value) in values.items()))
+
+    def prepare_spectra(self, spectra, **kwargs):
+        """Like set_spectra, but returns the work as jobs for
+        SpectrumMatrix.compute (which may run on another thread) and
+        SpectrumMatrix.apply."""
+        # pylint: disable=protected-access
+        jobs = []
+        for matrix, spectra_, values in self._group_by_matrix(
+                spectra, kwargs):
+            if matrix is not None:
+                jobs.append(matrix.prepare(spectra_, **values))
+                continue
+            for j, spectrum in enumerate(spectra_):
+                jobs.append(SpectrumMatrix.prepare_job(
+                    spectrum._energy, spectrum._intensity[None],
+                    np.zeros(1, dtype=int), [spectrum], dict(
+                        (attr, value[j] if np.ndim(value) else value)
+                        for (attr, value) in values.items())))
+        return [job for job in jobs if job is not None]
+
+    def _group_by_matrix(self, spectra, kwargs):
+        """Splits spectra (and per spectrum values in kwargs) by their
+        SpectrumMatrix, yields (matrix, spectra, values)."""
+        spectra = list(spectra)
+        groups = {}
+        for i, spectrum in enumerate(spectra):
+            matrix = self._matrix_by_sid.get(spectrum.sid, None)
+            groups.setdefault(id(matrix), (matrix, []))[1].append(i)
+        for matrix, idxs in groups.values():
+            values = dict(
+                (attr, np.asarray(value)[idxs] if np.ndim(value) else value)
+                for (attr, value) in kwargs.items())
+            yield matrix, [spectra[i] for i in idxs], values
+
+    def _reindex(self):
+        """Invalidates the sid -> index map."""
+        self._indices = None
+
+    def _rebuild(self):
+        """Rebuilds both maps from the list content."""
+        self._spectra_by_sid = dict(
+            (spectrum.sid, spectrum) for spectrum in self)
+        self._indices = None
 
     def get_spectrum_by_sid(self, sid):
         """Returns spectrum with the matching uuid."""
-        for spectrum in self:
-            if spectrum.sid == sid:
-                return spectrum
-        return None
+        return self._spectra_by_sid.get(sid, None)
 
     def get_idx_by_sid(self, sid):
         """Returns spectrum with the matching uuid."""
-        for idx, spectrum in enumerate(self):
-            if spectrum.sid == sid:
-                return idx
-        return None
+        if self._indices is None:
+            self._indices = dict(
+                (spectrum.sid, idx) for idx, spectrum in enumerate(self))
+        return self._indices.get(sid, None)
+
+    def index(self, spectrum, *args):
+        """Returns the index of spectrum, uses the sid map."""
+        if args:
+            return super().index(spectrum, *args)
+        idx = self.get_idx_by_sid(spectrum.sid)
+        if idx is None:
+            raise ValueError("{} is not in SpectrumContainer".format(
+                spectrum))
+        return idx
+
+    def __contains__(self, spectrum):
+        return getattr(spectrum, "sid", None) in self._spectra_by_sid
 
     def show_only(self, spectra_to_show):
         """ sets all visibility values to None except for one """
         if isinstance(spectra_to_show, Spectrum):
             spectra_to_show = [spectra_to_show]
+        sids_to_show = set(spectrum.sid for spectrum in spectra_to_show)
         for spectrum in self:
-            if spectrum in spectra_to_show:
+            if spectrum.sid in sids_to_show:
                 spectrum.plot()
             else:
                 spectrum.unplot()
         self.emit("plot")
 
     def append(self, spectrum):
+        self._attach([spectrum])
         super().append(spectrum)
-        idx = self.index(spectrum)
+        self._spectra_by_sid[spectrum.sid] = spectrum
+        idx = len(self) - 1
+        if self._indices is not None:
+            self._indices[spectrum.sid] = idx
         self.emit("add_spectrum", spectrum=spectrum, index=idx)
-        for callback in self._observers:
-            spectrum.subscribe(callback)
+        spectrum.subscribe(self.relay)
 
     def extend(self, spectra):
-        for spectrum in spectra:
-            self.append(spectrum)
+        """Adds all spectra at once and emits a single "add_spectra"
+        signal with the index of the first new spectrum."""
+        spectra = list(spectra)
+        if not spectra:
+            return
+        start = len(self)
+        self._attach(spectra)
+        super().extend(spectra)
+        for idx, spectrum in enumerate(spectra, start):
+            self._spectra_by_sid[spectrum.sid] = spectrum
+            if self._indices is not None:
+                self._indices[spectrum.sid] = idx
+            spectrum.subscribe(self.relay)
+        self.emit("add_spectra", spectra=spectra, index=start)
 
     def remove(self, spectrum):
         idx = self.index(spectrum)
         self.emit("remove_spectrum", spectrum=spectrum, index=idx)
-        super().remove(spectrum)
+        spectrum.unsubscribe(self.relay)
+        self._detach([spectrum])
+        super().__delitem__(idx)
+        del self._spectra_by_sid[spectrum.sid]
+        if idx == len(self) and self._indices is not None:
+            del self._indices[spectrum.sid]
+        else:
+            self._reindex()
+
+    def insert(self, idx, spectrum):
+        self._attach([spectrum])
+        super().insert(idx, spectrum)
+        self._rebuild()
+        self.emit("add_spectrum", spectrum=spectrum,
+                  index=self.index(spectrum))
+        spectrum.subscribe(self.relay)
+
+    def pop(self, *args):
+        spectrum = super().pop(*args)
+        spectrum.unsubscribe(self.relay)
+        self._detach([spectrum])
+        self._rebuild()
+        return spectrum
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            old_spectra, new_spectra = self[key], list(value)
+        else:
+            old_spectra, new_spectra = [self[key]], [value]
+        for spectrum in old_spectra:
+            spectrum.unsubscribe(self.relay)
+        self._detach(old_spectra)
+        self._attach(new_spectra)
+        super().__setitem__(key, new_spectra if isinstance(key, slice)
+                            else value)
+        for spectrum in new_spectra:
+            spectrum.subscribe(self.relay)
+        self._rebuild()
+
+    def __delitem__(self, key):
+        old_spectra = self[key] if isinstance(key, slice) else [self[key]]
+        for spectrum in old_spectra:
+            spectrum.unsubscribe(self.relay)
+        self._detach(old_spectra)
+        super().__delitem__(key)
+        self._rebuild()
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self._reindex()
+
+    def reverse(self):
+        super().reverse()
+        self._reindex()
 
     def clear(self):
         self.show_only([])
         self.emit("clear_container")
-        super().clear()
-
-    def subscribe(self, callback):
-        """Bind a new callback of class_ to this."""
-        self._observers.append(callback)
         for spectrum in self:
-            spectrum.subscribe(callback)
+            spectrum.unsubscribe(self.relay)
+        self._detach(self)
+        super().clear()
+        self._rebuild()
+
+    def subscribe(self, callback, batched=True):
+        """Bind a new callback to this and all spectra, regions and peaks.
+        Callbacks with batched=False get every single signal even inside
+        self.batch()."""
+        if batched:
+            self._observers.append(callback)
+        else:
+            self._immediate_observers.append(callback)
 
     def unsubscribe(self, callback):
         """Unbind the callback."""
-        self._observers.remove(callback)
-        for spectrum in self:
-            spectrum.unsubscribe(callback)
+        if callback in self._observers:
+            self._observers.remove(callback)
+        else:
+            self._immediate_observers.remove(callback)
 
     def emit(self, keyword, **kwargs):
         """Emits to all obervers."""
+        self.relay(keyword, self, **kwargs)
+
+    def relay(self, keyword, obj, **kwargs):
+        """Forwards signals from this and from all spectra, regions and
+        peaks to the observers. Inside self.batch(), signals are collected
+        for the batched observers; structural signals of the container
+        itself are never held back."""
+        for callback in self._immediate_observers:
+            callback(keyword, obj, **kwargs)
+        if self._batch_depth and keyword not in self.structural_signals:
+            self._batch_events.append((keyword, obj, kwargs))
+            return
+        self.flush_batch()
+        for callback in self._observers:
+            callback(keyword, obj, **kwargs)
+
+    @contextmanager
+    def batch(self):
+        """Collects signals while open and emits them as a single "batch"
+        signal on exit, events=[(keyword, obj, kwargs)] in order. Change
+        signals (changed_*) with the same keyword and object are merged
+        into the first one (their kwargs updated), all other signals are
+        kept as they are."""
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self.flush_batch()
+
+    def flush_batch(self):
+        """Emits the signals collected so far as one "batch" signal."""
+        if not self._batch_events:
+            return
+        events = []
+        merged = {}
+        for keyword, obj, kwargs in self._batch_events:
+            if not keyword.startswith("changed_"):
+                events.append((keyword, obj, dict(kwargs)))
+                continue
+            key = (keyword, id(obj))
+            if key in merged:
+                merged[key][2].update(kwargs)
+            else:
+                merged[key] = (keyword, obj, dict(kwargs))
+                events.append(merged[key])
+        self._batch_events = []
         for callback in self._observers:
-            callback(keyword, self, **kwargs)
+            callback("batch", self, events=events)
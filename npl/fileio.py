@@ -2,12 +2,18 @@
 
 import re
 import os
+import csv
+import queue
 import pickle
 import sqlite3
+import zipfile
+import threading
+from contextlib import contextmanager
 
 import numpy as np
 
 from npl.containers import Spectrum, SpectrumContainer
+from npl.processing import find_peaks
 from npl import __config__
 
 
@@ -82,18 +88,27 @@ class FileParser():
 
 class DBHandler():
     """Handles database access, opening and saving projects
-    (i.e. SpectrumContainers)"""
+    (i.e. SpectrumContainers). Spectra are stored with their raw data,
+    processing parameters (calibration, smoothness, norm), regions and
+    peaks, see get_state."""
     spectrum_keys = ["Name", "Notes", "EISRegion", "Filename", "Sweeps",
                      "DwellTime", "PassEnergy", "Visibility"]
+    processing_keys = ["Calibration", "Smoothness", "Norm"]
 
     def __init__(self, dbfilename="untitled.npl"):
         self.dbfilename = dbfilename
 
     def save(self, spectrum_container, fname):
         """Saves SpectrumContainer to fname."""
+        self.save_states(
+            [self.get_state(spectrum) for spectrum in spectrum_container],
+            fname)
+
+    def save_states(self, states, fname):
+        """Saves spectrum states (see get_state) to fname."""
         self.change_dbfile(fname)
         self.wipe_tables()
-        self.save_container(spectrum_container)
+        self.save_container(states)
 
     def load(self, fname):
         """Loads SpectrumContainer from fname."""
@@ -101,6 +116,60 @@ class DBHandler():
         spectrum_container = self.get_container()
         return spectrum_container
 
+    @staticmethod
+    def get_state(spectrum):
+        """Returns everything that is saved of a spectrum as a dict of
+        plain values, regions and peaks as lists of dicts. The arrays are
+        shared with the spectrum, they are replaced instead of changed in
+        place."""
+        # pylint: disable=protected-access
+        state = dict((attr, getattr(spectrum, attr))
+                     for attr in spectrum.attrs)
+        state["energy"] = spectrum._energy
+        state["intensity"] = spectrum._intensity
+        state["regions"] = [DBHandler.get_region_state(region)
+                            for region in spectrum.regions]
+        return state
+
+    @staticmethod
+    def get_region_state(region):
+        """Returns the saved values of a region and its peaks."""
+        return {
+            "name": region.name, "emin": region.emin, "emax": region.emax,
+            "bgtype": region.bgtype,
+            "peaks": [{"name": peak.name, "model_name": peak.model_name,
+                       "area": peak.area, "fwhm": peak.fwhm,
+                       "center": peak.center,
+                       # guessed peaks have no values before the first fit
+                       "guess": None in (peak.area, peak.fwhm, peak.center)}
+                      for peak in region.peaks]}
+
+    @staticmethod
+    def make_spectrum(state):
+        """Makes a Spectrum with regions and peaks from a state."""
+        state = dict(state)
+        regions = state.pop("regions", None) or []
+        processing = dict((attr, state.pop(attr, None))
+                          for attr in ("calibration", "smoothness", "norm"))
+        spectrum = Spectrum(**state)
+        processing = dict((attr, value) for attr, value in processing.items()
+                          if value)
+        if processing:
+            spectrum.set(**processing)
+        for region in regions:
+            if not isinstance(region, dict):
+                # projects written before regions were saved as dicts
+                region = DBHandler.get_region_state(region)
+            spectrum.add_region(emin=region["emin"], emax=region["emax"],
+                                name=region["name"])
+            new_region = spectrum.regions[-1]
+            if region["bgtype"] != new_region.bgtype:
+                new_region.set(bgtype=region["bgtype"])
+            for peak in region["peaks"]:
+                new_region.add_peak(**peak)
+            new_region.peakname = len(new_region.peaks)
+        return spectrum
+
     def change_dbfile(self, new_filename):
         """Change db file name."""
         self.dbfilename = new_filename
@@ -125,6 +194,9 @@ class DBHandler():
                           Energy blob,
                           Intensity blob,
                           Regions blob,
+                          Calibration real,
+                          Smoothness integer,
+                          Norm integer,
                           PRIMARY KEY (SpectrumID))"""]
         with sqlite3.connect(self.dbfilename) as database:
             cursor = database.cursor()
@@ -148,45 +220,55 @@ class DBHandler():
         self.create_tables()
 
     def get_container(self):
-        """Loads project file and returns SpectrumContainer."""
+        """Loads project file and returns SpectrumContainer. Projects
+        without processing columns (older files) load with the default
+        processing."""
         with sqlite3.connect(self.dbfilename) as database:
             cursor = database.cursor()
+            cursor.execute("PRAGMA table_info(Spectrum)", ())
+            columns = set(row[1] for row in cursor.fetchall())
+            processing_keys = [key for key in self.processing_keys
+                               if key in columns]
             sql = """SELECT SpectrumID, Name, Notes, EISRegion, Filename,
                      Sweeps, DwellTime, PassEnergy, Visibility, Energy,
-                     Intensity, Regions
-                     FROM Spectrum"""
+                     Intensity, Regions{}
+                     FROM Spectrum""".format(
+                         "".join(", " + key for key in processing_keys))
             cursor.execute(sql, ())
             spectrum_container = SpectrumContainer()
             spectra = cursor.fetchall()
+            new_spectra = []
             for spectrum in spectra:
-                specdict = {"sid": spectrum[0],
-                            "name": spectrum[1],
-                            "notes": spectrum[2],
-                            "eis_region": spectrum[3],
-                            "fname": spectrum[4],
-                            "sweeps": spectrum[5],
-                            "dwelltime": spectrum[6],
-                            "passenergy": spectrum[7],
-                            "visibility": "",   #TODO: delete tag
-                            "energy": pickle.loads(spectrum[9]),
-                            "intensity": pickle.loads(spectrum[10]),
-                            "regions": pickle.loads(spectrum[11])}
-                spectrum_container.append(Spectrum(**specdict))
+                state = {"name": spectrum[1],
+                         "notes": spectrum[2],
+                         "eis_region": spectrum[3],
+                         "fname": spectrum[4],
+                         "sweeps": spectrum[5],
+                         "dwelltime": spectrum[6],
+                         "passenergy": spectrum[7],
+                         "visibility": "",   #TODO: delete tag
+                         "energy": pickle.loads(spectrum[9]),
+                         "intensity": pickle.loads(spectrum[10]),
+                         "regions": pickle.loads(spectrum[11])}
+                for key, value in zip(processing_keys, spectrum[12:]):
+                    state[key.lower()] = value
+                new_spectra.append(self.make_spectrum(state))
+            spectrum_container.extend(new_spectra)
         return spectrum_container
 
-    def save_container(self, spectrum_container):
-        """Dumps SpectrumContainer as project file."""
+    def save_container(self, states):
+        """Dumps spectrum states (see get_state) as project file."""
         self.wipe_tables()
         idlist = []
         with sqlite3.connect(self.dbfilename) as database:
             cursor = database.cursor()
-            for spectrum in spectrum_container:
-                idlist.append(self.add_spectrum(spectrum, cursor))
+            for state in states:
+                idlist.append(self.add_spectrum(state, cursor))
             database.commit()
         return idlist
 
-    def add_spectrum(self, spectrum, cursor=None):
-        """Adds a spectrum to the project file."""
+    def add_spectrum(self, state, cursor=None):
+        """Adds a spectrum state (see get_state) to the project file."""
         needs_closing = False
         if cursor is None:
             needs_closing = True
@@ -194,19 +276,23 @@ class DBHandler():
             cursor = database.cursor()
         sql = """INSERT INTO Spectrum(Name, Notes, EISRegion, Filename,
                                       Sweeps, DwellTime, PassEnergy,
-                                      Visibility, Energy, Intensity, Regions)
-                 VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
-        values = (spectrum.name,
-                  spectrum.notes,
-                  spectrum.eis_region,
-                  spectrum.fname,
-                  spectrum.sweeps,
-                  spectrum.dwelltime,
-                  spectrum.passenergy,
-                  spectrum.visibility,
-                  pickle.dumps(spectrum.energy),
-                  pickle.dumps(spectrum.intensity),
-                  pickle.dumps(spectrum.regions))
+                                      Visibility, Energy, Intensity, Regions,
+                                      Calibration, Smoothness, Norm)
+                 VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+        values = (state["name"],
+                  state["notes"],
+                  state["eis_region"],
+                  state["fname"],
+                  state["sweeps"],
+                  state["dwelltime"],
+                  state["passenergy"],
+                  state["visibility"],
+                  pickle.dumps(state["energy"]),
+                  pickle.dumps(state["intensity"]),
+                  pickle.dumps(state["regions"]),
+                  state["calibration"],
+                  state["smoothness"],
+                  state["norm"])
         cursor.execute(sql, values)
         spectrum_id = cursor.lastrowid
         if needs_closing:
@@ -245,32 +331,647 @@ class DBHandler():
                 return ids[0][0]
 
 
+class DataExporter():
+    """Exports every spectrum of a SpectrumContainer together with region
+    backgrounds, fit envelopes and peak components. In both formats the
+    envelope and the peaks include the region background, as they are
+    plotted. Data is written spectrum by spectrum, so memory consumption
+    does not depend on the project size."""
+    text_attrs = ("name", "notes", "eis_region", "fname")
+    number_attrs = ("sweeps", "dwelltime", "passenergy", "calibration",
+                    "smoothness", "norm")
+
+    def __init__(self, container):
+        self.container = container
+
+    def export(self, fname):
+        """Checks file extension and calls appropriate export method."""
+        if fname.split(".")[-1] == "npz":
+            self.write_npz(fname)
+        elif fname.split(".")[-1] == "csv":
+            self.write_csv(fname)
+        else:
+            raise ValueError("Unknown export format {}".format(fname))
+
+    @staticmethod
+    def iter_curves(spectrum):
+        """Yields (region name, curve name, energy, intensity) for the
+        spectrum itself and all backgrounds, fits and peaks."""
+        yield "", "spectrum", spectrum.energy, spectrum.intensity
+        for region in spectrum.regions:
+            if region.background is None:
+                continue
+            yield region.name, "background", region.energy, region.background
+            if region.fit_intensity is None:
+                continue
+            yield (region.name, "envelope", region.energy,
+                   DataExporter.with_background(region.fit_intensity, region))
+            for peak in region.peaks:
+                fit_intensity = peak.fit_intensity
+                if fit_intensity is None:
+                    continue
+                yield (region.name, "peak {}".format(peak.name),
+                       region.energy,
+                       DataExporter.with_background(fit_intensity, region))
+
+    def write_csv(self, fname):
+        """Writes a long format CSV: one row per data point and curve."""
+        with open(fname, "w", newline="") as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(("spectrum", "name", "region", "curve",
+                             "energy", "intensity"))
+            for idx, spectrum in enumerate(self.container):
+                for region, curve, energy, intensity in self.iter_curves(
+                        spectrum):
+                    writer.writerows(
+                        (idx, spectrum.name, region, curve, x, y)
+                        for (x, y) in zip(energy, intensity))
+
+    def write_npz(self, fname):
+        """Writes a compressed .npz bundle. "spectra", "regions" and
+        "peaks" are metadata tables (structured arrays) whose "offset" and
+        "length" fields point into the stacked data columns. "envelope"
+        and "peak_intensity" include the background, they are NaN where
+        there is no fit."""
+        spectra, regions, peaks = self.get_tables()
+        with zipfile.ZipFile(fname, "w", compression=zipfile.ZIP_DEFLATED,
+                             allowZip64=True) as zfile:
+            for name, table in (("spectra", spectra), ("regions", regions),
+                                ("peaks", peaks)):
+                with zfile.open("{}.npy".format(name), "w") as npyfile:
+                    np.lib.format.write_array(npyfile, table)
+
+            all_regions = [region for spectrum in self.container
+                           for region in spectrum.regions]
+            all_peaks = [(region, peak) for region in all_regions
+                         for peak in region.peaks]
+            columns = (
+                ("energy", spectra,
+                 (s.energy for s in self.container)),
+                ("intensity", spectra,
+                 (s.intensity for s in self.container)),
+                ("region_energy", regions,
+                 (r.energy for r in all_regions)),
+                ("background", regions,
+                 (self.nan_if_none(r.background, r.energy)
+                  for r in all_regions)),
+                ("envelope", regions,
+                 (self.with_background(r.fit_intensity, r)
+                  for r in all_regions)),
+                ("peak_intensity", peaks,
+                 (self.with_background(p.fit_intensity, r)
+                  for (r, p) in all_peaks)))
+            for name, table, chunks in columns:
+                self.write_column(
+                    zfile, name, int(table["length"].sum()), chunks)
+
+    def get_tables(self):
+        """Returns the spectrum, region and peak metadata tables."""
+        spectrum_rows, region_rows, peak_rows = [], [], []
+        offsets = [0, 0, 0]
+        for sidx, spectrum in enumerate(self.container):
+            length = len(spectrum.energy)
+            spectrum_rows.append(
+                (spectrum.sid, )
+                + tuple(str(getattr(spectrum, attr))
+                        for attr in self.text_attrs)
+                + tuple(self.to_float(getattr(spectrum, attr))
+                        for attr in self.number_attrs)
+                + (offsets[0], length))
+            offsets[0] += length
+            for region in spectrum.regions:
+                length = len(region.energy)
+                region_rows.append(
+                    (sidx, str(region.name), region.emin, region.emax,
+                     str(region.bgtype), offsets[1], length))
+                for peak in region.peaks:
+                    peak_rows.append(
+                        (len(region_rows) - 1, str(peak.name),
+                         str(peak.model_name), self.to_float(peak.center),
+                         self.to_float(peak.fwhm), self.to_float(peak.area),
+                         offsets[2], length))
+                    offsets[2] += length
+                offsets[1] += length
+
+        spectrum_dtype = (
+            [("sid", "u8")]
+            + [(attr, self.str_dtype(spectrum_rows, i + 1))
+               for i, attr in enumerate(self.text_attrs)]
+            + [(attr, "f8") for attr in self.number_attrs]
+            + [("offset", "i8"), ("length", "i8")])
+        region_dtype = [
+            ("spectrum", "i8"), ("name", self.str_dtype(region_rows, 1)),
+            ("emin", "f8"), ("emax", "f8"),
+            ("bgtype", self.str_dtype(region_rows, 4)),
+            ("offset", "i8"), ("length", "i8")]
+        peak_dtype = [
+            ("region", "i8"), ("name", self.str_dtype(peak_rows, 1)),
+            ("model_name", self.str_dtype(peak_rows, 2)),
+            ("center", "f8"), ("fwhm", "f8"), ("area", "f8"),
+            ("offset", "i8"), ("length", "i8")]
+        return (np.array(spectrum_rows, dtype=spectrum_dtype),
+                np.array(region_rows, dtype=region_dtype),
+                np.array(peak_rows, dtype=peak_dtype))
+
+    @staticmethod
+    def write_column(zfile, name, length, chunks):
+        """Streams chunks of float data into a single .npy array of
+        given length inside zfile."""
+        header = {"descr": np.lib.format.dtype_to_descr(np.dtype("f8")),
+                  "fortran_order": False,
+                  "shape": (length, )}
+        with zfile.open("{}.npy".format(name), "w",
+                        force_zip64=True) as npyfile:
+            np.lib.format.write_array_header_1_0(npyfile, header)
+            for chunk in chunks:
+                npyfile.write(
+                    np.ascontiguousarray(chunk, dtype="f8").tobytes())
+
+    @staticmethod
+    def nan_if_none(values, energy):
+        """Returns values or NaNs of the same length as energy."""
+        if values is None:
+            return np.full(len(energy), np.nan)
+        return values
+
+    @staticmethod
+    def with_background(values, region):
+        """Returns values + region.background, NaNs of the region length
+        if either is missing."""
+        if values is None or region.background is None:
+            return np.full(len(region.energy), np.nan)
+        return values + region.background
+
+    @staticmethod
+    def to_float(value):
+        """Converts metadata to float, NaN if impossible."""
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return np.nan
+
+    @staticmethod
+    def str_dtype(rows, column):
+        """Returns a numpy unicode dtype that fits all strings in
+        rows[:][column]."""
+        maxlen = max([len(row[column]) for row in rows] + [1])
+        return "U{}".format(maxlen)
+
+
+class ChangeJournal():
+    """Append-only journal of all changes to a SpectrumContainer. Records
+    are pickled on the calling thread and written by a background thread,
+    so durability costs O(change). The records apply to a base file, the
+    journal also remembers the project file the user works on. From time
+    to time the journal is compacted into recovery_fname (never into the
+    project file, that is only written by an explicit compact), and after
+    a crash the base is loaded and the records are replayed."""
+    # pylint: disable=too-many-instance-attributes
+    processing_attrs = ("calibration", "smoothness", "norm")
+    region_attrs = ("emin", "emax", "bgtype")
+    peak_attrs = ("fwhm", "area", "center")
+
+    def __init__(self, fname, recovery_fname=None, max_records=500,
+                 error_callback=None):
+        self.fname = fname
+        self.recovery_fname = recovery_fname
+        self.max_records = max_records
+        # called with the exception if writing fails, in the writer thread
+        self.error_callback = error_callback
+        self.n_records = 0
+        self.container = None
+        self.base = None
+        self.project = None
+        self.is_suspended = False
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def attach(self, container):
+        """Starts journaling all changes done to container."""
+        self.container = container
+        container.subscribe(self.container_callback, batched=False)
+
+    @contextmanager
+    def suspended(self):
+        """Changes done inside this context are not journaled."""
+        self.is_suspended = True
+        try:
+            yield
+        finally:
+            self.is_suspended = False
+
+    def needs_recovery(self):
+        """True if the journal holds changes that are not in the project
+        file: records, or a base that is not the project (a compacted
+        recovery file)."""
+        base, project, records = self.read()
+        return bool(records) or (base is not None and base != project)
+
+    def read(self):
+        """Returns the base file name, the project file name and the list
+        of records from the journal file. A truncated tail (crash while
+        writing) is ignored."""
+        base = None
+        project = None
+        records = []
+        if not os.path.isfile(self.fname):
+            return base, project, records
+        with open(self.fname, "rb") as jfile:
+            while True:
+                try:
+                    record = pickle.load(jfile)
+                except (EOFError, pickle.UnpicklingError):
+                    break
+                if record["event"] == "base":
+                    base = record["fname"]
+                    project = record.get("project", None)
+                else:
+                    records.append(record)
+        return base, project, records
+
+    def reset(self, base, project=None):
+        """Truncates the journal, base is the file that the following
+        records refer to, project the file of the user."""
+        self.base = base
+        self.project = project
+        self.n_records = 0
+        self._queue.put(("reset", base, project))
+
+    def compact(self, container, fname, project=None):
+        """Saves a snapshot of container to fname in the background and
+        truncates the journal afterwards (only if saving succeeded). The
+        snapshot is taken here, so the writer thread never touches
+        objects the GUI changes."""
+        snapshot = [DBHandler.get_state(spectrum) for spectrum in container]
+        self.base = fname
+        self.project = project
+        self.n_records = 0
+        self._queue.put(("compact", fname, project, snapshot))
+
+    def autosave(self, container):
+        """Compacts into the recovery file if there are new records."""
+        if self.n_records and self.recovery_fname is not None:
+            self.compact(container, self.recovery_fname, self.project)
+
+    def flush(self):
+        """Blocks until all queued records are written."""
+        self._queue.join()
+
+    def close(self):
+        """Stops the writer thread and removes the journal file, changes
+        that were not saved explicitly are discarded."""
+        self._queue.put(("close", ))
+        self._thread.join()
+        if os.path.isfile(self.fname):
+            os.remove(self.fname)
+
+    def container_callback(self, keyword, obj, **kwargs):
+        """Turns container, spectrum, region and peak signals into
+        journal records."""
+        # pylint: disable=too-many-branches, protected-access
+        if self.is_suspended:
+            return
+        if keyword == "add_spectra":
+            for idx, spectrum in enumerate(kwargs["spectra"], kwargs["index"]):
+                self.container_callback(
+                    "add_spectrum", obj, spectrum=spectrum, index=idx)
+            return
+        record = {"event": keyword}
+        if keyword == "add_spectrum":
+            spectrum = kwargs["spectrum"]
+            data = dict((attr, getattr(spectrum, attr))
+                        for attr in spectrum.attrs)
+            data["energy"] = spectrum._energy
+            data["intensity"] = spectrum._intensity
+            record.update(index=kwargs["index"], data=data)
+            self._put(record)
+            # spectra that are put back (e.g. by undo) bring their regions
+            for region in spectrum.regions:
+                self.container_callback("add_region", spectrum, region=region)
+            return
+        elif keyword == "remove_spectrum":
+            record.update(index=kwargs["index"])
+        elif keyword == "clear_container":
+            pass
+        elif keyword == "changed_spectrum":
+            attrs = self.processing_attrs + tuple(obj.titles)
+            values = dict((key, value) for (key, value) in kwargs.items()
+                          if key in attrs)
+            if not values:
+                return
+            record.update(path=self.get_path(obj), values=values)
+        elif keyword == "add_region":
+            region = kwargs["region"]
+            data = {"emin": region.emin, "emax": region.emax,
+                    "name": region.name, "bgtype": region.bgtype}
+            record.update(path=self.get_path(obj), data=data,
+                          index=obj.regions.index(region))
+            self._put(record)
+            for peak in region.peaks:
+                self.container_callback("add_peak", region, peak=peak)
+            return
+        elif keyword == "remove_region":
+            record.update(path=self.get_path(obj),
+                          index=kwargs.get("index", None))
+        elif keyword == "changed_region":
+            values = dict((key, value) for (key, value) in kwargs.items()
+                          if key in self.region_attrs)
+            if not values:
+                return
+            record.update(path=self.get_path(obj), values=values)
+        elif keyword == "add_peak":
+            peak = kwargs["peak"]
+            data = {"name": peak.name, "model_name": peak.model_name,
+                    "area": peak.area, "fwhm": peak.fwhm,
+                    "center": peak.center}
+            record.update(path=self.get_path(obj), data=data,
+                          index=obj.peaks.index(peak))
+        elif keyword == "remove_peak":
+            record.update(path=self.get_path(obj),
+                          index=kwargs.get("index", None))
+        elif keyword == "changed_peak":
+            values = dict((key, value) for (key, value) in kwargs.items()
+                          if key in self.peak_attrs)
+            if not values:
+                return
+            record.update(path=self.get_path(obj), values=values)
+        else:
+            return
+        self._put(record)
+
+    def _put(self, record):
+        """Queues a record for the writer thread."""
+        self._queue.put(("record", pickle.dumps(record)))
+        self.n_records += 1
+        if self.max_records and self.n_records >= self.max_records:
+            self.autosave(self.container)
+
+    def get_path(self, obj):
+        """Returns the position of a spectrum, region or peak as tuple of
+        indices, those stay valid because every insertion and removal is
+        journaled, too."""
+        if isinstance(obj, Spectrum):
+            return (self.container.index(obj), )
+        if hasattr(obj, "peaks"):
+            return self.get_path(obj.spectrum) + (
+                obj.spectrum.regions.index(obj), )
+        return self.get_path(obj.region) + (obj.region.peaks.index(obj), )
+
+    @staticmethod
+    def get_obj(container, path):
+        """Returns the object at path (see self.get_path)."""
+        obj = container[path[0]]
+        if len(path) > 1:
+            obj = obj.regions[path[1]]
+        if len(path) > 2:
+            obj = obj.peaks[path[2]]
+        return obj
+
+    def replay(self, container, records):
+        """Applies records to container (which must have been loaded from
+        the journal base)."""
+        # pylint: disable=too-many-branches
+        for record in records:
+            event = record["event"]
+            if event == "add_spectrum":
+                data = dict(record["data"])
+                processing = dict((attr, data.pop(attr))
+                                  for attr in self.processing_attrs)
+                spectrum = Spectrum(**data)
+                if record["index"] < len(container):
+                    container.insert(record["index"], spectrum)
+                else:
+                    container.append(spectrum)
+                spectrum.set(**processing)
+            elif event == "remove_spectrum":
+                container.remove(container[record["index"]])
+            elif event == "clear_container":
+                container.clear()
+            elif event in ("changed_spectrum", "changed_region",
+                           "changed_peak"):
+                self.get_obj(container, record["path"]).set(
+                    **record["values"])
+            elif event == "add_region":
+                spectrum = self.get_obj(container, record["path"])
+                data = dict(record["data"])
+                bgtype = data.pop("bgtype", None)
+                spectrum.add_region(**data)
+                region = spectrum.regions[-1]
+                if bgtype is not None:
+                    region.set(bgtype=bgtype)
+                self.move_last(spectrum.regions, record.get("index", None))
+            elif event == "remove_region":
+                spectrum = self.get_obj(container, record["path"])
+                if record["index"] is None:
+                    spectrum.clear_regions()
+                else:
+                    spectrum.remove_region(spectrum.regions[record["index"]])
+            elif event == "add_peak":
+                region = self.get_obj(container, record["path"])
+                region.add_peak(**record["data"])
+                self.move_last(region.peaks, record.get("index", None))
+            elif event == "remove_peak":
+                region = self.get_obj(container, record["path"])
+                if record["index"] is None:
+                    region.clear_peaks()
+                else:
+                    region.remove_peak(region.peaks[record["index"]])
+
+    @staticmethod
+    def move_last(items, index):
+        """Moves the last item of a list to index."""
+        if index is not None and index < len(items) - 1:
+            items.insert(index, items.pop())
+
+    def _write_loop(self):
+        """Runs in the writer thread."""
+        jfile = open(self.fname, "ab")
+        while True:
+            item = self._queue.get()
+            try:
+                if item[0] == "record":
+                    jfile.write(item[1])
+                elif item[0] == "reset":
+                    jfile.close()
+                    jfile = self._truncate(item[1], item[2])
+                elif item[0] == "compact":
+                    _keyword, fname, project, snapshot = item
+                    self._save_snapshot(snapshot, fname)
+                    jfile.close()
+                    jfile = self._truncate(fname, project)
+                elif item[0] == "close":
+                    jfile.close()
+                    return
+                if self._queue.empty():
+                    jfile.flush()
+                    os.fsync(jfile.fileno())
+            except (OSError, sqlite3.Error, pickle.PicklingError) as error:
+                if self.error_callback is not None:
+                    self.error_callback(error)
+                else:
+                    print("journal: {}".format(error))
+            finally:
+                self._queue.task_done()
+
+    def _truncate(self, base, project):
+        """Starts a new journal file referring to base and project."""
+        jfile = open(self.fname, "wb")
+        jfile.write(pickle.dumps(
+            {"event": "base", "fname": base, "project": project}))
+        return jfile
+
+    @staticmethod
+    def _save_snapshot(snapshot, fname):
+        """Atomically writes snapshot (a list of spectrum states, see
+        DBHandler.get_state) to fname."""
+        tmpname = "{}.tmp".format(fname)
+        if os.path.isfile(tmpname):
+            os.remove(tmpname)
+        DBHandler(tmpname).save_states(snapshot, tmpname)
+        os.replace(tmpname, fname)
+
+
 class RSFHandler():
-    """Handles rsf library."""
-    # pylint: disable=too-few-public-methods
+    """Handles rsf library. The library is read once (lazily) into one
+    structured array per X-ray source, sorted by element, so that getting
+    the lines of an element is just an array slice."""
     k_alpha = {"Al": 1486.3,
                "Mg": 1253.4}
 
     def __init__(self, filename):
         self.filename = filename
+        self._tables = None
+        self._index = None
+        self._by_energy = None
+        self._codes = None
+
+    @property
+    def tables(self):
+        """Dictionary of structured arrays {source: table}, loads the
+        library on first access."""
+        if self._tables is None:
+            self.load()
+        return self._tables
+
+    def load(self):
+        """Reads the whole library and precomputes binding energies for
+        every source in self.k_alpha."""
+        with sqlite3.connect(self.filename) as rsfbase:
+            cursor = rsfbase.cursor()
+            sql = """SELECT Element, Fullname, IsAuger, BE, RSF, Source
+                     FROM Peak ORDER BY Element, PeakID"""
+            cursor.execute(sql, ())
+            rows = cursor.fetchall()
+        dtype = [("element", "U{}".format(max(len(r[0]) for r in rows))),
+                 ("fullname", "U{}".format(max(len(r[1]) for r in rows))),
+                 ("is_auger", "?"),
+                 ("BE", "f8"),
+                 ("RSF", "f8")]
+        sources = np.array([row[5] for row in rows])
+        library = np.array([row[:5] for row in rows], dtype=dtype)
+
+        self._tables = {}
+        self._index = {}
+        self._by_energy = {}
+        self._codes = {}
+        for source, k_alpha in self.k_alpha.items():
+            table = library[(sources == source) | (sources == "Any")]
+            table["BE"] = np.where(
+                table["is_auger"], k_alpha - table["BE"], table["BE"])
+            elements, starts, codes, counts = np.unique(
+                table["element"], return_index=True, return_inverse=True,
+                return_counts=True)
+            self._tables[source] = table
+            self._index[source] = dict(
+                (element, slice(start, start + count))
+                for element, start, count in zip(elements, starts, counts))
+            self._by_energy[source] = table[
+                np.argsort(table["BE"], kind="stable")]
+            self._codes[source] = (elements, codes)
+
+    def get_element_table(self, element, source):
+        """Returns the structured array (fields element, fullname,
+        is_auger, BE, RSF) of all lines of element with given source."""
+        if source not in self.tables:
+            return self.tables[list(self.k_alpha)[0]][:0]
+        idx = self._index[source].get(element.title(), slice(0, 0))
+        return self.tables[source][idx]
+
+    def get_lines_near(self, energy, delta, source):
+        """Returns all core level and Auger lines within energy +- delta
+        for given source as structured array (see get_element_table),
+        ranked by RSF."""
+        if source not in self.tables:
+            return self.tables[list(self.k_alpha)[0]][:0]
+        table = self._by_energy[source]
+        idx1 = np.searchsorted(table["BE"], energy - delta, side="left")
+        idx2 = np.searchsorted(table["BE"], energy + delta, side="right")
+        lines = table[idx1:idx2]
+        return lines[np.argsort(-lines["RSF"], kind="stable")]
+
+    def identify_elements(self, energy, intensity, source, tolerance=1.5,
+                          min_score=0.5, auger_weight=0.5):
+        """Detects peaks in a survey spectrum and scores every element in
+        the library against them. Returns a list of (element, score)
+        tuples, best first."""
+        peak_energies, _prominences = find_peaks(energy, intensity)
+        return self.score_elements(
+            peak_energies, source, (min(energy), max(energy)),
+            tolerance=tolerance, min_score=min_score,
+            auger_weight=auger_weight)
+
+    def score_elements(self, peak_energies, source, span, tolerance=1.5,
+                       min_score=0.5, auger_weight=0.5):
+        """Scores all elements at once: the score is the RSF weighted
+        fraction of an element's lines inside span that lie within
+        tolerance of a detected peak. Missing spin-orbit partners and
+        missing Auger lines therefore lower the score. Elements whose
+        strongest core level is not found get zero."""
+        # pylint: disable=too-many-arguments, too-many-locals
+        if source not in self.tables or not len(peak_energies):
+            return []
+        table = self.tables[source]
+        elements, codes = self._codes[source]
+        n_elements = len(elements)
+
+        expected = (table["BE"] >= span[0]) & (table["BE"] <= span[1])
+        core_weights = np.where(
+            table["is_auger"] | ~expected, 0, np.maximum(table["RSF"], 0.05))
+        weights = core_weights + (table["is_auger"] & expected) * auger_weight
+
+        peaks = np.sort(peak_energies)
+        idx = np.clip(np.searchsorted(peaks, table["BE"]), 1, len(peaks) - 1)
+        if len(peaks) == 1:
+            idx[:] = 0
+        distance = np.minimum(np.abs(peaks[idx] - table["BE"]),
+                              np.abs(peaks[idx - 1] - table["BE"]))
+        matched = expected & (distance <= tolerance)
+
+        total = np.bincount(codes, weights, n_elements)
+        found = np.bincount(codes, weights * matched, n_elements)
+        strongest = np.zeros(n_elements)
+        np.maximum.at(strongest, codes, core_weights)
+        strongest_found = np.bincount(
+            codes, (core_weights == strongest[codes]) & (core_weights > 0)
+            & matched, n_elements) > 0
+
+        score = np.where(total > 0, found / np.maximum(total, 1e-9), 0)
+        score *= strongest_found
+        # equal scores: more found intensity (RSF) ranks first
+        order = np.lexsort((-found, -score))
+        return [(str(elements[i]), float(score[i])) for i in order
+                if score[i] >= min_score]
 
     def get_element(self, element, source):
         """Gets binding energies, rsf and orbital name for specific
         element."""
-        with sqlite3.connect(self.filename) as rsfbase:
-            cursor = rsfbase.cursor()
-            sql = """SELECT Fullname, IsAuger, BE, RSF FROM Peak
-                     WHERE Element=? AND (Source=? OR Source=?)"""
-            values = (element.title(), source, "Any")
-            cursor.execute(sql, values)
-            rsf_data = cursor.fetchall()
-            rsf_dicts = []
-            for dataset in rsf_data:
-                if dataset[1] == 1.0:
-                    energy = self.k_alpha[source] - dataset[2]
-                else:
-                    energy = dataset[2]
-                rsf_dicts.append({"Fullname": dataset[0],
-                                  "BE": energy,
-                                  "RSF": dataset[3]})
-            return rsf_dicts
+        table = self.get_element_table(element, source)
+        rsf_dicts = []
+        for fullname, energy, rsf in zip(
+                table["fullname"], table["BE"], table["RSF"]):
+            rsf_dicts.append({"Fullname": str(fullname),
+                              "BE": float(energy),
+                              "RSF": float(rsf)})
+        return rsf_dicts
@@ -9,13 +9,18 @@ gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk, Gio, GLib, GdkPixbuf
 import numpy as np
 
-from npl import __appname__, __version__, __authors__, __config__
-from npl.fileio import FileParser, DBHandler
-from npl.containers import SpectrumContainer
+from npl import __appname__, __version__, __authors__, __config__, CONFDIR
+from npl.fileio import FileParser, DBHandler, ChangeJournal, DataExporter
+from npl.containers import SpectrumContainer, combine_spectra
+from npl.processing import fit_models
+from npl.quantification import Quantifier
+from npl.history import UndoHistory
+from npl.gui_executor import Executor
+from npl.gui_scheduler import UpdateScheduler
 from npl.gui_treeview import (
     ContainerView, TreeViewFilterBar, ContainerContextMenu, SpectrumSettings)
 from npl.gui_regions import RegionManager
-from npl.gui_plotter import CanvasBox
+from npl.gui_plotter import CanvasBox, MapWindow
 from npl.gui_dialogs import (
     EditSpectrumDialog, AskForSaveDialog, SimpleFileFilter)
 
@@ -33,7 +38,25 @@ class Npl(Gtk.Application):
 
         self.s_container = SpectrumContainer()
         self.parser = FileParser()
-        self.dbhandler = DBHandler()
+        self.journal = ChangeJournal(
+            __config__.get("io", "journal_file",
+                           fallback=os.path.join(CONFDIR, "npl.journal")),
+            recovery_fname=__config__.get(
+                "io", "autosave_file",
+                fallback=os.path.join(CONFDIR, "autosave.npl")),
+            error_callback=self.on_journal_error)
+        self.journal.attach(self.s_container)
+        self.history = UndoHistory(
+            max_bytes=__config__.getint(
+                "history", "max_megabytes", fallback=64) * 1024 * 1024,
+            max_steps=__config__.getint("history", "max_steps", fallback=200))
+        self.history.attach(self.s_container)
+        self.executor = Executor(
+            threads=__config__.getint("executor", "threads", fallback=2),
+            processes=__config__.getint("executor", "processes", fallback=2),
+            error_callback=self.on_task_error)
+        self.scheduler = UpdateScheduler(self.s_container, self.executor)
+        self._load_token = None
 
         self.project_fname = None
         self.win = None
@@ -47,14 +70,12 @@ class Npl(Gtk.Application):
     def do_activate(self):
         """Creates MainWindow."""
         self.win = MainWindow(app=self)
-        if __config__.get("io", "project_file") != "None":
-            try:
-                self.open_silently(__config__.get("io", "project_file"))
-            except FileNotFoundError:
-                print(
-                    "file '{}' not found".format(
-                        __config__.get("io", "project_file")))
-                __config__.set("io", "project_file", "None")
+        if self.journal.needs_recovery():
+            self.recover()
+        elif __config__.get("io", "project_file") != "None":
+            self.open_silently(__config__.get("io", "project_file"))
+        interval = __config__.getint("io", "autosave_interval", fallback=60)
+        GLib.timeout_add_seconds(interval, self.autosave)
         self.win.show_all()
 
     def do_startup(self):
@@ -66,9 +87,12 @@ class Npl(Gtk.Application):
             ("save", self.do_save),
             ("save_as", self.do_save_as),
             ("open", self.do_open_project),
+            ("export", self.do_export),
             ("add_spectrum", self.do_add_spectrum),
             ("remove_spectrum", self.do_remove_spectrum),
             ("edit_spectrum", self.do_edit_spectrum),
+            ("undo", self.do_undo),
+            ("redo", self.do_redo),
             ("quit", self.do_quit))
         for name, callback in actions:
             simple = Gio.SimpleAction.new(name, None)
@@ -87,6 +111,68 @@ class Npl(Gtk.Application):
         self.activate()
         return 0
 
+    def recover(self):
+        """Restores the state of a crashed session from the change
+        journal. The recovered changes are not written to the project
+        file, only to the recovery file, until the user saves."""
+        self.scheduler.cancel()
+        base, project, records = self.journal.read()
+
+        def replay():
+            """Replays the records on top of the base file."""
+            self.project_fname = project
+            __config__.set("io", "project_file", str(project))
+            try:
+                with self.journal.suspended():
+                    self.journal.replay(self.s_container, records)
+            except (IndexError, KeyError, ValueError, TypeError) as error:
+                self.win.message(
+                    "Recovery stopped, journal does not fit the project: "
+                    "{}".format(error))
+            else:
+                self.win.message("Recovered {} changes".format(len(records)))
+            self.s_container.altered = True
+            self.history.clear()
+            self.journal.compact(
+                self.s_container, self.journal.recovery_fname, project)
+
+        if base is not None and os.path.isfile(base):
+            self.open_silently(base, callback=replay)
+        else:
+            replay()
+
+    def on_journal_error(self, error):
+        """Called in the journal writer thread if writing the journal or
+        saving a project failed."""
+        GLib.idle_add(self.report_save_error, error)
+
+    def report_save_error(self, error):
+        """Tells the user that the project was not saved, it counts as
+        unsaved again."""
+        self.s_container.altered = True
+        MainWindow.message("Saving failed: {}".format(error))
+        if self.win is not None:
+            dialog = Gtk.MessageDialog(
+                self.win, 0, Gtk.MessageType.ERROR, Gtk.ButtonsType.OK,
+                "Saving failed")
+            dialog.format_secondary_text(str(error))
+            dialog.run()
+            dialog.destroy()
+        return False
+
+    def on_task_error(self, error):
+        """Reports a failed background task."""
+        MainWindow.message("Background task failed: {}".format(error))
+
+    def autosave(self):
+        """Compacts the change journal into the recovery file in the
+        background, is called periodically via
+        GLib.timeout_add_seconds."""
+        if self._load_token is not None:
+            return True
+        self.journal.autosave(self.s_container)
+        return True
+
     def ask_for_save(self):
         """Opens a AskForSaveDialog and runs the appropriate methods,
         then returns True if user really wants to close current file."""
@@ -110,18 +196,26 @@ class Npl(Gtk.Application):
         """Start new project."""
         really_do_it = self.ask_for_save()
         if really_do_it:
-            self.s_container.clear()
+            self.scheduler.cancel()
+            self.cancel_loading()
+            with self.journal.suspended():
+                self.s_container.clear()
             self.s_container.altered = False
             self.project_fname = None
             __config__.set("io", "project_file", "None")
+            self.journal.reset(None, None)
+            self.history.clear()
 
     def do_save(self, *_ignore):
         """Saves project, calls do_save_as if it does not already have a
-        file. Returns True if successful."""
+        file. Returns True if successful. The file is written in the
+        background by the change journal."""
+        self.scheduler.flush()
         if self.project_fname is None:
             self.do_save_as()
         else:
-            self.dbhandler.save(self.s_container, self.project_fname)
+            self.journal.compact(
+                self.s_container, self.project_fname, self.project_fname)
             __config__.set("io", "project_file", self.project_fname)
             self.s_container.altered = False
             return True
@@ -164,15 +258,69 @@ class Npl(Gtk.Application):
             self.open_silently(fname)
         dialog.destroy()
 
-    def open_silently(self, fname):
-        """Opens a project file."""
-        self.s_container.clear()
-        self.project_fname = fname
-        container = self.dbhandler.load(self.project_fname)
-        for spectrum in container:
-            self.s_container.append(spectrum)
-        self.s_container.altered = False
-        __config__.set("io", "project_file", self.project_fname)
+    def open_silently(self, fname, callback=None):
+        """Opens a project file. The file is read in the background, the
+        current project is replaced when it is loaded. If callback is
+        given, it is called instead of resetting the change journal, so
+        the journal survives until callback compacts it."""
+        self.cancel_loading()
+
+        def loaded(container):
+            """Replaces the current project."""
+            self._load_token = None
+            self.scheduler.cancel()
+            with self.journal.suspended():
+                self.s_container.clear()
+                self.project_fname = fname
+                self.s_container.extend(container)
+            self.s_container.altered = False
+            __config__.set("io", "project_file", self.project_fname)
+            self.history.clear()
+            if callback is not None:
+                callback()
+            else:
+                self.journal.reset(fname, fname)
+
+        def failed(exc):
+            """Reports the error."""
+            self._load_token = None
+            if isinstance(exc, FileNotFoundError):
+                self.win.message("file '{}' not found".format(fname))
+                __config__.set("io", "project_file", "None")
+            else:
+                self.win.message("could not open '{}': {}".format(fname, exc))
+
+        self._load_token = self.executor.submit(
+            DBHandler().load, fname, callback=loaded, error_callback=failed,
+            priority=Executor.BATCH)
+
+    def cancel_loading(self):
+        """Stops loading a project."""
+        if self._load_token is not None:
+            self._load_token.cancel()
+            self._load_token = None
+
+    def do_export(self, *_ignore):
+        """Exports spectra, backgrounds and fits to a file pointed out by
+        the user."""
+        dialog = Gtk.FileChooserDialog(
+            "Export data...",
+            self.win,
+            Gtk.FileChooserAction.SAVE,
+            ("_Cancel", Gtk.ResponseType.CANCEL, "_Save", Gtk.ResponseType.OK))
+        dialog.set_do_overwrite_confirmation(True)
+        dialog.add_filter(SimpleFileFilter(".npz", ["*.npz"]))
+        dialog.add_filter(SimpleFileFilter(".csv", ["*.csv"]))
+        dialog.set_current_name("untitled.npz")
+
+        response = dialog.run()
+        if response == Gtk.ResponseType.OK:
+            fname = dialog.get_filename()
+            if fname.split(".")[-1] not in ("npz", "csv"):
+                fname += ".npz"
+            self.scheduler.flush()
+            DataExporter(self.s_container).export(fname)
+        dialog.destroy()
 
     def do_add_spectrum(self, *_ignore):
         """Imports a spectrum file and adds it to the current container."""
@@ -187,18 +335,22 @@ class Npl(Gtk.Application):
         dialog.add_filter(SimpleFileFilter(".xym", ["*.xym"]))
         dialog.add_filter(SimpleFileFilter(".txt", ["*.txt"]))
 
-        spectra = []
+        def parsed(spectra):
+            """Adds the spectra of one file."""
+            self.s_container.extend(spectra)
+            self.s_container.altered = True
+
         response = dialog.run()
         if response == Gtk.ResponseType.OK:
             for fname in dialog.get_filenames():
                 if fname.split(".")[-1] in ["xym", "txt"]:
-                    spectra.extend(self.parser.parse_spectrum_file(fname))
+                    self.executor.submit(
+                        self.parser.parse_spectrum_file, fname,
+                        callback=parsed, priority=Executor.BATCH)
                 elif fname.split(".")[-1] in ["xy"]:
                     print("not yet implemented")
                 else:
                     print("file {} not recognized".format(fname))
-            self.s_container.extend(spectra)
-            self.s_container.altered = True
         else:
             print("nothing selected")
         dialog.destroy()
@@ -218,9 +370,26 @@ class Npl(Gtk.Application):
         dialog = EditSpectrumDialog(self.win, spectra)
         response = dialog.run()
         if response == Gtk.ResponseType.OK:
-            dialog.change_values()
+            with self.s_container.batch():
+                dialog.change_values()
         dialog.destroy()
 
+    def do_undo(self, *_ignore):
+        """Reverts the last change."""
+        self.scheduler.flush()
+        if self.history.undo():
+            self.s_container.altered = True
+        else:
+            self.win.message("Nothing to undo")
+
+    def do_redo(self, *_ignore):
+        """Repeats the last undone change."""
+        self.scheduler.flush()
+        if self.history.redo():
+            self.s_container.altered = True
+        else:
+            self.win.message("Nothing to redo")
+
     def do_quit(self, *_ignore):
         """Quit program, write to config file."""
         xsize, ysize = self.win.get_size()
@@ -232,6 +401,8 @@ class Npl(Gtk.Application):
         cfg_name = __config__.get("general", "conf_filename")
         with open(cfg_name, "w") as cfg_file:
             __config__.write(cfg_file)
+        self.journal.close()
+        self.executor.shutdown()
         self.quit()
 
 
@@ -256,6 +427,8 @@ class MainWindow(Gtk.ApplicationWindow):
         actions = (
             ("about", self.do_about),
             ("show_selected", self.do_show_selected),
+            ("waterfall", self.do_waterfall),
+            ("intensity_map", self.do_intensity_map),
             ("debug", self.do_debug))
         for (name, callback) in actions:
             simple = Gio.SimpleAction.new(name, None)
@@ -266,6 +439,11 @@ class MainWindow(Gtk.ApplicationWindow):
             ("Show selected", self.do_show_selected),
             ("Edit spectrum", self.app.do_edit_spectrum),
             ("Delete regions", self.do_delete_regions),
+            ("Identify elements", self.do_identify_elements),
+            ("Quantify", self.do_quantify),
+            ("Sum spectra", self.do_sum_spectra),
+            ("Average spectra", self.do_average_spectra),
+            ("Subtract first selected", self.do_subtract_spectra),
             ("debug", self.do_debug)]
 
         self.toolbar = ToolBar(self.app, self)
@@ -279,6 +457,8 @@ class MainWindow(Gtk.ApplicationWindow):
             self.cview, "Notes", hide_combo=True)
         self.spectrum_settings = SpectrumSettings(self)
         self.rview = RegionManager(self)
+        # source -> Quantifier, they keep their line assignments
+        self.quantifiers = {}
 
         self.build_window()
 
@@ -338,12 +518,135 @@ class MainWindow(Gtk.ApplicationWindow):
     def do_debug(self, *_ignore):
         """Allows for testing stuff from GUI."""
         region = self.get_selected_region()
-        region.fit()
+        self.fit_region(region)
+
+    def fit_region(self, region):
+        """Fits region in the background, the result is discarded if the
+        region, its data or its peaks changed in the meantime."""
+        args = region.model.get_fit_args()
+        if args is None:
+            return
+        specs, params, energy, intensity = args
+
+        def get_state():
+            """Returns what the fit depends on: values, and arrays that
+            are compared by identity (they are replaced on change)."""
+            values = (
+                region.emin, region.emax, region.bgtype,
+                sorted(peak.prefix for peak in region.peaks),
+                [(name, param.value, param.min, param.max, param.vary,
+                  param.expr)
+                 for name, param in sorted(region.model.params.items())])
+            arrays = (region.spectrum.energy, region.spectrum.intensity,
+                      region.background)
+            return values, arrays
+
+        state = get_state()
+
+        def fitted(params):
+            """Sets the fit result."""
+            values, arrays = get_state()
+            if (region not in region.spectrum.regions or values != state[0]
+                    or any(old is not new
+                           for old, new in zip(state[1], arrays))):
+                self.message("Region changed during the fit, result dropped")
+                return
+            with self.app.s_container.batch():
+                region.set_fit_result(params)
+
+        def failed(exc):
+            """Reports the error."""
+            self.message("Fit failed: {}".format(exc))
+
+        self.app.executor.submit(
+            fit_models, specs, params.copy(), energy, intensity,
+            callback=fitted, error_callback=failed, process=True)
 
     def do_show_rsf(self, *_ignore):
         """Calls the canvasbox method to show rsf values in plot."""
         self.canvasbox.show_rsf()
 
+    def do_identify_elements(self, *_ignore):
+        """Detects elements in the selected survey spectrum and shows
+        their rsf values."""
+        spectra = self.get_selected_spectra()
+        if len(spectra) != 1:
+            self.message("Select exactly one spectrum")
+            return
+        candidates = self.canvasbox.identify_elements(spectra[0])
+        self.message(", ".join(
+            "{} ({:.2f})".format(element, score)
+            for (element, score) in candidates))
+
+    def do_quantify(self, *_ignore):
+        """Computes atomic concentrations from the fitted peaks of all
+        selected spectra, treating them as one sample."""
+        spectra = self.get_selected_spectra()
+        if not spectra:
+            return
+        quantifier = self.get_quantifier(self.canvasbox.rsf["source"] or "Al")
+        _groups, elements, atomic_percent = quantifier.quantify(
+            spectra, groups=[""] * len(spectra))
+        self.message(", ".join(
+            "{}: {:.1f} at.%".format(element, concentration)
+            for (element, concentration) in zip(elements, atomic_percent[0])))
+
+    def get_quantifier(self, source):
+        """Returns the Quantifier for an X-ray source, it is reused so its
+        line lookups are cached across quantifications."""
+        if source not in self.quantifiers:
+            self.quantifiers[source] = Quantifier(
+                self.canvasbox.figure.rsfhandler, source=source)
+        return self.quantifiers[source]
+
+    def do_sum_spectra(self, *_ignore):
+        """Adds the sum of the selected spectra to the container."""
+        self.combine_selected("sum")
+
+    def do_average_spectra(self, *_ignore):
+        """Adds the average of the selected spectra to the container."""
+        self.combine_selected("average")
+
+    def do_subtract_spectra(self, *_ignore):
+        """Subtracts the first selected spectrum from the other selected
+        ones and adds the differences to the container."""
+        self.combine_selected("subtract")
+
+    def combine_selected(self, operation):
+        """Combines the selected spectra, see combine_spectra."""
+        spectra = self.get_selected_spectra()
+        if len(spectra) < 2:
+            self.message("Select at least two spectra")
+            return
+        try:
+            new_spectra = combine_spectra(
+                spectra, operation, reference=spectra[0])
+        except ValueError as error:
+            self.message(str(error))
+            return
+        self.app.s_container.extend(new_spectra)
+        self.app.s_container.altered = True
+        self.set_selected_spectra(new_spectra)
+
+    def do_waterfall(self, *_ignore):
+        """Toggles the waterfall view of the shown spectra."""
+        self.canvasbox.toggle_waterfall()
+
+    def do_intensity_map(self, *_ignore):
+        """Opens an intensity map of the selected spectra, of all spectra
+        if less than two are selected."""
+        spectra = self.get_selected_spectra()
+        if len(spectra) < 2:
+            spectra = list(self.app.s_container)
+        if not spectra:
+            self.message("No spectra to show")
+            return
+        MapWindow(self.app, self, spectra)
+
+    def do_lookup_lines(self, *_ignore):
+        """Toggles showing library lines near the mouse cursor."""
+        self.canvasbox.toggle_line_lookup()
+
     def do_get_span(self, callback):
         """Gets a span from the user."""
         self.canvasbox.get_span(callback)
@@ -363,8 +666,9 @@ class MainWindow(Gtk.ApplicationWindow):
     def do_delete_regions(self, *_ignore):
         """Deletes regions of selected spectra."""
         spectra = self.get_selected_spectra()
-        for spectrum in spectra:
-            spectrum.clear_regions()
+        with self.app.s_container.batch():
+            for spectrum in spectra:
+                spectrum.clear_regions()
         self.set_selected_spectra(spectra)
 
     def do_create_peak(self, *_ignore):
@@ -411,7 +715,25 @@ class MainWindow(Gtk.ApplicationWindow):
             self.canvasbox.refresh(keepaxes)
 
     def container_callback(self, keyword, _obj, **kwargs):
-        """Catches everything important from the SpectrumContainer."""
+        """Catches everything important from the SpectrumContainer. A
+        "batch" of signals leads to at most one refresh."""
+        if keyword == "batch":
+            events = kwargs["events"]
+        else:
+            events = [(keyword, _obj, kwargs)]
+        needs_refresh = False
+        keepaxes = True
+        for keyword_, obj_, kwargs_ in events:
+            self.canvasbox.figure.invalidate(obj_)
+            refresh, keep = self.get_refresh_need(keyword_, kwargs_)
+            needs_refresh = needs_refresh or refresh
+            keepaxes = keepaxes and keep
+        if needs_refresh:
+            self.refresh(keepaxes=keepaxes)
+
+    def get_refresh_need(self, keyword, kwargs):
+        """Returns (needs_refresh, keepaxes) for a container signal and
+        marks the container as altered if necessary."""
         if keyword in ("changed_spectrum", "changed_region"):
             dontkeep_list = ("bgtype", "norm")
             keep_list = ("emin", "emax", "smoothness", "calibration")
@@ -419,20 +741,21 @@ class MainWindow(Gtk.ApplicationWindow):
                 "name", "notes", "eis_region", "fname", "sweeps", "dwelltime",
                 "passenergy")
             if any([attr in kwargs for attr in dontkeep_list]):
-                self.refresh(keepaxes=False)
                 self.app.s_container.altered = True
-            elif any([attr in kwargs for attr in keep_list]):
-                self.refresh(keepaxes=True)
+                return True, False
+            if any([attr in kwargs for attr in keep_list]):
                 self.app.s_container.altered = True
-            elif any([attr in kwargs for attr in altered_list]):
+                return True, True
+            if any([attr in kwargs for attr in altered_list]):
                 self.app.s_container.altered = True
 
         elif keyword in ("clear_container", "plot"):
-            self.refresh(keepaxes=False)
+            return True, False
 
         elif keyword in ("remove_spectrum", "add_region", "remove_region",
                          "add_peak", "remove_peak", "fit", "changed_peak"):
-            self.refresh(keepaxes=True)
+            return True, True
+        return False, True
 
 
 class ToolBar(Gtk.Toolbar):
@@ -455,7 +778,8 @@ class ToolBar(Gtk.Toolbar):
             (None, None),
             (os.path.join(
                 __config__.get("general", "basedir"), "icons/atom_lib.png"),
-             self.parent.do_show_rsf))
+             self.parent.do_show_rsf),
+            ("edit-find", self.parent.do_lookup_lines))
         for icon_name, callback in self.toolitems:
             if icon_name is None:
                 self.insert(Gtk.SeparatorToolItem(), -1)
@@ -84,10 +84,12 @@ class EditSpectrumDialog(Gtk.Dialog):
     def change_values(self):
         """Actually changes the values of the spectra."""
         for spectrum in self.spectra:
+            new_values = {}
             for i, (attr, _) in enumerate(self.titles):
                 new_value = self.entries[i].get_text()
                 if self.excluding_key not in new_value:
-                    setattr(spectrum, attr, new_value)
+                    new_values[attr] = new_value
+            spectrum.set(**new_values)
 
 
 class AskForSaveDialog(Gtk.Dialog):
@@ -0,0 +1,115 @@
+"""Runs processing, fitting and file I/O off the GTK main loop and hands
+the results back to it."""
+
+import queue
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from gi.repository import GLib
+
+
+class CancelToken():
+    """Marks submitted tasks as no longer wanted: they are not started
+    and their results are not delivered."""
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        """Cancels all tasks submitted with this token."""
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        """True if cancel() was called."""
+        return self._event.is_set()
+
+
+class Executor():
+    """Runs tasks on a few worker threads, tasks with a lower priority
+    value run first (INTERACTIVE before BATCH), equal priorities in
+    submission order. Tasks submitted with process=True are handed to a
+    process pool by the worker, so their function and arguments must be
+    picklable. Results and exceptions are delivered to the callbacks in
+    the main loop via GLib.idle_add, exceptions of tasks without
+    error_callback go to the error_callback of the Executor."""
+    INTERACTIVE = 0
+    BATCH = 10
+
+    def __init__(self, threads=2, processes=2, error_callback=None):
+        self.processes = processes
+        self.error_callback = error_callback
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._queue = queue.PriorityQueue()
+        self._counter = itertools.count()
+        self._threads = []
+        for _ in range(max(threads, 1)):
+            thread = threading.Thread(target=self._work_loop, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, func, *args, callback=None, error_callback=None,
+               priority=INTERACTIVE, token=None, process=False):
+        """Runs func(*args) in the background, then callback(result) or
+        error_callback(exception) in the main loop. Returns the
+        CancelToken of the task."""
+        if token is None:
+            token = CancelToken()
+        task = (func, args, callback, error_callback, token, process)
+        self._queue.put((priority, next(self._counter), task))
+        return token
+
+    def shutdown(self):
+        """Stops the workers after their current task, queued tasks are
+        dropped."""
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        for _thread in self._threads:
+            self._queue.put((self.INTERACTIVE, next(self._counter), None))
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def get_pool(self):
+        """Returns the process pool, it is started when needed first."""
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context("forkserver"))
+            return self._pool
+
+    def _work_loop(self):
+        """Runs in the worker threads."""
+        while True:
+            _priority, _count, task = self._queue.get()
+            if task is None:
+                return
+            func, args, callback, error_callback, token, process = task
+            if token.cancelled:
+                continue
+            try:
+                if process and self.processes:
+                    result = self.get_pool().submit(func, *args).result()
+                else:
+                    result = func(*args)
+            except Exception as exc:    # pylint: disable=broad-except
+                GLib.idle_add(self._deliver, error_callback, exc, token, True)
+            else:
+                GLib.idle_add(self._deliver, callback, result, token, False)
+
+    def _deliver(self, callback, result, token, is_error):
+        """Calls the callback in the main loop."""
+        if token.cancelled:
+            return False
+        if callback is not None:
+            callback(result)
+        elif is_error and self.error_callback is not None:
+            self.error_callback(result)
+        elif is_error:
+            print("background task failed: {}".format(result))
+        return False
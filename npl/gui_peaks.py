@@ -41,7 +41,7 @@ class PeakManager(Gtk.Box):
         """Builds the header row containing "Peaks" title and buttons."""
         def call_fit(*_ignore):
             """Button callback for region fit."""
-            self.region.fit()
+            self.parent.fit_region(self.region)
         fitbutton = Gtk.Button(label="Fit")
         fitbutton.connect("clicked", call_fit)
         add_img = Gtk.Image.new_from_icon_name("list-add", Gtk.IconSize.BUTTON)
@@ -67,12 +67,15 @@ class PeakManager(Gtk.Box):
 
 
 class PeakView(Gtk.TreeView):
-    """Treeview that displays Peak details."""
+    """Treeview that displays Peak details. The rows are kept in a
+    persistent ListStore (in the order of region.peaks) and updated in
+    place from the container signals."""
     def __init__(self, manager, peaks, attrs):
         super().__init__()
         self.manager = manager
         self.peaks = peaks
         self.attrs = attrs
+        self.iters = {}
         self.model = self.make_model()
         self.sortable_model = Gtk.TreeModelSort(self.model)
 
@@ -84,28 +87,69 @@ class PeakView(Gtk.TreeView):
 
         self.make_columns()
 
+        self.container = self.manager.parent.app.s_container
+        self.container.subscribe(self.container_callback)
+
+    def detach(self):
+        """Stops listening to the container."""
+        self.container.unsubscribe(self.container_callback)
+
+    def container_callback(self, keyword, obj, **kwargs):
+        """Updates the rows of the peaks of this region."""
+        if keyword == "batch":
+            for keyword_, obj_, kwargs_ in kwargs["events"]:
+                self.container_callback(keyword_, obj_, **kwargs_)
+        elif obj is self.manager.region:
+            if keyword in ("add_peak", "remove_peak"):
+                self.sync()
+            elif keyword == "fit":
+                self.refresh()
+        elif keyword == "changed_peak" and obj.sid in self.iters:
+            self.update_peak(obj)
+
     def refresh(self):
         """Refreshes the view."""
-        self.model = self.make_model()
-        self.sortable_model = Gtk.TreeModelSort(self.model)
-        self.set_model(self.sortable_model)
-        # self.make_columns()
+        self.sync()
+        for peak in self.peaks:
+            self.update_peak(peak)
+
+    def sync(self):
+        """Removes rows of removed peaks and inserts rows for new ones."""
+        sids = set(peak.sid for peak in self.peaks)
+        for sid in list(self.iters):
+            if sid not in sids:
+                self.model.remove(self.iters.pop(sid))
+        for index, peak in enumerate(self.peaks):
+            if peak.sid not in self.iters:
+                self.iters[peak.sid] = self.model.insert(
+                    index, self.get_row(peak))
+
+    def update_peak(self, peak):
+        """Sets the cells of a peak that changed."""
+        iter_ = self.iters[peak.sid]
+        for column, value in enumerate(self.get_row(peak)):
+            if self.model.get_value(iter_, column) != value:
+                self.model.set_value(iter_, column, value)
+
+    def get_row(self, peak):
+        """Returns the cell strings for a peak."""
+        row = []
+        for attr in self.attrs:
+            value = getattr(peak, attr)
+            if isinstance(value, float):
+                row.append("{:.2f}".format(value))
+            elif isinstance(value, int):
+                row.append(str(value))
+            else:
+                row.append(value)
+        return row
 
     def make_model(self):
         """Makes a ListStore and fills it with data, returns the model."""
         types = [str] * len(self.attrs)
         model = Gtk.ListStore(*types)
         for peak in self.peaks:
-            row = []
-            for attr in self.attrs:
-                value = getattr(peak, attr)
-                if isinstance(value, float):
-                    row.append("{:.2f}".format(value))
-                elif isinstance(value, int):
-                    row.append(str(value))
-                else:
-                    row.append(value)
-            model.append(row)
+            self.iters[peak.sid] = model.append(self.get_row(peak))
         return model
 
     def make_columns(self):
@@ -117,13 +161,17 @@ class PeakView(Gtk.TreeView):
             column.set_reorderable(True)
             self.append_column(column)
 
+    def get_peak(self, path):
+        """Returns the peak at a path of the sorted model."""
+        path = self.sortable_model.convert_path_to_child_path(path)
+        return self.peaks[path.get_indices()[0]]
+
     def get_selected_peaks(self):
         """Returns list of currently selected Peak objects."""
         _model, pathlist = self.get_selection().get_selected_rows()
         peaks = []
         for path in pathlist:
-            index = path.get_indices()[0]
-            peaks.append(self.peaks[index])
+            peaks.append(self.get_peak(path))
         return peaks
 
     def on_row_clicked(self, treeview, event):
@@ -134,7 +182,7 @@ class PeakView(Gtk.TreeView):
         if pathinfo is None:
             return True
         path, _col, _cellx, _celly = pathinfo
-        peak = self.peaks[path.get_indices()[0]]
+        peak = self.get_peak(path)
         if event.type == Gdk.EventType.BUTTON_PRESS and event.button == 1:
             self.manager.psettings.set_peak(peak)
             return path in self.get_selection().get_selected_rows()[1]
@@ -2,8 +2,6 @@
 provides means for altering its appearance."""
 # pylint: disable=wrong-import-position
 
-import os
-
 import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk
@@ -11,11 +9,10 @@ from matplotlib.backends.backend_gtk3 import (
     NavigationToolbar2GTK3 as NavigationToolbar)
 from matplotlib.backends.backend_gtk3agg import (
     FigureCanvasGTK3Agg as FigureCanvas)
-from matplotlib.figure import Figure
 import numpy as np
 
-from npl import __config__
-from npl.fileio import RSFHandler
+from npl import __config__, plotter
+from npl.processing import calculate_background
 from npl.plotter_elements import SpanSelector, DraggableVLine, PeakSelector
 from npl.gui_dialogs import SelectElementsDialog
 
@@ -37,9 +34,9 @@ class CanvasBox(Gtk.Box):
         self.refresh()
 
     def refresh(self, keepaxes=False):
-        """Draws on canvas."""
+        """Draws on canvas, only artists of changed objects are
+        updated."""
         self.figure.store_axlims()
-        self.figure.ax.cla()
         self.figure.plot(self.app.s_container)
         if keepaxes:
             self.figure.adjust_axlims()
@@ -63,6 +60,36 @@ class CanvasBox(Gtk.Box):
             self.refresh(keepaxes=True)
         dialog.destroy()
 
+    def identify_elements(self, spectrum, max_elements=8):
+        """Detects the elements in a survey spectrum and preselects them
+        for the rsf plot."""
+        source = self.rsf["source"] or "Al"
+        candidates = self.figure.rsfhandler.identify_elements(
+            spectrum.energy, spectrum.intensity, source)
+        self.rsf["elements"] = [
+            element for (element, _score) in candidates[:max_elements]]
+        self.rsf["source"] = source
+        self.refresh(keepaxes=True)
+        return candidates
+
+    def toggle_line_lookup(self, *_ignore):
+        """Switches showing library lines near the mouse cursor on/off."""
+        if self.figure.lookup_cid is None:
+            source = self.rsf["source"] or "Al"
+            self.figure.start_line_lookup(source)
+        else:
+            self.figure.stop_line_lookup()
+
+    def toggle_waterfall(self, *_ignore):
+        """Switches between stacking the shown spectra and overlaying
+        them."""
+        if self.figure.waterfall is None:
+            self.figure.set_waterfall(__config__.getfloat(
+                "view", "waterfall_offset", fallback=0.3))
+        else:
+            self.figure.set_waterfall(None)
+        self.refresh()
+
     def get_span(self, callback, **kwargs):
         """Just gets a span from the user."""
         self.figure.get_span(callback, **kwargs)
@@ -72,72 +99,13 @@ class CanvasBox(Gtk.Box):
         self.figure.draw_peak(callback)
 
 
-class BeautifulFigure(Figure):
-    """A customized canvas."""
-    def __init__(self):
-        # pylint: disable=invalid-name
-        super().__init__(figsize=(10, 10), dpi=80)
-        self.canvas = FigureCanvas(self)
-        self.ax = self.add_axes([-0.005, 0.0, 1.01, 1.005])
-
-        self.now_xy = [0, 0, 1, 1]
-        self.s_xy = [np.inf, -np.inf, np.inf, -np.inf]
-
-    def lock(self, obj):
-        """Lock the canvas."""
-        self.canvas.widgetlock(obj)
-
-    def unlock(self, obj):
-        """Unlock the canvas."""
-        self.canvas.widgetlock.release(obj)
-
-    def set_ticks(self):
-        """Configures axes ticks."""
-        self.ax.tick_params(
-            reset=True,
-            axis="both",
-            direction="in",
-            pad=-20,
-            labelsize="large",
-            labelcolor="blue",
-            color="blue",
-            labelleft=False,
-            top=False,
-            left=False,
-            right=False)
-        if self.s_xy[0] == np.inf:
-            self.ax.tick_params(
-                which="both",
-                bottom=False,
-                top=False,
-                left=False,
-                right=False,
-                labelbottom=False)
-
-    def store_axlims(self):
-        """Stores axis limits in self.now_xy."""
-        self.now_xy[1], self.now_xy[0] = self.ax.get_xlim()
-        self.now_xy[2], self.now_xy[3] = self.ax.get_ylim()
-
-    def adjust_axlims(self):
-        """Sets the axis limits."""
-        if np.all(np.isfinite(self.now_xy)):
-            self.ax.set_xlim(*self.now_xy[1::-1])
-            self.ax.set_ylim(*self.now_xy[2:])
-
-    def recenter_view(self):
-        """Focuses view on current plot."""
-        if self.now_xy != self.s_xy:
-            self.now_xy = self.s_xy
-        self.adjust_axlims()
-
-
-class SpectrumFigure(BeautifulFigure):
-    """Axes object containing the methods for plotting Spectra."""
+class SpectrumFigure(plotter.SpectrumFigure):
+    """SpectrumFigure on the GTK canvas, with selectors for regions and
+    peaks, draggable region bounds and line lookup."""
+    canvas_class = FigureCanvas
+
     def __init__(self):
         super().__init__()
-        rsf_file = os.path.join(__config__.get("general", "basedir"), "rsf.db")
-        self.rsfhandler = RSFHandler(rsf_file)
         self.span_selector = SpanSelector(
             self.ax, lambda *args: None, "horizontal", span_stays=True,
             useblit=True)
@@ -145,110 +113,42 @@ class SpectrumFigure(BeautifulFigure):
         self.peak_selector = PeakSelector(
             self.ax, lambda *args: None, peak_stays=False, useblit=True)
         self.peak_selector.active = False
-        self.dlines = []
-
-    def plot_spectrum(self, spectrum):
-        """Spectrum plotting."""
-        lineprops = {
-            "color": "black",
-            "linewidth": 1,
-            "linestyle": "-",
-            "alpha": 1}
-        self.ax.plot(
-            spectrum.energy, spectrum.intensity,
-            label=spectrum.name, **lineprops)
-        self.s_xy = [
-            min(self.s_xy[0], min(spectrum.energy)),
-            max(self.s_xy[1], max(spectrum.energy)),
-            min(self.s_xy[2], min(spectrum.intensity)),
-            max(self.s_xy[3], max(spectrum.intensity * 1.05))]
-
-    def plot_region(self, region):
-        """Region plotting."""
-        lineprops = {
-            "color": "blue",
-            "linewidth": 2,
-            "linestyle": "-",
-            "alpha": 0.5}
-        line = self.ax.axvline(region.emin, 0, 1, **lineprops)
-        self.dlines.append(DraggableRegionBound(line, region, "emin"))
-        line = self.ax.axvline(region.emax, 0, 1, **lineprops)
-        self.dlines.append(DraggableRegionBound(line, region, "emax"))
-        # region.calculate_background()
-        if ("b" in region.spectrum.visibility
-                and region.background is not None):
-            lineprops = {
-                "color": "red",
-                "linewidth": 1,
-                "linestyle": "--",
-                "alpha": 1}
-            self.ax.plot(
-                region.energy, region.background, **lineprops)
-
-    def plot_peaks(self, region):
-        """Peak and model plotting."""
-        lineprops = {
-            "color": "blue",
-            "linewidth": 1,
-            "linestyle": "--"}
-        if region.fit_intensity is not None:
-            self.ax.plot(
-                region.energy,
-                region.fit_intensity + region.background,
-                **lineprops)
-        lineprops = {
-            "color": "green",
-            "linewidth": 1,
-            "linestyle": "--"}
-        for peak in region.peaks:
-            if peak.fit_intensity is not None:
-                self.ax.plot(
-                    region.energy,
-                    peak.fit_intensity + region.background,
-                    **lineprops)
-
-    def plot(self, container):
-        """Plots a spectrum."""
-        self.dlines = []
-        if container:
-            self.s_xy = [np.inf, -np.inf, np.inf, -np.inf]
-        for spectrum in container:
-            if "d" in spectrum.visibility:
-                self.plot_spectrum(spectrum)
-            else:
-                continue
-            if "r" in spectrum.visibility:
-                for region in spectrum.regions:
-                    self.plot_region(region)
-            if "p" in spectrum.visibility:
-                for region in spectrum.regions:
-                    self.plot_peaks(region)
-
-    def plot_rsf(self, elements, source):
-        """Plots RSF values for a certain element with given X-ray souce."""
-        if not elements:
-            return
-        peakdata = []
-        for element in elements:
-            peaks = self.rsfhandler.get_element(element, source)
-            peakdata.append(peaks)
-
-        max_rsf = max(max(
-            [[(x["RSF"] + 1e-9) for x in dicts] for dicts in peakdata]))
-        normfactor = (self.now_xy[3] / max_rsf * 0.8)
-        colorcycle = "gcmybr"*10
-        for i, peaks in enumerate(peakdata):
-            for peak in peaks:
-                if peak["RSF"] == 0:
-                    rsf = 0.5 * self.now_xy[3]
-                else:
-                    rsf = peak["RSF"] * normfactor
-                self.ax.vlines(peak["BE"], 0, rsf, colors=colorcycle[i], lw=2)
-                self.ax.annotate(
-                    peak["Fullname"],
-                    xy=[peak["BE"], rsf + self.now_xy[3] * 0.015],
-                    color="black",
-                    textcoords="data")
+        self.lookup_cid = None
+        self.lookup_label = self.text(
+            0.01, 0.99, "", verticalalignment="top", family="monospace")
+
+    def get_bound_handlers(self, line, region, attr):
+        """Makes the region bounds draggable."""
+        return [DraggableRegionBound(line, region, attr, self)]
+
+    def start_line_lookup(self, source, delta=1.0, maxlines=8):
+        """Shows the library lines within +- delta eV of the mouse cursor,
+        ranked by RSF."""
+        def on_motion(event):
+            """Callback for motion_notify_event."""
+            text = ""
+            if event.inaxes == self.ax and event.xdata is not None:
+                lines = self.rsfhandler.get_lines_near(
+                    event.xdata, delta, source)[:maxlines]
+                text = "\n".join(
+                    "{:<10} {:7.1f} eV  RSF {:.2f}".format(
+                        fullname, energy, rsf)
+                    for fullname, energy, rsf in zip(
+                        lines["fullname"], lines["BE"], lines["RSF"]))
+            if text != self.lookup_label.get_text():
+                self.lookup_label.set_text(text)
+                self.canvas.draw_idle()
+        self.stop_line_lookup()
+        self.lookup_cid = self.canvas.mpl_connect(
+            "motion_notify_event", on_motion)
+
+    def stop_line_lookup(self):
+        """Stops showing library lines under the mouse cursor."""
+        if self.lookup_cid is not None:
+            self.canvas.mpl_disconnect(self.lookup_cid)
+            self.lookup_cid = None
+        self.lookup_label.set_text("")
+        self.canvas.draw_idle()
 
     def get_span(self, callback, **kwargs):
         """Makes a SpanSelector and uses it."""
@@ -290,6 +190,73 @@ class SpectrumFigure(BeautifulFigure):
         self.peak_selector.active = False
 
 
+class MapFigure(plotter.MapFigure):
+    """MapFigure on the GTK canvas."""
+    canvas_class = FigureCanvas
+
+
+class MapWindow(Gtk.Window):
+    """Window with an intensity map of spectra, clicking a row shows that
+    spectrum in the line plot of the main window."""
+    def __init__(self, app, parent, spectra):
+        super().__init__(title="Intensity map", transient_for=parent)
+        self.app = app
+        self.parent = parent
+        self.spectra = list(spectra)
+        self.figure = MapFigure()
+        self.figure.row_callback = self.on_row_selected
+        self.navbar = NavigationToolbar(self.figure.canvas)
+
+        box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        box.pack_start(self.figure.canvas, True, True, 0)
+        box.pack_start(self.navbar, False, False, 0)
+        self.add(box)
+        self.set_default_size(800, 600)
+
+        self.app.s_container.subscribe(self.container_callback)
+        self.connect("destroy", self.on_destroy)
+        self.refresh()
+        self.show_all()
+
+    def refresh(self, keepaxes=False):
+        """Draws the map, it is only resampled if spectra changed."""
+        self.figure.store_axlims()
+        self.figure.plot(self.spectra)
+        if keepaxes:
+            self.figure.adjust_axlims()
+        else:
+            self.figure.recenter_view()
+        self.figure.set_ticks()
+        self.figure.canvas.draw_idle()
+
+    def container_callback(self, keyword, obj, **kwargs):
+        """Drops removed spectra and redraws. The signals come before the
+        spectra are removed."""
+        if keyword == "batch":
+            events = kwargs["events"]
+        else:
+            events = [(keyword, obj, kwargs)]
+        removed = set()
+        for keyword_, _obj, kwargs_ in events:
+            if keyword_ == "remove_spectrum":
+                removed.add(kwargs_["spectrum"].sid)
+            elif keyword_ == "clear_container":
+                removed.update(spectrum.sid for spectrum in self.spectra)
+        if removed:
+            self.spectra = [spectrum for spectrum in self.spectra
+                            if spectrum.sid not in removed]
+        self.refresh(keepaxes=True)
+
+    def on_row_selected(self, spectrum):
+        """Shows the clicked spectrum in the main window."""
+        self.parent.set_selected_spectra([spectrum])
+        self.parent.do_show_selected()
+
+    def on_destroy(self, *_ignore):
+        """Stops listening to the container."""
+        self.app.s_container.unsubscribe(self.container_callback)
+
+
 class MPLNavBar(NavigationToolbar):
     """Navbar for the canvas."""
     def __init__(self, figure, parent):
@@ -331,20 +298,53 @@ class MPLNavBar(NavigationToolbar):
 
 
 class DraggableRegionBound(DraggableVLine):
-    """Takes a line marking a region boundary and makes it draggable."""
-    def __init__(self, line, region, attr):
+    """Takes a line marking a region boundary and makes it draggable, the
+    background and fit lines of the region follow while dragging, the
+    region itself is only changed on release."""
+    def __init__(self, line, region, attr, figure):
         super().__init__(line)
         self.region = region
         self.attr = attr
+        self.figure = figure
 
-    def on_release(self, event):
-        """When the mouse button is released."""
-        if self.lock is not self:
+    def get_preview_artists(self):
+        """The background and fit lines of the region."""
+        keys = [(self.region.sid, "background"), (self.region.sid, "fit")]
+        keys.extend((peak.sid, "fit") for peak in self.region.peaks)
+        return [self.figure.object_artists.get(key, None) for key in keys]
+
+    def update_preview(self, xdata):
+        """Calculates background and fit for the dragged bound."""
+        region = self.region
+        bounds = {"emin": region.emin, "emax": region.emax}
+        bounds[self.attr] = xdata
+        energy, intensity = region.spectrum.energy, region.spectrum.intensity
+        idx1, idx2 = sorted(np.searchsorted(
+            energy, (bounds["emin"], bounds["emax"])))
+        if idx2 - idx1 < 2:
             return
+        energy, intensity = energy[idx1:idx2], intensity[idx1:idx2]
+        background = calculate_background(region.bgtype, energy, intensity)
+        if background is None:
+            background = np.zeros(energy.shape)
+        artists = self.figure.object_artists
+        if (region.sid, "background") in artists:
+            artists[(region.sid, "background")].set_data(energy, background)
+        if (region.sid, "fit") in artists:
+            artists[(region.sid, "fit")].set_data(
+                energy, region.model.get_intensity(energy) + background)
+        for peak in region.peaks:
+            if (peak.sid, "fit") in artists:
+                artists[(peak.sid, "fit")].set_data(
+                    energy,
+                    region.model.get_peak_intensity(peak, energy) + background)
 
-        if self.attr == "emin":
-            self.region.set(emin=self.line.get_xdata()[0])
-        if self.attr == "emax":
-            self.region.set(emax=self.line.get_xdata()[0])
+    def on_release(self, event):
+        """When the mouse button is released, the region is set and the
+        canvas refreshed once."""
+        if DraggableVLine.lock is not self:
+            return
 
         super().on_release(event)
+        self.figure.invalidate(self.region)
+        self.region.set(**{self.attr: self.line.get_xdata()[0]})
@@ -90,8 +90,9 @@ class RegionsUI(Gtk.Stack):
         """Rebuilds with new regions."""
         for child in self.get_children():
             if child.region not in regions:
+                child.pmanager.view.detach()
                 self.remove(child)
-        old_regions = (child.region for child in self.get_children())
+        old_regions = [child.region for child in self.get_children()]
         for region in regions:
             if region not in old_regions:
                 box = SingleRegionUI(self.app, region)
@@ -101,6 +102,7 @@ class RegionsUI(Gtk.Stack):
     def delete_region(self):
         """Deletes currently selected region."""
         region = self.get_selected_region()
+        self.get_visible_child().pmanager.view.detach()
         self.remove(self.get_visible_child())
         region.spectrum.remove_region(region)
         self.show_all()
@@ -0,0 +1,122 @@
+"""Coalesces rapid parameter changes from the GUI (sliders, entries) and
+calculates them in the background."""
+
+from gi.repository import GLib
+import numpy as np
+
+from npl.containers import SpectrumMatrix
+from npl.gui_executor import CancelToken
+
+
+def compute_jobs(jobs):
+    """Calculates SpectrumMatrix jobs, runs on an Executor."""
+    for job in jobs:
+        SpectrumMatrix.compute(job)
+    return jobs
+
+
+class UpdateScheduler():
+    """Collects calibration, smoothness and norm changes per spectrum,
+    later values replace earlier ones. At most every delay milliseconds
+    the collected values are prepared in the main loop, calculated by the
+    Executor and applied again in the main loop. Values arriving while
+    the calculation runs wait for the next round, so intermediate slider
+    positions are dropped instead of queued up."""
+    def __init__(self, container, executor, delay=40):
+        self.container = container
+        self.executor = executor
+        self.delay = delay
+        # sid -> (spectrum, values)
+        self._pending = {}
+        self._inflight = {}
+        self._timeout = None
+        self._busy = False
+        self._token = CancelToken()
+
+    def schedule(self, spectra, **kwargs):
+        """Schedules SpectrumContainer.set_spectra(spectra, **kwargs),
+        values are single values or one value per spectrum."""
+        for i, spectrum in enumerate(spectra):
+            values = self._pending.setdefault(spectrum.sid, (spectrum, {}))[1]
+            for attr, value in kwargs.items():
+                values[attr] = value[i] if np.ndim(value) else value
+        if self._timeout is None and not self._busy:
+            self._timeout = GLib.timeout_add(self.delay, self.on_timeout)
+
+    def flush(self):
+        """Applies everything scheduled right away, results of a running
+        calculation are discarded."""
+        changes = self._inflight
+        changes.update(self._pending)
+        self.cancel()
+        with self.container.batch():
+            for values, spectra in self._group(changes).items():
+                self.container.set_spectra(spectra, **dict(values))
+
+    def cancel(self):
+        """Forgets everything scheduled."""
+        if self._timeout is not None:
+            GLib.source_remove(self._timeout)
+            self._timeout = None
+        self._pending = {}
+        self._inflight = {}
+        self._busy = False
+        self._token.cancel()
+        self._token = CancelToken()
+
+    def on_timeout(self):
+        """Hands the collected changes to the worker."""
+        self._timeout = None
+        if self._busy or not self._pending:
+            return False
+        jobs = []
+        for values, spectra in self._group(self._pending).items():
+            jobs.extend(self.container.prepare_spectra(
+                spectra, **dict(values)))
+        self._inflight = self._pending
+        self._pending = {}
+        if jobs:
+            self._busy = True
+            self.executor.submit(
+                compute_jobs, jobs, callback=self.on_computed,
+                error_callback=self.on_error, token=self._token)
+        return False
+
+    def _group(self, changes):
+        """Groups the spectra of changes that are still in the container
+        by equal values."""
+        groups = {}
+        for spectrum, values in changes.values():
+            if self.container.get_spectrum_by_sid(spectrum.sid) is spectrum:
+                groups.setdefault(
+                    tuple(sorted(values.items())), []).append(spectrum)
+        return groups
+
+    def on_error(self, exc):
+        """Sets the changes directly if the calculation failed."""
+        print("calculation failed: {}".format(exc))
+        self.flush()
+
+    def on_computed(self, jobs):
+        """Applies the calculated jobs. Jobs with spectra that got new
+        values in the meantime are dropped and their values scheduled
+        again, outdated jobs are set directly."""
+        self._busy = False
+        inflight, self._inflight = self._inflight, {}
+        for sid, (spectrum, values) in self._pending.items():
+            if sid in inflight:
+                merged = dict(inflight[sid][1])
+                merged.update(values)
+                self._pending[sid] = (spectrum, merged)
+        with self.container.batch():
+            for job in jobs:
+                if any(spectrum.sid in self._pending
+                       for spectrum in job["spectra"]):
+                    for spectrum in job["spectra"]:
+                        self._pending.setdefault(
+                            spectrum.sid, inflight[spectrum.sid])
+                elif not SpectrumMatrix.apply(job):
+                    self.container.set_spectra(
+                        job["spectra"], **job["kwargs"])
+        if self._pending:
+            self._timeout = GLib.timeout_add(self.delay, self.on_timeout)
@@ -8,8 +8,10 @@ import os
 import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk, GObject, Gdk, GdkPixbuf
+import numpy as np
 
 from npl import __config__
+from npl.containers import Spectrum
 from npl.gui_dialogs import GetCalibrationDialog
 
 
@@ -19,6 +21,9 @@ class ContainerView(Gtk.TreeView):
     show_selected on double click."""
     def __init__(self, container, hide_headers=False, attrs=None):
         super().__init__()
+        # subscribes before the model, so rows are matched before they
+        # are inserted or changed
+        self.index = SearchIndex(container)
         self.model = ContainerModelIface(container=container,
                                          attrs=container.spectrum_attrs)
         self.filter_model = self.model.filter_new()
@@ -31,7 +36,6 @@ class ContainerView(Gtk.TreeView):
         if hide_headers:
             self.set_headers_visible(False)
 
-        self.filter = (None, None)
         self.filter_model.set_visible_func(self.filter_func)
 
         self.connect("button-press-event", self.on_row_clicked)
@@ -64,19 +68,14 @@ class ContainerView(Gtk.TreeView):
             self.get_selection().select_path(path)
 
     def filter_by(self, attr, search_term):
-        """Filters the treeview: only show rows where
-        spectrum[key] matches regex."""
-        self.filter = (attr, search_term)
+        """Filters the treeview: only show rows where spectrum[key]
+        matches search_term (see SearchIndex.search)."""
+        self.index.set_query(attr, search_term)
         self.filter_model.refilter()
 
-    def filter_func(self, model, iter_, _data):
-        """Matches the regex with spectrum[key]."""
-        attr, search_term = self.filter
-        regex = re.compile(r".*{}.*".format(search_term), re.IGNORECASE)
-        if attr is None or not search_term:
-            return True
-        spectrum = model.get_spectrum(iter_)
-        return re.match(regex, getattr(spectrum, attr))
+    def filter_func(self, _model, iter_, _data):
+        """Looks the row up in the current search result."""
+        return self.index.is_visible(iter_.user_data)
 
     def on_row_clicked(self, treeview, event):
         """Callback for button-press-event, popups the menu on right click
@@ -99,31 +98,251 @@ class ContainerView(Gtk.TreeView):
             return True
 
     def make_columns(self):
-        """Makes columns with given titles."""
-        def render_text(_col, renderer, model, iter_, attr):
-            """Renders a cell in column with value from that
-            model column which number in model_col_indexes corresponds
-            to title."""
+        """Makes columns with given titles, the cells show the (cached)
+        strings of the model column for attr."""
+        for attr, title in self.titles:
             col_index = self.model.get_column_from_attr(attr)
-            value = model.get_value(iter_, col_index)
-            renderer.set_property("text", str(value))
-        for i, (attr, title) in enumerate(self.titles):
             renderer = Gtk.CellRendererText()
-            column = Gtk.TreeViewColumn(title, renderer, text=i)
-            column.set_cell_data_func(renderer, render_text, attr)
-            col_index = self.model.get_column_from_attr(attr)
+            column = Gtk.TreeViewColumn(title, renderer, text=col_index)
             column.set_sort_column_id(col_index)
             column.set_resizable(True)
             column.set_reorderable(True)
             self.append_column(column)
 
 
+class SearchIndex():
+    """Search index over the metadata of the spectra in a container. For
+    each searched attribute it keeps the lowercased strings, the sids per
+    trigram and (for numeric attributes) the values sorted. An attribute
+    is indexed when it is searched first and then kept up to date from
+    the container signals, as is the result of the current query."""
+    gram_size = 3
+    range_regex = re.compile(
+        r"^\s*(?:(>=|<=|>|<|=)\s*({0})|({0})?\s*\.\.\s*({0})?|({0}))\s*$"
+        .format(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?"))
+
+    def __init__(self, container):
+        self.container = container
+        self.strings = {}
+        self.grams = {}
+        self.numbers = {}
+        self._sorted = {}
+        self.query = None
+        self.result = None
+        container.subscribe(self.container_callback)
+
+    def container_callback(self, keyword, obj, **kwargs):
+        """Keeps the index and the query result up to date."""
+        if keyword == "batch":
+            for keyword_, obj_, kwargs_ in kwargs["events"]:
+                self.container_callback(keyword_, obj_, **kwargs_)
+        elif keyword == "add_spectrum":
+            self.add(kwargs["spectrum"])
+        elif keyword == "add_spectra":
+            for spectrum in kwargs["spectra"]:
+                self.add(spectrum)
+        elif keyword == "remove_spectrum":
+            self.remove(kwargs["spectrum"])
+        elif keyword == "clear_container":
+            for attr in self.strings:
+                self.strings[attr] = {}
+                self.grams[attr] = {}
+                if attr in self.numbers:
+                    self.numbers[attr] = {}
+            self._sorted = {}
+            if self.result is not None:
+                self.result = set()
+        elif keyword == "changed_spectrum":
+            if any(attr in kwargs for attr in self.strings):
+                self.remove(obj)
+                self.add(obj)
+
+    def index_attr(self, attr):
+        """Starts indexing attr."""
+        self.strings[attr] = {}
+        self.grams[attr] = {}
+        if Spectrum.types.get(attr, str) in (int, float):
+            self.numbers[attr] = {}
+        for spectrum in self.container:
+            self.add(spectrum, attrs=[attr])
+
+    def add(self, spectrum, attrs=None):
+        """Indexes a spectrum."""
+        if attrs is None:
+            attrs = self.strings
+        for attr in attrs:
+            value = getattr(spectrum, attr)
+            string = str(value).lower()
+            self.strings[attr][spectrum.sid] = string
+            grams = self.grams[attr]
+            for gram in self.get_grams(string):
+                grams.setdefault(gram, set()).add(spectrum.sid)
+            if attr in self.numbers:
+                self.numbers[attr][spectrum.sid] = self.to_float(value)
+                self._sorted.pop(attr, None)
+        if self.result is not None and self.query[0] in attrs:
+            if self.search(*self.query, within={spectrum.sid}):
+                self.result.add(spectrum.sid)
+            else:
+                self.result.discard(spectrum.sid)
+
+    def remove(self, spectrum):
+        """Removes a spectrum from the index."""
+        for attr, strings in self.strings.items():
+            string = strings.pop(spectrum.sid, None)
+            if string is None:
+                continue
+            grams = self.grams[attr]
+            for gram in self.get_grams(string):
+                sids = grams.get(gram, None)
+                if sids is not None:
+                    sids.discard(spectrum.sid)
+                    if not sids:
+                        del grams[gram]
+            if attr in self.numbers:
+                del self.numbers[attr][spectrum.sid]
+                self._sorted.pop(attr, None)
+        if self.result is not None:
+            self.result.discard(spectrum.sid)
+
+    def get_grams(self, string):
+        """Returns the set of trigrams of string."""
+        size = self.gram_size
+        return set(string[i:i + size] for i in range(len(string) - size + 1))
+
+    def set_query(self, attr, term):
+        """Sets the current query. If the new term only extends the last
+        plain term, only the last result is searched."""
+        within = None
+        if (self.query is not None and self.result is not None
+                and self.query[0] == attr
+                and self.is_plain(attr, self.query[1])
+                and self.is_plain(attr, term)
+                and self.query[1].strip().lower() in term.strip().lower()):
+            within = self.result
+        self.query = None
+        self.result = None
+        result = self.search(attr, term, within)
+        if result is not None:
+            self.query = (attr, term)
+            self.result = result
+
+    def is_visible(self, sid):
+        """True if sid matches the current query."""
+        return self.result is None or sid in self.result
+
+    def is_plain(self, attr, term):
+        """True if term is searched as a plain substring."""
+        term = term.strip()
+        if attr in self.numbers and self.range_regex.match(term):
+            return False
+        return re.escape(term) == term
+
+    def search(self, attr, term, within=None):
+        """Returns the set of sids where attr matches term, None for an
+        empty term. For numeric attributes term can be a range ("1..5",
+        ">=20", "<3", "=10"), terms with special characters are regular
+        expressions, everything else is a case insensitive substring.
+        Only sids in within are searched, if given."""
+        # pylint: disable=too-many-branches
+        term = term.strip()
+        if attr is None or not term:
+            return None
+        if attr not in self.strings:
+            self.index_attr(attr)
+        strings = self.strings[attr]
+        if within is not None:
+            within = set(sid for sid in within if sid in strings)
+
+        if attr in self.numbers:
+            bounds = self.parse_range(term)
+            if bounds is not None:
+                return self.search_range(attr, bounds, within)
+        if re.escape(term) != term:
+            try:
+                regex = re.compile(term, re.IGNORECASE)
+            except re.error:
+                regex = None
+            if regex is not None:
+                if within is None:
+                    within = strings.keys()
+                return set(sid for sid in within if regex.search(strings[sid]))
+
+        term = term.lower()
+        candidates = within
+        if len(term) >= self.gram_size:
+            grams = self.grams[attr]
+            for gram in sorted(self.get_grams(term),
+                               key=lambda gram: len(grams.get(gram, ()))):
+                sids = grams.get(gram, set())
+                candidates = sids if candidates is None else candidates & sids
+                if not candidates:
+                    return set()
+        if candidates is None:
+            candidates = strings.keys()
+        return set(sid for sid in candidates if term in strings[sid])
+
+    def parse_range(self, term):
+        """Returns (low, high) for a numeric range term, None if term is
+        no range."""
+        match = self.range_regex.match(term)
+        if match is None:
+            return None
+        operator, value, low, high, exact = match.groups()
+        if exact is not None:
+            return self.to_float(exact), self.to_float(exact)
+        if operator is None:
+            return (-np.inf if low is None else self.to_float(low),
+                    np.inf if high is None else self.to_float(high))
+        value = self.to_float(value)
+        return {
+            ">=": (value, np.inf),
+            "<=": (-np.inf, value),
+            ">": (np.nextafter(value, np.inf), np.inf),
+            "<": (-np.inf, np.nextafter(value, -np.inf)),
+            "=": (value, value)}[operator]
+
+    @staticmethod
+    def to_float(value):
+        """Converts metadata to float, NaN if impossible (NaN is in no
+        range)."""
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return np.nan
+
+    def search_range(self, attr, bounds, within=None):
+        """Returns the set of sids where low <= attr <= high."""
+        if within is not None:
+            numbers = self.numbers[attr]
+            return set(sid for sid in within
+                       if bounds[0] <= numbers[sid] <= bounds[1])
+        if attr not in self._sorted:
+            numbers = self.numbers[attr]
+            sids = np.fromiter(numbers.keys(), dtype=object,
+                               count=len(numbers))
+            values = np.fromiter(numbers.values(), dtype=float,
+                                 count=len(numbers))
+            order = np.argsort(values, kind="stable")
+            self._sorted[attr] = (values[order], sids[order])
+        values, sids = self._sorted[attr]
+        idx1 = np.searchsorted(values, bounds[0], side="left")
+        idx2 = np.searchsorted(values, bounds[1], side="right")
+        return set(sids[idx1:idx2].tolist())
+
+
 class ContainerModel(GObject.GObject, Gtk.TreeModel):
-    """A TreeModel that reflects a spectrum container."""
+    """A TreeModel that reflects a spectrum container. A cell string is
+    formatted when the view asks for it and cached by sid and column
+    until invalidate() is called for the spectrum. Attributes that
+    change without a signal are never cached."""
     # pylint: disable=no-self-use
+    uncached_attrs = ("visibility", )
+
     def __init__(self, container, attrs=None):
         super().__init__()
         self.container = container
+        self._cells = {}
         if self.container:
             if attrs is not None:
                 self.attrs = [attr for attr in attrs
@@ -154,11 +373,28 @@ class ContainerModel(GObject.GObject, Gtk.TreeModel):
         column = self.attrs.index(attr)
         return column
 
+    def get_cell(self, sid, column):
+        """Returns the formatted string of a column for a spectrum."""
+        cells = self._cells.setdefault(sid, {})
+        cell = cells.get(column, None)
+        if cell is None:
+            attr = self.attrs[column]
+            spectrum = self.container.get_spectrum_by_sid(sid)
+            cell = str(getattr(spectrum, attr))
+            if attr not in self.uncached_attrs:
+                cells[column] = cell
+        return cell
+
+    def invalidate(self, sid=None):
+        """Forgets the cell strings of a spectrum (or of all)."""
+        if sid is None:
+            self._cells = {}
+        else:
+            self._cells.pop(sid, None)
+
     def do_get_value(self, iter_, column):
         """Returns the value for iter_ and column."""
-        attr = self.attrs[column]
-        value = self.get_value_by_attr(iter_, attr)
-        return str(value)
+        return self.get_cell(iter_.user_data, column)
 
     def do_get_iter(self, path):
         """Returns a new TreeIter that points at path.
@@ -250,15 +486,20 @@ class ContainerModelIface(ContainerModel):
 
     def container_callback(self, keyword, obj, **kwargs):
         """Manages signals from the spectrum container."""
-        if keyword == "changed_spectrum":
-            if any([attr in kwargs for attr in obj.titles]):
-                # TODO make this solid (avoiding shifting focus in the cview)
+        if keyword == "batch":
+            for keyword_, obj_, kwargs_ in kwargs["events"]:
+                self.container_callback(keyword_, obj_, **kwargs_)
+        elif keyword == "changed_spectrum":
+            self.invalidate(obj.sid)
+            if any(attr in kwargs for attr in obj.titles):
                 self.amend(obj)
         elif keyword == "add_spectrum":
             self.append(kwargs["spectrum"])
+        elif keyword == "add_spectra":
+            self.extend(kwargs["spectra"], kwargs["index"])
         elif keyword == "remove_spectrum":
-            iter_ = self.get_iter(kwargs["index"])
-            self.remove(iter_)
+            self.invalidate(kwargs["spectrum"].sid)
+            self.row_deleted(Gtk.TreePath((kwargs["index"], )))
         elif keyword == "clear_container":
             self.clear()
 
@@ -266,12 +507,23 @@ class ContainerModelIface(ContainerModel):
         """Adds a spectrum to the model."""
         if not self.attrs:
             self.attrs = self.container.spectrum_attrs
+            self.invalidate()
         if path is None:
             path = (self.container.index(spectrum), )
         if iter_ is None:
             iter_ = self.get_iter(path)
         self.row_inserted(path, iter_)
 
+    def extend(self, spectra, start):
+        """Adds rows for spectra which were inserted at index start."""
+        if not self.attrs:
+            self.attrs = self.container.spectrum_attrs
+            self.invalidate()
+        for idx, spectrum in enumerate(spectra, start):
+            iter_ = Gtk.TreeIter()
+            iter_.user_data = spectrum.sid
+            self.row_inserted(Gtk.TreePath((idx, )), iter_)
+
     def remove(self, iter_):
         """Removes row with iter_."""
         if iter_ is not None:
@@ -279,15 +531,18 @@ class ContainerModelIface(ContainerModel):
             self.row_deleted(path)
 
     def amend(self, spectrum):
-        """Changes a model row."""
+        """Tells the view that a row changed, it keeps its place and the
+        selection."""
         iter_ = Gtk.TreeIter()
         iter_.user_data = spectrum.sid
-        self.remove(iter_)
-        self.append(spectrum)   # TODO this shifts the focus in the cview
+        path = self.get_path(iter_)
+        if path is not None:
+            self.row_changed(path, iter_)
 
     def clear(self):
         """Removes every row."""
-        for idx in range(len(self.container), -1, -1):
+        self.invalidate()
+        for idx in range(len(self.container) - 1, -1, -1):
             self.row_deleted(idx)
 
 
@@ -310,6 +565,8 @@ class TreeViewFilterBar(Gtk.Box):
 
         self.entry = Gtk.Entry()
         self.entry.connect("changed", self.on_entry_changed)
+        self.combo.connect(
+            "changed", lambda _combo: self.on_entry_changed(self.entry))
 
         if not hide_combo:
             self.pack_start(self.combo, False, False, 2)
@@ -401,8 +658,8 @@ class SpectrumSettings(Gtk.Box):
         """Adds a box for setting smoothness of the spectrum."""
         def callback(scale):
             """Callback for smoothscale."""
-            for spectrum in self.spectra:
-                spectrum.set(smoothness=int(scale.get_value()))
+            self.parent.app.scheduler.schedule(
+                self.spectra, smoothness=int(scale.get_value()))
         adj = Gtk.Adjustment(0, 0, 40, 2, 2, 0)
         scale = Gtk.Scale(
             orientation=Gtk.Orientation.HORIZONTAL, adjustment=adj)
@@ -430,8 +687,8 @@ class SpectrumSettings(Gtk.Box):
 
         def callback(button):
             """Callback for normbutton."""
-            for spectrum in self.spectra:
-                spectrum.set(norm=int(button.get_active()))
+            self.parent.app.scheduler.schedule(
+                self.spectra, norm=int(button.get_active()))
 
         icon_path = os.path.join(
             __config__.get("general", "basedir"), "icons/divide16.png")
@@ -458,9 +715,10 @@ class SpectrumSettings(Gtk.Box):
 
         def entry_callback(entry):
             """Callback for calentry."""
-            for spectrum in self.spectra:
-                if not entry.get_text() == "multiple":
-                    spectrum.set(calibration=float(entry.get_text()))
+            if entry.get_text() == "multiple":
+                return
+            self.parent.app.scheduler.schedule(
+                self.spectra, calibration=float(entry.get_text()))
 
         def button_callback(_button):
             """Callback for calbutton."""
@@ -473,8 +731,8 @@ class SpectrumSettings(Gtk.Box):
                             entry.set_text("{:.2f}".format(cal[0]))
                         else:
                             entry.set_text("multiple")
-                        for i, spectrum in enumerate(self.spectra):
-                            spectrum.set(calibration=cal[i])
+                        self.parent.app.s_container.set_spectra(
+                            self.spectra, calibration=cal)
                 else:
                     self.parent.refresh(keepaxes=True)
                 dialog.destroy()
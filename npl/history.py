@@ -0,0 +1,255 @@
+"""Provides undo/redo for a SpectrumContainer. The history only keeps
+parameter deltas and references to the objects that were added or
+removed, arrays are never copied: they are replaced instead of changed
+in place, so old states share them with the current one."""
+
+from npl.containers import Spectrum
+
+
+class UndoHistory():
+    """Records the changes done to a SpectrumContainer as undo steps, one
+    step per signal or per container.batch(). Parameters of all spectra,
+    regions and peaks are mirrored in a shadow (keyed by sid) to know the
+    old values when a change signal arrives, so undo and redo only touch
+    the changed objects. max_bytes limits the (estimated) memory held by
+    the steps, the oldest steps are dropped first."""
+    spectrum_attrs = ("calibration", "smoothness", "norm") + tuple(
+        sorted(Spectrum.titles))
+    region_attrs = ("emin", "emax", "bgtype")
+    peak_attrs = ("fwhm", "area", "center")
+    param_size = 100
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_steps=200):
+        self.max_bytes = max_bytes
+        self.max_steps = max_steps
+        self.container = None
+        self.undo_steps = []
+        self.redo_steps = []
+        self.is_suspended = False
+
+        self._shadow = {}
+        self._pending = []
+        self._pending_ops = {}
+
+    def attach(self, container):
+        """Starts recording the changes done to container."""
+        self.container = container
+        self.clear()
+        container.subscribe(self.container_callback)
+
+    def clear(self):
+        """Forgets all steps and mirrors the container content."""
+        self.undo_steps = []
+        self.redo_steps = []
+        self._pending = []
+        self._pending_ops = {}
+        self._shadow = {}
+        if self.container is not None:
+            for spectrum in self.container:
+                self.track(spectrum)
+
+    def can_undo(self):
+        """True if there is something to undo."""
+        self.close_step()
+        return bool(self.undo_steps)
+
+    def can_redo(self):
+        """True if there is something to redo."""
+        self.close_step()
+        return bool(self.redo_steps)
+
+    def undo(self):
+        """Reverts the last step."""
+        self.close_step()
+        if not self.undo_steps:
+            return False
+        step = self.undo_steps.pop()
+        self.apply(step, undo=True)
+        self.redo_steps.append(step)
+        return True
+
+    def redo(self):
+        """Applies the last undone step again."""
+        self.close_step()
+        if not self.redo_steps:
+            return False
+        step = self.redo_steps.pop()
+        self.apply(step, undo=False)
+        self.undo_steps.append(step)
+        return True
+
+    @property
+    def nbytes(self):
+        """Estimated memory held by all steps."""
+        return sum(step["nbytes"] for step in self.undo_steps
+                   + self.redo_steps)
+
+    def container_callback(self, keyword, obj, **kwargs):
+        """Turns signals into operations of the pending step, the step is
+        closed as soon as no batch is open anymore."""
+        if self.is_suspended:
+            return
+        if keyword == "batch":
+            for keyword_, obj_, kwargs_ in kwargs["events"]:
+                self.record(keyword_, obj_, kwargs_)
+        else:
+            self.record(keyword, obj, kwargs)
+        if not self.container._batch_depth:  # pylint: disable=protected-access
+            self.close_step()
+
+    def record(self, keyword, obj, kwargs):
+        """Adds the operation for one signal to the pending step."""
+        if keyword == "add_spectrum":
+            self.add_op(("insert", kwargs["index"], [kwargs["spectrum"]]))
+            self.track(kwargs["spectrum"])
+        elif keyword == "add_spectra":
+            self.add_op(("insert", kwargs["index"], list(kwargs["spectra"])))
+            for spectrum in kwargs["spectra"]:
+                self.track(spectrum)
+        elif keyword == "remove_spectrum":
+            self.add_op(("remove", kwargs["index"], [kwargs["spectrum"]]))
+        elif keyword == "clear_container":
+            self.add_op(("remove", 0, list(self.container)))
+        elif keyword in ("changed_spectrum", "changed_region",
+                         "changed_peak"):
+            self.diff(obj, "params")
+        elif keyword in ("add_region", "remove_region", "add_peak",
+                         "remove_peak"):
+            self.diff(obj, "children")
+            for child in self.get_children(obj):
+                if child.sid not in self._shadow:
+                    self.track(child)
+
+    def add_op(self, operation):
+        """Appends an operation to the pending step."""
+        self._pending.append(operation)
+
+    def diff(self, obj, part):
+        """Compares obj with its shadow and records the difference, a
+        second change of the same object in one step is merged."""
+        old = self._shadow.get(obj.sid, None)
+        if old is None:
+            self.track(obj)
+            return
+        new = self.get_state(obj)
+        if old[part] == new[part]:
+            return
+        key = (obj.sid, part)
+        if key in self._pending_ops:
+            operation = self._pending_ops[key]
+            self._pending[operation] = (
+                part, obj, self._pending[operation][2], new[part])
+        else:
+            self._pending_ops[key] = len(self._pending)
+            self._pending.append((part, obj, old[part], new[part]))
+        self._shadow[obj.sid] = new
+
+    def close_step(self):
+        """Finishes the pending step and enforces the memory limit."""
+        if not self._pending:
+            return
+        step = {"ops": self._pending,
+                "nbytes": sum(self.estimate(op) for op in self._pending)}
+        self._pending = []
+        self._pending_ops = {}
+        self.undo_steps.append(step)
+        self.redo_steps = []
+        while self.undo_steps and (len(self.undo_steps) > self.max_steps
+                                   or self.nbytes > self.max_bytes):
+            self.undo_steps.pop(0)
+
+    def apply(self, step, undo=True):
+        """Reverts (undo=True) or repeats the operations of step."""
+        operations = step["ops"]
+        if undo:
+            operations = reversed(operations)
+        self.is_suspended = True
+        try:
+            with self.container.batch():
+                for operation in operations:
+                    self.apply_op(operation, undo)
+        finally:
+            self.is_suspended = False
+
+    def apply_op(self, operation, undo):
+        """Applies a single operation."""
+        kind = operation[0]
+        if kind in ("insert", "remove"):
+            _kind, index, spectra = operation
+            if (kind == "insert") == undo:
+                for spectrum in spectra:
+                    if spectrum in self.container:
+                        self.container.remove(spectrum)
+            elif index >= len(self.container):
+                self.container.extend(spectra)
+                for spectrum in spectra:
+                    self.track(spectrum)
+            else:
+                for idx, spectrum in enumerate(spectra, index):
+                    self.container.insert(idx, spectrum)
+                    self.track(spectrum)
+            return
+        _kind, obj, old, new = operation
+        target = old if undo else new
+        if kind == "params":
+            obj.set(**dict(target))
+        else:
+            self.set_children(obj, target)
+        self._shadow[obj.sid] = self.get_state(obj)
+
+    def set_children(self, obj, children):
+        """Makes the regions of a spectrum or the peaks of a region equal
+        to children."""
+        if isinstance(obj, Spectrum):
+            current, remove, insert = (
+                obj.regions, obj.remove_region, obj.insert_region)
+        else:
+            current, remove, insert = (
+                obj.peaks, obj.remove_peak, obj.insert_peak)
+        wanted = set(child.sid for child in children)
+        for child in list(current):
+            if child.sid not in wanted:
+                remove(child)
+        present = set(child.sid for child in current)
+        for index, child in enumerate(children):
+            if child.sid not in present:
+                insert(child, index)
+                self.track(child)
+
+    def track(self, obj):
+        """Mirrors obj and its children in the shadow."""
+        self._shadow[obj.sid] = self.get_state(obj)
+        for child in self.get_children(obj):
+            self.track(child)
+
+    def get_state(self, obj):
+        """Returns the recorded parameters and children of obj."""
+        if isinstance(obj, Spectrum):
+            attrs = self.spectrum_attrs
+        elif hasattr(obj, "peaks"):
+            attrs = self.region_attrs
+        else:
+            attrs = self.peak_attrs
+        return {"params": tuple((attr, getattr(obj, attr)) for attr in attrs),
+                "children": tuple(self.get_children(obj))}
+
+    @staticmethod
+    def get_children(obj):
+        """Returns the regions of a spectrum or the peaks of a region."""
+        if isinstance(obj, Spectrum):
+            return obj.regions
+        return getattr(obj, "peaks", [])
+
+    def estimate(self, operation):
+        """Estimated bytes kept alive by an operation: removed or added
+        spectra count with their arrays."""
+        # pylint: disable=protected-access
+        if operation[0] in ("insert", "remove"):
+            nbytes = 0
+            for spectrum in operation[2]:
+                nbytes += spectrum._intensity.nbytes + self.param_size * len(
+                    self.spectrum_attrs)
+                if spectrum.intensity is not spectrum._intensity:
+                    nbytes += spectrum.intensity.nbytes
+            return nbytes
+        return self.param_size * (len(operation[2]) + len(operation[3]))
@@ -0,0 +1,694 @@
+"""Plots spectra with their regions, backgrounds, fits and RSF markers
+on a figure, without the GTK user interface. Report figures of many
+spectra can be rendered in parallel by export_figures, also from the
+command line:
+
+    python -m npl.plotter project.npl outdir --format pdf
+"""
+
+import os
+import re
+import time
+import bisect
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+from matplotlib import colormaps
+import numpy as np
+
+from npl import __config__
+from npl.fileio import RSFHandler, DBHandler
+from npl.plotter_elements import MinMaxPyramid, ImagePyramid, decimate_rows
+from npl.processing import resample
+
+
+class BeautifulFigure(Figure):
+    """A customized canvas."""
+    canvas_class = FigureCanvasAgg
+
+    def __init__(self, figsize=(10, 10), dpi=80):
+        # pylint: disable=invalid-name
+        super().__init__(figsize=figsize, dpi=dpi)
+        self.canvas = self.canvas_class(self)
+        self.ax = self.add_axes([-0.005, 0.0, 1.01, 1.005])
+
+        self.now_xy = [0, 0, 1, 1]
+        self.s_xy = [np.inf, -np.inf, np.inf, -np.inf]
+
+    def lock(self, obj):
+        """Lock the canvas."""
+        self.canvas.widgetlock(obj)
+
+    def unlock(self, obj):
+        """Unlock the canvas."""
+        self.canvas.widgetlock.release(obj)
+
+    def set_ticks(self):
+        """Configures axes ticks."""
+        self.ax.tick_params(
+            reset=True,
+            axis="both",
+            direction="in",
+            pad=-20,
+            labelsize="large",
+            labelcolor="blue",
+            color="blue",
+            labelleft=False,
+            top=False,
+            left=False,
+            right=False)
+        if self.s_xy[0] == np.inf:
+            self.ax.tick_params(
+                which="both",
+                bottom=False,
+                top=False,
+                left=False,
+                right=False,
+                labelbottom=False)
+
+    def store_axlims(self):
+        """Stores axis limits in self.now_xy."""
+        self.now_xy[1], self.now_xy[0] = self.ax.get_xlim()
+        self.now_xy[2], self.now_xy[3] = self.ax.get_ylim()
+
+    def adjust_axlims(self):
+        """Sets the axis limits."""
+        if np.all(np.isfinite(self.now_xy)):
+            self.ax.set_xlim(*self.now_xy[1::-1])
+            self.ax.set_ylim(*self.now_xy[2:])
+
+    def recenter_view(self):
+        """Focuses view on current plot."""
+        if self.now_xy != self.s_xy:
+            self.now_xy = self.s_xy
+        self.adjust_axlims()
+
+
+class SpectrumFigure(BeautifulFigure):
+    """Axes object containing the methods for plotting Spectra. Artists
+    are kept per (sid, part) and only changed objects are updated."""
+    # decimated spectra have this many points per pixel column (x2 for
+    # min and max), more than one makes up for hidpi and line joins
+    lod_oversampling = 2
+    # minimum horizontal distance of RSF labels in pixels
+    rsf_label_spacing = 45
+    # stacked spectra are only a few pixels high, one point pair per
+    # pixel column is enough for them
+    waterfall_oversampling = 1
+    # colors of the spectra in the waterfall view, from front to back
+    waterfall_cmap = "viridis"
+
+    def __init__(self, figsize=(10, 10), dpi=80):
+        super().__init__(figsize=figsize, dpi=dpi)
+        rsf_file = os.path.join(__config__.get("general", "basedir"), "rsf.db")
+        self.rsfhandler = RSFHandler(rsf_file)
+        # overrides spectrum.visibility if not None
+        self.visibility = None
+        # (sid, part) -> artist, with the data it shows and extra objects
+        # (e.g. DraggableRegionBound) that have to be disconnected
+        self.object_artists = {}
+        self._shown = {}
+        self._handlers = {}
+        # (sid, "spectrum") -> (energy, intensity, MinMaxPyramid, bounds)
+        self._lod = {}
+        self._dirty = set()
+        self._seen = set()
+        # RSF lines as one LineCollection and a pool of labels
+        self.rsf_collection = None
+        self.rsf_labels = []
+        self._rsf_lines = None
+        self._rsf_data_key = None
+        self._rsf_key = None
+        # offset between the spectra of the waterfall view as fraction of
+        # the intensity range, None shows the normal view
+        self.waterfall = None
+        self.waterfall_collection = None
+        self._waterfall = None
+        self.ax.callbacks.connect("xlim_changed", self.on_view_changed)
+        self.canvas.mpl_connect("resize_event", self.on_view_changed)
+
+    def invalidate(self, obj):
+        """Marks the fit curves of a spectrum, region or peak (and the
+        objects depending on it) for re-evaluation on the next plot."""
+        if hasattr(obj, "regions"):
+            for region in obj.regions:
+                self.invalidate(region)
+        elif hasattr(obj, "peaks"):
+            self._dirty.add(obj.sid)
+            self._dirty.update(peak.sid for peak in obj.peaks)
+        elif hasattr(obj, "region"):
+            self._dirty.add(obj.sid)
+            self._dirty.add(obj.region.sid)
+
+    def get_line(self, key, lineprops):
+        """Returns the line stored under key, creates it if necessary."""
+        if key not in self.object_artists:
+            self.object_artists[key] = self.ax.plot([], [], **lineprops)[0]
+        self._seen.add(key)
+        return self.object_artists[key]
+
+    def set_line_data(self, key, lineprops, *data):
+        """Sets the data of a line only if the arrays are not the ones
+        it already shows (arrays are replaced on change, not altered)."""
+        line = self.get_line(key, lineprops)
+        shown = self._shown.get(key, ())
+        if (len(shown) != len(data)
+                or any(old is not new for old, new in zip(shown, data))):
+            line.set_data(*data)
+            self._shown[key] = data
+        return line
+
+    def remove_artist(self, key):
+        """Removes an artist and disconnects its handlers."""
+        for handler in self._handlers.pop(key, ()):
+            handler.disconnect()
+        self.object_artists.pop(key).remove()
+        self._shown.pop(key, None)
+        self._lod.pop(key, None)
+
+    def update_lod(self, key):
+        """Shows the decimated data of a spectrum line for the current
+        x limits and axes width."""
+        _energy, _intensity, pyramid, _bounds = self._lod[key]
+        xmin, xmax = self.ax.get_xlim()
+        ncols = self.ax.bbox.width * self.lod_oversampling
+        self.object_artists[key].set_data(
+            *pyramid.decimate(xmin, xmax, ncols))
+
+    def on_view_changed(self, *_ignore):
+        """Recomputes the decimated lines and the RSF labels on zoom, pan
+        and resize."""
+        for key in self._lod:
+            self.update_lod(key)
+        if self.waterfall_collection is not None:
+            self.update_waterfall()
+        if self._rsf_lines is not None:
+            self.update_rsf_labels()
+
+    def plot_spectrum(self, spectrum):
+        """Spectrum plotting."""
+        lineprops = {
+            "color": "black",
+            "linewidth": 1,
+            "linestyle": "-",
+            "alpha": 1}
+        key = (spectrum.sid, "spectrum")
+        line = self.get_line(key, lineprops)
+        line.set_label(spectrum.name)
+        lod = self._lod.get(key, None)
+        if (lod is None or lod[0] is not spectrum.energy
+                or lod[1] is not spectrum.intensity):
+            lod = (spectrum.energy, spectrum.intensity,
+                   MinMaxPyramid(spectrum.energy, spectrum.intensity),
+                   [np.min(spectrum.energy), np.max(spectrum.energy),
+                    np.min(spectrum.intensity),
+                    np.max(spectrum.intensity * 1.05)])
+            self._lod[key] = lod
+            self.update_lod(key)
+        bounds = lod[3]
+        self.s_xy = [
+            min(self.s_xy[0], bounds[0]), max(self.s_xy[1], bounds[1]),
+            min(self.s_xy[2], bounds[2]), max(self.s_xy[3], bounds[3])]
+
+    def get_visibility(self, spectrum):
+        """Returns which parts of spectrum are plotted: d(ata), r(egions),
+        b(ackgrounds), p(eaks)."""
+        if self.visibility is not None:
+            return self.visibility
+        return spectrum.visibility
+
+    def get_bound_handlers(self, line, region, attr):
+        """Returns objects that make the line for region.attr (emin or
+        emax) interactive, they need a disconnect() method."""
+        # pylint: disable=no-self-use,unused-argument
+        return []
+
+    def plot_region(self, region):
+        """Region plotting."""
+        lineprops = {
+            "color": "blue",
+            "linewidth": 2,
+            "linestyle": "-",
+            "alpha": 0.5}
+        for attr in ("emin", "emax"):
+            key = (region.sid, attr)
+            if key not in self.object_artists:
+                self.object_artists[key] = self.ax.axvline(
+                    getattr(region, attr), 0, 1, **lineprops)
+                self._handlers[key] = self.get_bound_handlers(
+                    self.object_artists[key], region, attr)
+            else:
+                self.object_artists[key].set_xdata([getattr(region, attr)] * 2)
+            self._seen.add(key)
+        if ("b" in self.get_visibility(region.spectrum)
+                and region.background is not None):
+            lineprops = {
+                "color": "red",
+                "linewidth": 1,
+                "linestyle": "--",
+                "alpha": 1}
+            self.set_line_data((region.sid, "background"), lineprops,
+                               region.energy, region.background)
+
+    def plot_peaks(self, region):
+        """Peak and model plotting, the fit curves are only evaluated for
+        new or invalidated regions and peaks."""
+        lineprops = {
+            "color": "blue",
+            "linewidth": 1,
+            "linestyle": "--"}
+        key = (region.sid, "fit")
+        if key in self.object_artists and region.sid not in self._dirty:
+            self._seen.add(key)
+        elif region.fit_intensity is not None:
+            self.set_line_data(key, lineprops, region.energy,
+                               region.fit_intensity + region.background)
+        lineprops = {
+            "color": "green",
+            "linewidth": 1,
+            "linestyle": "--"}
+        for peak in region.peaks:
+            key = (peak.sid, "fit")
+            if key in self.object_artists and peak.sid not in self._dirty:
+                self._seen.add(key)
+            elif peak.fit_intensity is not None:
+                self.set_line_data(key, lineprops, region.energy,
+                                   peak.fit_intensity + region.background)
+
+    def plot(self, container):
+        """Plots the visible spectra, reusing the artists of the last
+        call and removing those of objects that are no longer shown."""
+        self._seen = set()
+        if container:
+            self.s_xy = [np.inf, -np.inf, np.inf, -np.inf]
+        if self.waterfall is not None:
+            self.plot_waterfall([
+                spectrum for spectrum in container
+                if "d" in self.get_visibility(spectrum)])
+            container = []
+        elif self.waterfall_collection is not None:
+            self.waterfall_collection.remove()
+            self.waterfall_collection = None
+            self._waterfall = None
+        for spectrum in container:
+            visibility = self.get_visibility(spectrum)
+            if "d" in visibility:
+                self.plot_spectrum(spectrum)
+            else:
+                continue
+            if "r" in visibility:
+                for region in spectrum.regions:
+                    self.plot_region(region)
+            if "p" in visibility:
+                for region in spectrum.regions:
+                    self.plot_peaks(region)
+        for key in [key for key in self.object_artists
+                    if key not in self._seen]:
+            self.remove_artist(key)
+        self._dirty.clear()
+
+    def set_waterfall(self, offset=None):
+        """Stacks the spectra with offset times the intensity range between
+        them, offset=None switches back to the normal view. Only the data
+        is shown in the waterfall view."""
+        self.waterfall = offset
+        self._waterfall = None
+
+    def plot_waterfall(self, spectra):
+        """Plots spectra stacked as one LineCollection. Spectra on the
+        same energy grid are decimated together, the grouped intensities
+        are only rebuilt when the shown arrays change."""
+        arrays = [(spectrum.energy, spectrum.intensity)
+                  for spectrum in spectra]
+        cache = self._waterfall
+        if (cache is None or len(cache["arrays"]) != len(arrays)
+                or any(old[0] is not new[0] or old[1] is not new[1]
+                       for old, new in zip(cache["arrays"], arrays))):
+            cache = self._waterfall = self.get_waterfall_groups(arrays)
+        if self.waterfall_collection is None:
+            self.waterfall_collection = LineCollection(
+                [], linewidths=1, zorder=2)
+            self.ax.add_collection(self.waterfall_collection)
+        if not arrays:
+            self.waterfall_collection.set_segments([])
+            return
+        cmap = colormaps[self.waterfall_cmap]
+        self.waterfall_collection.set_color(
+            cmap(np.linspace(0, 1, len(arrays)))[cache["order"]])
+        ymin, ymax = cache["ymin"], cache["ymax"]
+        step = self.waterfall * (ymax - ymin)
+        cache["offsets"] = np.arange(len(arrays)) * step
+        self.s_xy = [cache["xmin"], cache["xmax"], ymin,
+                     ymax + cache["offsets"][-1] + 0.05 * (ymax - ymin)]
+        self.update_waterfall()
+
+    @staticmethod
+    def get_waterfall_groups(arrays):
+        """Groups (energy, intensity) pairs by energy array and stacks the
+        intensities of each group."""
+        groups = {}
+        for row, (energy, intensity) in enumerate(arrays):
+            group = groups.setdefault(id(energy), (energy, [], []))
+            group[1].append(row)
+            group[2].append(intensity)
+        groups = [(energy, np.array(rows), np.vstack(intensities))
+                  for energy, rows, intensities in groups.values()]
+        cache = {"arrays": arrays, "groups": groups,
+                 "xmin": 0, "xmax": 1, "ymin": 0, "ymax": 1}
+        cache["order"] = np.concatenate(
+            [rows for _energy, rows, _data in groups] or [[]]).astype(int)
+        if groups:
+            cache["xmin"] = min(np.min(energy) for energy, _, _ in groups)
+            cache["xmax"] = max(np.max(energy) for energy, _, _ in groups)
+            cache["ymin"] = min(np.nanmin(data) for _, _, data in groups)
+            cache["ymax"] = max(np.nanmax(data) for _, _, data in groups)
+        return cache
+
+    def update_waterfall(self):
+        """Shows the decimated waterfall lines for the current x limits
+        and axes width."""
+        cache = self._waterfall
+        if cache is None or "offsets" not in cache:
+            return
+        xmin, xmax = self.ax.get_xlim()
+        ncols = self.ax.bbox.width * self.waterfall_oversampling
+        segments = []
+        for energy, rows, data in cache["groups"]:
+            xdata, ydata = decimate_rows(energy, data, xmin, xmax, ncols)
+            lines = np.empty(ydata.shape + (2, ))
+            lines[..., 0] = xdata
+            lines[..., 1] = ydata + cache["offsets"][rows, None]
+            segments.extend(lines)
+        self.waterfall_collection.set_segments(segments)
+
+    def plot_rsf(self, elements, source):
+        """Plots RSF values for a certain element with given X-ray souce
+        as one LineCollection. The library lines are only looked up when
+        elements or source change, the collection is only updated when
+        the height changes too."""
+        data_key = (tuple(elements), source)
+        if data_key != self._rsf_data_key:
+            self._rsf_data_key = data_key
+            self._rsf_lines = self.get_rsf_lines(elements, source)
+            self._rsf_key = None
+        rsf_key = data_key + (self.now_xy[3], )
+        if rsf_key == self._rsf_key:
+            return
+        self._rsf_key = rsf_key
+        lines = self._rsf_lines
+        if lines is None:
+            if self.rsf_collection is not None:
+                self.rsf_collection.remove()
+                self.rsf_collection = None
+            self.update_rsf_labels()
+            return
+
+        ymax = self.now_xy[3]
+        max_rsf = lines["rsf"].max() + 1e-9
+        lines["heights"] = np.where(
+            lines["rsf"] == 0, 0.5 * ymax, lines["rsf"] * ymax / max_rsf * 0.8)
+        segments = np.zeros((len(lines["energies"]), 2, 2))
+        segments[:, :, 0] = lines["energies"][:, None]
+        segments[:, 1, 1] = lines["heights"]
+        if self.rsf_collection is None:
+            self.rsf_collection = LineCollection(
+                segments, colors=lines["colors"], linewidths=2)
+            self.ax.add_collection(self.rsf_collection, autolim=False)
+        else:
+            self.rsf_collection.set_segments(segments)
+            self.rsf_collection.set_color(lines["colors"])
+        self.update_rsf_labels()
+
+    def get_rsf_lines(self, elements, source):
+        """Returns the lines of elements as dict of arrays (energies, rsf,
+        names, colors), None if there are none."""
+        colorcycle = "gcmybr" * 10
+        tables = [self.rsfhandler.get_element_table(element, source)
+                  for element in elements]
+        tables = [(colorcycle[i], table) for i, table in enumerate(tables)
+                  if table.size]
+        if not tables:
+            return None
+        return {
+            "energies": np.concatenate(
+                [table["BE"] for _color, table in tables]).astype(float),
+            "rsf": np.concatenate(
+                [table["RSF"] for _color, table in tables]).astype(float),
+            "names": np.concatenate(
+                [table["fullname"] for _color, table in tables]),
+            "colors": [color for color, table in tables
+                       for _i in range(table.size)]}
+
+    def update_rsf_labels(self):
+        """Labels the RSF lines in the visible x range. Labels closer than
+        rsf_label_spacing pixels to the label of a line with higher RSF
+        are left out. Text artists are reused."""
+        chosen = []
+        lines = self._rsf_lines
+        if lines is not None and "heights" in lines:
+            energies = lines["energies"]
+            xmin, xmax = sorted(self.ax.get_xlim())
+            visible = np.flatnonzero((energies >= xmin) & (energies <= xmax))
+            order = visible[np.argsort(-lines["rsf"][visible], kind="stable")]
+            xpixels = self.ax.transData.transform(np.column_stack(
+                (energies[order], np.zeros(len(order)))))[:, 0]
+            placed = []
+            for idx, xpixel in zip(order, xpixels):
+                pos = bisect.bisect(placed, xpixel)
+                if (pos > 0 and xpixel - placed[pos - 1]
+                        < self.rsf_label_spacing):
+                    continue
+                if (pos < len(placed)
+                        and placed[pos] - xpixel < self.rsf_label_spacing):
+                    continue
+                placed.insert(pos, xpixel)
+                chosen.append(idx)
+        while len(self.rsf_labels) < len(chosen):
+            self.rsf_labels.append(self.ax.text(0, 0, "", color="black"))
+        for label, idx in zip(self.rsf_labels, chosen):
+            label.set_position((lines["energies"][idx], lines["heights"][idx]
+                                + self.now_xy[3] * 0.015))
+            label.set_text(lines["names"][idx])
+            label.set_visible(True)
+        for label in self.rsf_labels[len(chosen):]:
+            label.set_visible(False)
+
+
+class MapFigure(BeautifulFigure):
+    """Shows spectra as an intensity map of energy x spectrum index. The
+    spectra are resampled onto a common grid and drawn as one image, on
+    zoom a level of an ImagePyramid is shown so the image never has much
+    more pixels than the axes. Clicking a row selects the spectrum and
+    calls row_callback(spectrum)."""
+    # resampled spectra have at most this many points
+    max_columns = 4096
+    cmap = "viridis"
+
+    def __init__(self, figsize=(10, 10), dpi=80):
+        super().__init__(figsize=figsize, dpi=dpi)
+        self.ax.set_autoscale_on(False)
+        self.spectra = []
+        self.grid = None
+        self.pyramid = None
+        self.image = None
+        self.row_callback = None
+        self.marker = self.ax.axhline(
+            0, color="red", linewidth=1, visible=False)
+        self._arrays = []
+        self._view = None
+        self._clim = None
+        self.ax.callbacks.connect("xlim_changed", self.on_view_changed)
+        self.ax.callbacks.connect("ylim_changed", self.on_view_changed)
+        self.canvas.mpl_connect("resize_event", self.on_view_changed)
+        self.canvas.mpl_connect("button_press_event", self.on_press)
+
+    def plot(self, spectra):
+        """Shows spectra, one row per spectrum. The map is only resampled
+        when the shown arrays change."""
+        spectra = list(spectra)
+        arrays = [(spectrum.energy, spectrum.intensity)
+                  for spectrum in spectra]
+        self.spectra = spectra
+        if (len(arrays) != len(self._arrays)
+                or any(old[0] is not new[0] or old[1] is not new[1]
+                       for old, new in zip(self._arrays, arrays))):
+            self._arrays = arrays
+            self._view = None
+            self.marker.set_visible(False)
+            if arrays:
+                self.grid, data = self.get_map(arrays)
+                self.pyramid = ImagePyramid(data)
+                self._clim = (np.nanmin(data), np.nanmax(data))
+            else:
+                self.grid, self.pyramid = None, None
+        if self.pyramid is None:
+            self.s_xy = [np.inf, -np.inf, np.inf, -np.inf]
+            if self.image is not None:
+                self.image.set_visible(False)
+            return
+        self.s_xy = [self.grid[0], self.grid[-1], len(spectra) - 0.5, -0.5]
+        if self.image is None:
+            self.image = self.ax.imshow(
+                np.zeros((1, 1)), aspect="auto", origin="upper",
+                interpolation="nearest", cmap=self.cmap)
+        self.image.set_visible(True)
+        self.image.set_clim(*self._clim)
+        self.update_image()
+
+    def get_map(self, arrays):
+        """Resamples (energy, intensity) pairs onto an ascending grid
+        covering all of them with the finest step among them. Spectra
+        sharing an energy array are resampled together."""
+        energies = [energy for energy, _intensity in arrays]
+        emin = min(np.min(energy) for energy in energies)
+        emax = max(np.max(energy) for energy in energies)
+        steps = [np.median(np.abs(np.diff(energy)))
+                 for energy in energies if len(energy) > 1]
+        step = max(min(steps, default=1), (emax - emin) / self.max_columns)
+        if not step > 0:
+            step = 1
+        grid = np.linspace(emin, emax, int(round((emax - emin) / step)) + 1)
+        data = np.full((len(arrays), len(grid)), np.nan)
+        groups = {}
+        for row, (energy, _intensity) in enumerate(arrays):
+            groups.setdefault(id(energy), []).append(row)
+        for rows in groups.values():
+            data[rows] = resample([arrays[row][0] for row in rows],
+                                  [arrays[row][1] for row in rows], grid)
+        return grid, data
+
+    def update_image(self):
+        """Shows the pyramid level and part needed for the current axes
+        limits and size."""
+        if self.pyramid is None:
+            return
+        start = self.grid[0]
+        step = self.grid[1] - start if len(self.grid) > 1 else 1
+        xmin, xmax = sorted((np.array(self.ax.get_xlim()) - start) / step)
+        ymin, ymax = sorted(self.ax.get_ylim())
+        data, (col1, col2, row1, row2) = self.pyramid.get_view(
+            xmin + 0.5, xmax + 0.5, ymin + 0.5, ymax + 0.5,
+            self.ax.bbox.width, self.ax.bbox.height)
+        view = (data.shape, col1, col2, row1, row2)
+        if view == self._view:
+            return
+        self._view = view
+        self.image.set_data(data)
+        self.image.set_extent((
+            start + (col1 - 0.5) * step, start + (col2 - 0.5) * step,
+            row2 - 0.5, row1 - 0.5))
+
+    def on_view_changed(self, *_ignore):
+        """Picks the image part on zoom, pan and resize."""
+        self.update_image()
+
+    def set_ticks(self):
+        """Also labels the spectrum index."""
+        super().set_ticks()
+        if self.pyramid is not None:
+            self.ax.tick_params(
+                axis="y", left=True, labelleft=True, pad=-50)
+
+    def select_row(self, row):
+        """Marks the spectrum in row."""
+        self.marker.set_ydata([row, row])
+        self.marker.set_visible(True)
+        self.canvas.draw_idle()
+
+    def on_press(self, event):
+        """Selects the clicked row if no navigation tool is active."""
+        if (event.inaxes is not self.ax or event.ydata is None
+                or self.ax.get_navigate_mode() is not None
+                or self.pyramid is None):
+            return
+        row = int(round(event.ydata))
+        if 0 <= row < len(self.spectra):
+            self.select_row(row)
+            if self.row_callback is not None:
+                self.row_callback(self.spectra[row])
+
+
+def render_spectra(spectra, fnames, visibility="drbp", rsf=None,
+                   figsize=(8, 6), dpi=100):
+    """Renders each spectrum to the corresponding file name (the format is
+    taken from the extension). One figure is reused for all spectra.
+    rsf=(elements, source) adds RSF markers."""
+    figure = SpectrumFigure(figsize=figsize, dpi=dpi)
+    figure.visibility = visibility
+    label = figure.text(0.01, 0.99, "", verticalalignment="top")
+    for spectrum, fname in zip(spectra, fnames):
+        figure.plot([spectrum])
+        figure.recenter_view()
+        figure.set_ticks()
+        if rsf is not None:
+            figure.plot_rsf(*rsf)
+        label.set_text(spectrum.name)
+        figure.savefig(fname)
+    return len(fnames)
+
+
+def export_figures(spectra, directory, fmt="png", processes=None, **kwargs):
+    """Renders one figure per spectrum into directory, spread over
+    processes (default: number of CPUs). kwargs go to render_spectra.
+    Returns (number of figures, seconds, figures per second)."""
+    spectra = list(spectra)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fnames = []
+    for i, spectrum in enumerate(spectra):
+        name = re.sub(r"[^\w\-.]+", "_", spectrum.name).strip("_")
+        fnames.append(os.path.join(
+            directory, "{:04d}_{}.{}".format(i, name or "spectrum", fmt)))
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, len(spectra)))
+    # a few chunks per process balance the load and keep figures reused
+    nchunks = min(len(spectra), processes * 4)
+    chunks = [(spectra[i::nchunks], fnames[i::nchunks])
+              for i in range(nchunks)]
+
+    start = time.perf_counter()
+    if processes == 1:
+        count = sum(render_spectra(chunk, names, **kwargs)
+                    for chunk, names in chunks)
+    else:
+        with ProcessPoolExecutor(
+                max_workers=processes,
+                mp_context=multiprocessing.get_context("forkserver")) as pool:
+            futures = [pool.submit(render_spectra, chunk, names, **kwargs)
+                       for chunk, names in chunks]
+            count = sum(future.result() for future in futures)
+    seconds = time.perf_counter() - start
+    return count, seconds, count / seconds if seconds else float("inf")
+
+
+def main():
+    """Exports the figures of all spectra of a project file."""
+    parser = argparse.ArgumentParser(
+        description="Renders report figures of all spectra in a project.")
+    parser.add_argument("project", help="project file (.npl)")
+    parser.add_argument("directory", help="output directory")
+    parser.add_argument("--format", default="png",
+                        choices=("png", "pdf", "svg"))
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--dpi", type=int, default=100)
+    parser.add_argument("--rsf", nargs="+", metavar="ELEMENT",
+                        help="show RSF markers for these elements")
+    parser.add_argument("--source", default="Al", help="X-ray source")
+    args = parser.parse_args()
+
+    container = DBHandler().load(args.project)
+    rsf = (args.rsf, args.source) if args.rsf else None
+    count, seconds, rate = export_figures(
+        container, args.directory, fmt=args.format,
+        processes=args.processes, rsf=rsf, dpi=args.dpi)
+    print("{} figures in {:.1f} s ({:.1f} figures/s)".format(
+        count, seconds, rate))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,10 @@
-"""Custom SpanSelector widget that has a higher rectangle without visible
-up/down borders."""
+"""Building blocks for the plotter: selector widgets for spans
+(SpanSelector, a higher rectangle without visible up/down borders) and
+peaks (PeakSelector), draggable vertical lines that are blitted while
+dragged (DraggableVLine), and level-of-detail data that keeps redraws
+independent of the data size: MinMaxPyramid and decimate_rows reduce
+lines to per-pixel extrema, ImagePyramid holds downsampled levels of an
+image."""
 
 import numpy as np
 
@@ -308,12 +313,18 @@ class SpanSelector(_SelectorWidget):
 
 
 class DraggableVLine():
-    """A draggable vertical line in the plot."""
+    """A draggable vertical line in the plot. While dragging, the line
+    and the artists from get_preview_artists() are blitted onto a cached
+    background, at most rate times per second."""
     lock = None
+    rate = 60
+
     def __init__(self, line):
         self.line = line
         self.press = None
         self.background = None
+        self.animated = []
+        self.timer = None
 
         self.connect()
 
@@ -338,49 +349,271 @@ class DraggableVLine():
         self.line.figure.canvas.mpl_disconnect(self.cidrelease)
         self.line.figure.canvas.mpl_disconnect(self.cidmotion)
 
+    def get_preview_artists(self):
+        """Returns artists that change while dragging, see
+        update_preview."""
+        # pylint: disable=no-self-use
+        return []
+
+    def update_preview(self, xdata):
+        """Updates the artists from get_preview_artists for the line
+        position xdata."""
+
     def on_press(self, event):
         """When the mouse button is pressed."""
         if event.inaxes != self.line.axes:
             return
-        if self.lock is not None:
+        if DraggableVLine.lock is not None:
             return
         if not self.line.contains(event)[0]:
             return
 
         self.press = self.line.get_xdata(), event.xdata, event.ydata
-        self.lock = self
-
-        self.line.set_animated(True)
-        self.line.figure.canvas.draw()
-        self.background = self.line.figure.canvas.copy_from_bbox(
-            self.line.axes.bbox)
-        self.line.axes.draw_artist(self.line)
-        self.line.figure.canvas.blit(self.line.axes.bbox)
+        DraggableVLine.lock = self
+
+        self.animated = [self.line] + [
+            artist for artist in self.get_preview_artists()
+            if artist is not None]
+        for artist in self.animated:
+            artist.set_animated(True)
+        canvas = self.line.figure.canvas
+        # the only full draw while dragging: the background without the
+        # animated artists
+        canvas.draw()
+        self.background = canvas.copy_from_bbox(self.line.axes.bbox)
+        self.blit()
 
     def on_release(self, _event):
         """When the mouse button is released."""
-        if self.lock is not self:
+        if DraggableVLine.lock is not self:
             return
 
+        if self.timer is not None:
+            self.timer.stop()
+            self.timer = None
         self.press = None
-        self.lock = None
+        DraggableVLine.lock = None
 
-        self.line.set_animated(False)
+        for artist in self.animated:
+            artist.set_animated(False)
+        self.animated = []
         self.background = None
-        self.line.figure.canvas.draw()
+        self.line.figure.canvas.draw_idle()
 
     def on_motion(self, event):
-        """When the mouse is moved in pressed state."""
-        if self.lock is not self:
+        """When the mouse is moved in pressed state, the line is moved
+        and the blitting is scheduled."""
+        if DraggableVLine.lock is not self:
             return
         if event.inaxes != self.line.axes:
             return
 
         xdata, xpress, _ = self.press
-        self.line.set_xdata(xdata)
         xdiff = event.xdata - xpress
-        self.line.set_xdata([self.line.get_xdata()[0] + xdiff] * 2)
-
-        self.line.figure.canvas.restore_region(self.background)
-        self.line.axes.draw_artist(self.line)
-        self.line.figure.canvas.blit(self.line.axes.bbox)
+        self.line.set_xdata([xdata[0] + xdiff] * 2)
+        if self.timer is None:
+            self.timer = self.line.figure.canvas.new_timer(
+                interval=int(1000 / self.rate))
+            self.timer.single_shot = True
+            self.timer.add_callback(self.on_timer)
+            self.timer.start()
+
+    def on_timer(self):
+        """Blits the latest state, called by the throttling timer."""
+        self.timer = None
+        if DraggableVLine.lock is self and self.background is not None:
+            self.blit()
+
+    def blit(self):
+        """Restores the background and draws the animated artists."""
+        canvas = self.line.figure.canvas
+        self.update_preview(self.line.get_xdata()[0])
+        canvas.restore_region(self.background)
+        for artist in self.animated:
+            self.line.axes.draw_artist(artist)
+        canvas.blit(self.line.axes.bbox)
+
+
+class MinMaxPyramid():
+    """Level-of-detail data for a line: level k holds the indices of the
+    minimum and maximum of every block of 2**k points. decimate() reduces
+    the line to the first, minimal, maximal and last point of every pixel
+    column, so every column covers the same y range as with the full
+    data. Blocks that straddle a column border are split into their
+    halves until they fit into one column."""
+    def __init__(self, xdata, ydata):
+        xdata = np.asarray(xdata, dtype=float)
+        ydata = np.asarray(ydata, dtype=float)
+        if xdata.size > 1 and xdata[0] > xdata[-1]:
+            xdata, ydata = xdata[::-1], ydata[::-1]
+        self.xdata = xdata
+        self.ydata = ydata
+        self.imin = []
+        self.imax = []
+        imin = imax = np.arange(len(ydata))
+        while len(imin) > 1:
+            imin = self.merge(imin, np.less_equal)
+            imax = self.merge(imax, np.greater_equal)
+            self.imin.append(imin)
+            self.imax.append(imax)
+
+    def merge(self, indices, compare):
+        """Merges neighbouring blocks, keeps the index of the point that
+        wins the comparison."""
+        even = len(indices) // 2 * 2
+        left, right = indices[0:even:2], indices[1:even:2]
+        merged = np.where(compare(self.ydata[left], self.ydata[right]),
+                          left, right)
+        if even < len(indices):
+            merged = np.append(merged, indices[-1])
+        return merged
+
+    @staticmethod
+    def get_columns(xdata, xmin, xmax, ncols):
+        """Returns the pixel column of every x value, -1 and ncols for
+        values left and right of the range."""
+        return np.clip(np.floor((xdata - xmin) / (xmax - xmin) * ncols),
+                       -1, ncols).astype(int)
+
+    def decimate(self, xmin, xmax, ncols):
+        """Returns x and y data for the range xmin..xmax drawn ncols
+        pixels wide."""
+        # pylint: disable=too-many-locals
+        ncols = max(int(ncols), 1)
+        length = len(self.xdata)
+        low, high = np.searchsorted(self.xdata, sorted((xmin, xmax)))
+        # one point beyond the limits so that lines leave the view
+        low, high = max(low - 1, 0), min(high + 1, length)
+        if high - low <= 4 * ncols or not self.imin or xmin == xmax:
+            return self.xdata[low:high], self.ydata[low:high]
+
+        xmin, xmax = sorted((xmin, xmax))
+        level = min(int(np.log2((high - low) / (2 * ncols))),
+                    len(self.imin))
+        blocks = np.arange(low >> level, -(-high >> level))
+        pieces = []
+        while blocks.size:
+            starts = blocks << level
+            ends = np.minimum(starts + (1 << level), length) - 1
+            cols = self.get_columns(self.xdata[starts], xmin, xmax, ncols)
+            inside = cols == self.get_columns(
+                self.xdata[ends], xmin, xmax, ncols)
+            if level:
+                imin = self.imin[level - 1][blocks[inside]]
+                imax = self.imax[level - 1][blocks[inside]]
+            else:
+                imin = imax = blocks[inside]
+            pieces.append((starts[inside], ends[inside], imin, imax,
+                           cols[inside]))
+            # blocks across a column border are split into their halves
+            level -= 1
+            blocks = (2 * blocks[~inside, np.newaxis] + (0, 1)).ravel()
+            blocks = blocks[(blocks << level) < length]
+        starts, ends, imin, imax, cols = (
+            np.concatenate(arrays) for arrays in zip(*pieces))
+        order = np.argsort(starts)
+        starts, ends, imin, imax, cols = (
+            starts[order], ends[order], imin[order], imax[order],
+            cols[order])
+
+        firsts = np.flatnonzero(np.diff(cols, prepend=cols[0] - 1))
+        lasts = np.append(firsts[1:], len(cols)) - 1
+        colmin = imin[np.lexsort((self.ydata[imin], cols))[firsts]]
+        colmax = imax[np.lexsort((-self.ydata[imax], cols))[firsts]]
+        idx = np.unique(np.concatenate((
+            starts[firsts], colmin, colmax, ends[lasts])))
+        idx = idx[(idx >= low) & (idx < high)]
+        return self.xdata[idx], self.ydata[idx]
+
+
+def decimate_rows(xdata, ydata, xmin, xmax, ncols):
+    """Decimates several lines at once that share the x values xdata, ydata
+    has one row per line. Only minimum and maximum of every pixel column
+    are kept, alternately in the order min, max and max, min: the zigzag
+    covers the range of every column with two points instead of four, and
+    all rows share the same x values. Returns x (n, ) and y (rows, n) for
+    the range xmin..xmax drawn ncols pixels wide."""
+    xdata = np.asarray(xdata, dtype=float)
+    ydata = np.atleast_2d(np.asarray(ydata, dtype=float))
+    if xdata.size > 1 and xdata[0] > xdata[-1]:
+        xdata, ydata = xdata[::-1], ydata[:, ::-1]
+    ncols = max(int(ncols), 1)
+    xmin, xmax = sorted((xmin, xmax))
+    low, high = np.searchsorted(xdata, (xmin, xmax))
+    # one point beyond the limits so that lines leave the view
+    low, high = max(low - 1, 0), min(high + 1, len(xdata))
+    if high - low <= 2 * ncols or xmin == xmax:
+        return xdata[low:high], ydata[:, low:high]
+
+    xdata, ydata = xdata[low:high], ydata[:, low:high]
+    cols = np.clip(np.floor((xdata - xmin) / (xmax - xmin) * ncols),
+                   -1, ncols)
+    firsts = np.flatnonzero(np.diff(cols, prepend=cols[0] - 1))
+    lasts = np.append(firsts[1:], len(cols)) - 1
+    colmin = np.minimum.reduceat(ydata, firsts, axis=1)
+    colmax = np.maximum.reduceat(ydata, firsts, axis=1)
+    odd = np.arange(len(firsts)) % 2 == 1
+    colmin[:, odd], colmax[:, odd] = colmax[:, odd], colmin[:, odd]
+    xout = np.stack((xdata[firsts], xdata[lasts]), axis=1).ravel()
+    yout = np.stack((colmin, colmax), axis=2).reshape(len(ydata), -1)
+    return xout, yout
+
+
+class ImagePyramid():
+    """Level-of-detail data for an image: level (kx, ky) averages blocks of
+    2**ky rows and 2**kx columns, nan is ignored. Levels are calculated
+    from their finer neighbours when first needed. get_view() returns the
+    coarsest level that still has an image pixel per screen pixel,
+    cropped to the visible part."""
+    def __init__(self, data):
+        self.data = np.atleast_2d(np.asarray(data, dtype=float))
+        self.levels = {(0, 0): self.data}
+        self.maxlevel = tuple(
+            max(int(np.ceil(np.log2(size))), 0)
+            for size in self.data.shape[::-1])
+
+    @staticmethod
+    def reduce(data, axis):
+        """Averages neighbouring pairs along axis, nan is ignored."""
+        if data.shape[axis] % 2:
+            padding = [(0, 0), (0, 0)]
+            padding[axis] = (0, 1)
+            data = np.pad(data, padding, constant_values=np.nan)
+        first = data[::2] if axis == 0 else data[:, ::2]
+        second = data[1::2] if axis == 0 else data[:, 1::2]
+        return np.where(np.isnan(first), second, np.where(
+            np.isnan(second), first, (first + second) / 2))
+
+    def get_level(self, kx, ky):
+        """Returns level (kx, ky)."""
+        if (kx, ky) not in self.levels:
+            if kx > 0:
+                self.levels[(kx, ky)] = self.reduce(
+                    self.get_level(kx - 1, ky), axis=1)
+            else:
+                self.levels[(kx, ky)] = self.reduce(
+                    self.get_level(kx, ky - 1), axis=0)
+        return self.levels[(kx, ky)]
+
+    def get_view(self, xmin, xmax, ymin, ymax, ncols, nrows):
+        """Returns the image part for columns xmin..xmax and rows
+        ymin..ymax (indices of the full image, may be fractional) drawn
+        ncols x nrows pixels, and the column and row range of the full
+        image it covers as (col1, col2, row1, row2)."""
+        levels = []
+        for vmin, vmax, npixels, maxlevel in (
+                (xmin, xmax, ncols, self.maxlevel[0]),
+                (ymin, ymax, nrows, self.maxlevel[1])):
+            ratio = (vmax - vmin) / max(npixels, 1)
+            levels.append(min(int(np.log2(max(ratio, 1))), maxlevel))
+        kx, ky = levels
+        data = self.get_level(kx, ky)
+        sizex, sizey = 2 ** kx, 2 ** ky
+        col1 = min(max(int(np.floor(xmin / sizex)), 0), data.shape[1] - 1)
+        col2 = min(int(np.ceil(xmax / sizex)) + 1, data.shape[1])
+        row1 = min(max(int(np.floor(ymin / sizey)), 0), data.shape[0] - 1)
+        row2 = min(int(np.ceil(ymax / sizey)) + 1, data.shape[0])
+        col2, row2 = max(col2, col1 + 1), max(row2, row1 + 1)
+        return data[row1:row2, col1:col2], (
+            col1 * sizex, min(col2 * sizex, self.data.shape[1]),
+            row1 * sizey, min(row2 * sizey, self.data.shape[0]))
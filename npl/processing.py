@@ -6,10 +6,12 @@ from lmfit.models import PseudoVoigtModel
 
 
 def calculate_background(bgtype, energy, intensity):
-    """Returns background subtracted intensity."""
+    """Returns background subtracted intensity. intensity can also be a
+    2D array with one spectrum per row."""
     # pylint: disable=unsubscriptable-object
     if bgtype == "linear":
-        background = np.linspace(intensity[0], intensity[-1], len(energy))
+        background = np.linspace(
+            intensity[..., 0], intensity[..., -1], len(energy), axis=-1)
     elif bgtype == "shirley":
         background = shirley(energy, intensity)
     else:
@@ -18,53 +20,115 @@ def calculate_background(bgtype, energy, intensity):
 
 
 def shirley(energy, intensity, tol=1e-5, maxit=20):
-    """Calculates shirley background."""
+    """Calculates shirley background, works on the last axis of
+    intensity. Rows that converged are left unchanged while the others
+    keep iterating."""
     if energy[0] < energy[-1]:
         is_reversed = True
         energy = energy[::-1]
-        intensity = intensity[::-1]
+        intensity = intensity[..., ::-1]
     else:
         is_reversed = False
 
-    background = np.ones(energy.shape) * intensity[-1]
-    integral = np.zeros(energy.shape)
+    first, last = intensity[..., :1], intensity[..., -1:]
+    background = np.ones(intensity.shape) * last
     spacing = (energy[-1] - energy[0]) / (len(energy) - 1)
-
-    subtracted = intensity - background
-    ysum = subtracted.sum() - np.cumsum(subtracted)
-    for i in range(len(energy)):
-        integral[i] = spacing * (ysum[i] - 0.5
-                                 * (subtracted[i] + subtracted[-1]))
+    converged = np.zeros(intensity.shape[:-1], dtype=bool)
 
     iteration = 0
     while iteration < maxit:
         subtracted = intensity - background
-        integral = spacing * (subtracted.sum() - np.cumsum(subtracted))
-        bnew = ((intensity[0] - intensity[-1])
-                * integral / integral[0] + intensity[-1])
-        if np.linalg.norm((bnew - background) / intensity[0]) < tol:
-            background = bnew.copy()
+        integral = spacing * (subtracted.sum(axis=-1, keepdims=True)
+                              - np.cumsum(subtracted, axis=-1))
+        bnew = (first - last) * integral / integral[..., :1] + last
+        delta = np.linalg.norm((bnew - background) / first, axis=-1)
+        background = np.where(converged[..., np.newaxis], background, bnew)
+        converged = converged | (delta < tol)
+        if converged.all():
             break
-        else:
-            background = bnew.copy()
         iteration += 1
     if iteration >= maxit:
         print("shirley: Max iterations exceeded before convergence.")
 
     if is_reversed:
-        return background[::-1]
+        return background[..., ::-1]
     return background
 
 def moving_average(intensity, interval=20):
-    """Smoothed intensity."""
+    """Smoothed intensity, works on the last axis."""
+    intensity = np.asarray(intensity)
     odd = int(interval / 2) * 2 + 1
     even = int(interval / 2) * 2
-    cumsum = np.cumsum(np.insert(intensity, 0, 0))
-    avged = (cumsum[odd:] - cumsum[:-odd]) / odd
-    for _ in range(int(even / 2)):
-        avged = np.insert(avged, 0, avged[0])
-        avged = np.insert(avged, -1, avged[-1])
-    return avged
+    zeros = np.zeros(intensity.shape[:-1] + (1, ))
+    cumsum = np.cumsum(np.concatenate((zeros, intensity), axis=-1), axis=-1)
+    avged = (cumsum[..., odd:] - cumsum[..., :-odd]) / odd
+    padding = [(0, 0)] * (avged.ndim - 1) + [(even // 2, even // 2)]
+    return np.pad(avged, padding, mode="edge")
+
+def get_common_grid(energies):
+    """Returns an energy grid covering the range that all energies have in
+    common, with the finest step among them and the direction of the
+    first one."""
+    emin = max(np.min(energy) for energy in energies)
+    emax = min(np.max(energy) for energy in energies)
+    if emin >= emax:
+        raise ValueError("Spectra have no common energy range")
+    step = min(np.median(np.abs(np.diff(energy))) for energy in energies)
+    grid = np.linspace(emin, emax, int(round((emax - emin) / step)) + 1)
+    if energies[0][0] > energies[0][-1]:
+        return grid[::-1]
+    return grid
+
+def resample(energies, intensities, energy):
+    """Linearly interpolates many spectra (sequences of 1D arrays, lengths
+    may differ) onto one energy grid at once. Returns an array with one
+    row per spectrum, nan outside of the range of a spectrum."""
+    # pylint: disable=too-many-locals
+    energy = np.asarray(energy, dtype=float)
+    if len(energies) > 1 and all(row is energies[0] for row in energies):
+        return resample_shared(energies[0], intensities, energy)
+    lengths = np.array([len(row) for row in energies])
+    row = np.repeat(np.arange(len(lengths)), lengths)
+    flat_energy = np.concatenate(energies).astype(float)
+    flat_intensity = np.concatenate(intensities).astype(float)
+    order = np.lexsort((flat_energy, row))
+    flat_energy, flat_intensity = flat_energy[order], flat_intensity[order]
+
+    # shift the rows apart so that a single searchsorted finds the
+    # neighbours in all rows
+    lowest = min(flat_energy.min(), energy.min())
+    width = max(flat_energy.max(), energy.max()) - lowest + 1
+    offsets = np.arange(len(lengths)) * width
+    targets = (energy - lowest) + offsets[:, np.newaxis]
+    idx = np.searchsorted(flat_energy - lowest + offsets[row], targets)
+    starts = np.cumsum(lengths) - lengths
+    ends = starts + lengths
+    idx = np.clip(idx, starts[:, np.newaxis] + 1, ends[:, np.newaxis] - 1)
+
+    left, right = flat_energy[idx - 1], flat_energy[idx]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        weight = np.where(right > left, (energy - left) / (right - left), 0)
+    resampled = (flat_intensity[idx - 1]
+                 + weight * (flat_intensity[idx] - flat_intensity[idx - 1]))
+    inside = ((energy >= flat_energy[starts, np.newaxis])
+              & (energy <= flat_energy[ends - 1, np.newaxis]))
+    return np.where(inside, resampled, np.nan)
+
+def resample_shared(energies, intensities, energy):
+    """Like resample for spectra that all share one energies array, the
+    neighbours are only searched once."""
+    energies = np.asarray(energies, dtype=float)
+    order = np.argsort(energies, kind="stable")
+    energies = energies[order]
+    intensities = np.asarray(intensities, dtype=float)[:, order]
+    idx = np.clip(np.searchsorted(energies, energy), 1, len(energies) - 1)
+    left, right = energies[idx - 1], energies[idx]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        weight = np.where(right > left, (energy - left) / (right - left), 0)
+    resampled = (intensities[:, idx - 1]
+                 + weight * (intensities[:, idx] - intensities[:, idx - 1]))
+    inside = (energy >= energies[0]) & (energy <= energies[-1])
+    return np.where(inside, resampled, np.nan)
 
 def get_energy_at_maximum(energy, intensity, span):
     """Calibrate energy axis."""
@@ -75,17 +139,62 @@ def get_energy_at_maximum(energy, intensity, span):
     maxen = energy[maxidx]
     return maxen
 
+def find_peaks(energy, intensity, width=10, min_prominence=0.02,
+               smoothness=4):
+    """Returns energies and prominences of the peaks in a (survey)
+    spectrum. Peaks are local maxima of the smoothed intensity that rise by
+    at least min_prominence (fraction of the intensity range) above the
+    minima within width eV on both sides."""
+    smoothed = moving_average(intensity, smoothness)
+    spacing = abs(energy[-1] - energy[0]) / (len(energy) - 1)
+    npoints = max(2, int(width / spacing))
+    padded = np.pad(smoothed, npoints, mode="edge")
+    windows = np.lib.stride_tricks.sliding_window_view(padded, npoints)
+    left_min = windows[:len(smoothed)].min(axis=1)
+    right_min = windows[npoints + 1:npoints + 1 + len(smoothed)].min(axis=1)
+    prominence = smoothed - np.maximum(left_min, right_min)
+
+    is_max = np.zeros(len(smoothed), dtype=bool)
+    is_max[1:-1] = ((smoothed[1:-1] > smoothed[:-2])
+                    & (smoothed[1:-1] >= smoothed[2:]))
+    threshold = min_prominence * (smoothed.max() - smoothed.min())
+    is_peak = is_max & (prominence > threshold)
+    return energy[is_peak], prominence[is_peak]
+
 def normalize(intensity, norm):
-    """Normalize intensity."""
+    """Normalize intensity (each row of a 2D array to its own maximum)."""
     if not norm:
         return intensity
     if isinstance(norm, (int, float)) and norm != 1:
         normto = norm
     else:
-        normto = max(intensity)
+        normto = np.max(intensity, axis=-1, keepdims=True)
     return intensity / normto
 
 
+def make_model(model_name, prefix):
+    """Returns a new lmfit model for a peak."""
+    if model_name == "PseudoVoigt":
+        model = PseudoVoigtModel(prefix=prefix)
+        model.set_param_hint("sigma", value=2, min=1e-5, max=5)
+        model.set_param_hint("amplitude", value=2000, min=0)
+        model.set_param_hint("fraction", vary=False)
+        return model
+    raise ValueError("Unknown peak model {}".format(model_name))
+
+
+def fit_models(specs, params, energy, intensity):
+    """Fits the sum of the models given by specs [(model_name, prefix)]
+    to intensity and returns the fitted Parameters. Models are built here
+    because composite models can not be pickled, so this can run in
+    another thread or process."""
+    models = [make_model(model_name, prefix) for (model_name, prefix) in specs]
+    total = models[0]
+    for model in models[1:]:
+        total += model
+    return total.fit(intensity, params, x=energy).params
+
+
 class RegionFitModelIface(object):
     """This manages the Peak models and does the fitting."""
     # pylint: disable=invalid-name
@@ -110,12 +219,8 @@ class RegionFitModelIface(object):
         if peak.region is not self.region:
             raise ValueError("Peak does not belong to this Region")
 
-        if peak.model_name == "PseudoVoigt":
-            model = PseudoVoigtModel(prefix=peak.prefix)
-            model.set_param_hint("sigma", value=2, min=1e-5, max=5)
-            model.set_param_hint("amplitude", value=2000, min=0)
-            model.set_param_hint("fraction", vary=False)
-        self.single_models[peak.prefix] = model
+        self.single_models[peak.prefix] = make_model(
+            peak.model_name, peak.prefix)
 
     def remove_peak(self, peak):
         """Removes a Peak from the model and instantiates a new
@@ -150,34 +255,52 @@ class RegionFitModelIface(object):
             self.params += params
 
     def fit(self):
-        """Returns the fitted intensity values."""
-        if not self.single_models:
+        """Fits the peaks to the region."""
+        args = self.get_fit_args()
+        if args is None:
             return
+        self.set_fit_result(fit_models(*args))
+
+    def get_fit_args(self):
+        """Returns the arguments for fit_models, None if there is nothing
+        to fit."""
+        if not self.single_models:
+            return None
+        specs = [(peak.model_name, peak.prefix) for peak in self.region.peaks
+                 if peak.prefix in self.single_models]
         y = self.region.intensity - self.region.background
-        result = self.total_model.fit(y, self.params, x=self.region.energy)
-        self.params = result.params
+        return specs, self.params, self.region.energy, y
+
+    def set_fit_result(self, params):
+        """Takes the Parameters from fit_models and updates the peaks."""
+        self.params = params
 
         for peak in self.region.peaks:
             if peak.model_name == "PseudoVoigt":
                 amp = self.params["{}amplitude".format(peak.prefix)].value
                 sigma = self.params["{}sigma".format(peak.prefix)].value
                 center = self.params["{}center".format(peak.prefix)].value
-                peak.set(fwhm=sigma * 2)
-                peak.set(area=amp)
-                peak.set(center=center)
+                peak.set(fwhm=sigma * 2, area=amp, center=center)
 
         # print(result.fit_report())
 
-    def get_peak_intensity(self, peak):
-        """Returns the model evaluation value for a given Peak."""
+    def get_peak_intensity(self, peak, energy=None):
+        """Returns the model evaluation value for a given Peak (at the
+        region energies by default)."""
+        if energy is None:
+            energy = self.region.energy
         model = self.single_models[peak.prefix]
-        return model.eval(params=self.params, x=self.region.energy)
+        return model.eval(params=self.params, x=energy)
 
-    def get_intensity(self):
-        """Returns overall fit result."""
-        if not self.total_model:
+    def get_intensity(self, energy=None):
+        """Returns overall fit result (at the region energies by
+        default)."""
+        total_model = self.total_model
+        if not total_model:
             return None
-        return self.total_model.eval(params=self.params, x=self.region.energy)
+        if energy is None:
+            energy = self.region.energy
+        return total_model.eval(params=self.params, x=energy)
 
     def add_constraint(self, peak, attr, **kwargs):
         """Adds a constraint to a Peak parameter."""
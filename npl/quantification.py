@@ -0,0 +1,129 @@
+"""Provides quantification of fitted peak areas: peaks are mapped to lines
+in the rsf library, their areas are corrected for RSF, pass energy,
+acquisition time and analyzer transmission, and atomic concentrations
+are computed."""
+
+import numpy as np
+
+
+def default_transmission(kinetic_energy, passenergy):
+    """Analyzer transmission for fixed analyzer transmission mode:
+    T ~ E_pass / sqrt(E_kin)."""
+    return passenergy / np.sqrt(kinetic_energy)
+
+
+class Quantifier():
+    """Computes atomic concentrations for many spectra at once. Peaks are
+    assigned to library lines either by name (e.g. a peak named "C 1s") or
+    by the strongest core level within tolerance of the peak center.
+    Assignments are cached per peak sid and looked up again when name or
+    center of the peak changed."""
+    def __init__(self, rsfhandler, source="Al", tolerance=1.5,
+                 transmission=default_transmission):
+        self.rsfhandler = rsfhandler
+        self.source = source
+        self.tolerance = tolerance
+        self.transmission = transmission
+        self._names = None
+        self._lines = {}
+
+    @property
+    def names(self):
+        """Lookup table {lowercase line name: (element, line name, RSF)} of
+        all core levels with a non-zero RSF."""
+        if self._names is None:
+            table = self.rsfhandler.tables[self.source]
+            table = table[~table["is_auger"] & (table["RSF"] > 0)]
+            self._names = dict(
+                (str(fullname).lower(),
+                 (str(element), str(fullname), float(rsf)))
+                for element, fullname, rsf in zip(
+                    table["element"], table["fullname"], table["RSF"]))
+        return self._names
+
+    def get_line(self, peak):
+        """Returns (element, line name, RSF) for a Peak or None if no line
+        fits."""
+        key = (peak.name, peak.center)
+        cached = self._lines.get(peak.sid, None)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        line = self.names.get(str(peak.name).strip().lower(), None)
+        if line is None and peak.center is not None:
+            lines = self.rsfhandler.get_lines_near(
+                peak.center, self.tolerance, self.source)
+            lines = lines[~lines["is_auger"] & (lines["RSF"] > 0)]
+            if lines.size:
+                line = (str(lines["element"][0]), str(lines["fullname"][0]),
+                        float(lines["RSF"][0]))
+        self._lines[peak.sid] = (key, line)
+        return line
+
+    def quantify(self, spectra, groups=None):
+        """Returns (group names, elements, atomic percentages) where the
+        atomic percentages are an array of shape (n_groups, n_elements).
+        groups is a list with one group name per spectrum, by default
+        every spectrum is its own group (named by its name). Peak areas
+        of an element are summed and divided by the summed RSF of the
+        distinct lines they belong to, so spin-orbit doublets and
+        chemical states are handled alike."""
+        # pylint: disable=too-many-locals
+        if groups is None:
+            groups = [spectrum.name for spectrum in spectra]
+        group_names, group_codes = np.unique(
+            np.array(groups, dtype=str), return_inverse=True)
+        k_alpha = self.rsfhandler.k_alpha[self.source]
+
+        rows = []
+        for spectrum, group in zip(spectra, group_codes):
+            timing = self.to_float(spectrum.sweeps) * self.to_float(
+                spectrum.dwelltime)
+            passenergy = self.to_float(spectrum.passenergy)
+            for region in spectrum.regions:
+                for peak in region.peaks:
+                    line = self.get_line(peak)
+                    if line is None or peak.area is None:
+                        continue
+                    rows.append((group, line[0], line[1], line[2],
+                                 peak.area, peak.center, timing, passenergy))
+        if not rows:
+            return ([str(name) for name in group_names], [],
+                    np.zeros((len(group_names), 0)))
+
+        (group, element, fullname, rsf, area, center, timing,
+         passenergy) = [np.array(column) for column in zip(*rows)]
+        group = group.astype(int)
+        rsf, area, center, timing, passenergy = [
+            column.astype(float)
+            for column in (rsf, area, center, timing, passenergy)]
+        timing[~(timing > 0)] = 1
+        passenergy[~(passenergy > 0)] = 1
+
+        transmission = self.transmission(k_alpha - center, passenergy)
+        corrected = area / (timing * transmission)
+
+        elements, element_codes = np.unique(element, return_inverse=True)
+        shape = (len(group_names), len(elements))
+        cell = np.ravel_multi_index((group, element_codes), shape)
+        areas = np.bincount(cell, corrected, np.prod(shape))
+
+        _lines, first = np.unique(
+            np.char.add(cell.astype(str), np.char.add("|", fullname)),
+            return_index=True)
+        rsf_sums = np.bincount(cell[first], rsf[first], np.prod(shape))
+
+        amounts = np.where(rsf_sums > 0, areas / np.maximum(rsf_sums, 1e-12),
+                           0).reshape(shape)
+        totals = amounts.sum(axis=1, keepdims=True)
+        atomic_percent = np.where(
+            totals > 0, 100 * amounts / np.maximum(totals, 1e-12), 0)
+        return ([str(name) for name in group_names],
+                [str(element) for element in elements], atomic_percent)
+
+    @staticmethod
+    def to_float(value):
+        """Converts metadata to float, 0 if impossible."""
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return 0.
@@ -0,0 +1,248 @@
+"""Spectra sharing an energy grid are processed as rows of one
+SpectrumMatrix, signals are collected in batches, spectra are combined
+on a common grid."""
+
+import unittest
+
+import numpy as np
+
+from npl.containers import (
+    Spectrum, SpectrumContainer, combine_spectra)
+from npl.processing import resample
+
+
+def make_spectra(number, seed=0):
+    """Returns spectra on one grid with a region each."""
+    rng = np.random.default_rng(seed)
+    energy = np.linspace(280, 300, 201)
+    spectra = []
+    for _i in range(number):
+        intensity = (100 * np.exp(-(energy - 290 - rng.normal()) ** 2)
+                     + 10 + rng.random(energy.size))
+        spectrum = Spectrum(energy=energy, intensity=intensity)
+        spectrum.add_region(emin=284, emax=296, bgtype="linear")
+        spectra.append(spectrum)
+    return spectra
+
+
+class SpectrumMatrixTest(unittest.TestCase):
+    """Compares set_spectra on a matrix with Spectrum.set one by one."""
+    def setUp(self):
+        self.container = SpectrumContainer()
+        self.container.extend(make_spectra(6))
+        self.reference = make_spectra(6)
+
+    def assert_same(self, spectra, reference):
+        """Energies, intensities and backgrounds are equal."""
+        for spectrum, other in zip(spectra, reference):
+            np.testing.assert_allclose(spectrum.energy, other.energy)
+            np.testing.assert_allclose(spectrum.intensity, other.intensity)
+            np.testing.assert_allclose(spectrum.regions[0].background,
+                                       other.regions[0].background)
+
+    def test_rows(self):
+        """All spectra are rows of one matrix."""
+        # pylint: disable=protected-access
+        self.assertEqual(len(self.container.matrices), 1)
+        matrix = list(self.container.matrices.values())[0]
+        self.assertEqual(len(matrix), 6)
+        for spectrum in self.container:
+            self.assertTrue(np.shares_memory(spectrum._intensity, matrix.raw))
+            self.assertIs(spectrum.energy, matrix.energy)
+
+    def test_set_spectra(self):
+        """Single and per spectrum values give the results of
+        Spectrum.set."""
+        values = dict(calibration=[0, 0.5, 0.5, 1, 0, 0],
+                      smoothness=[0, 4, 4, 2, 0, 8], norm=1)
+        self.container.set_spectra(self.container, **values)
+        for i, spectrum in enumerate(self.reference):
+            spectrum.set(calibration=values["calibration"][i],
+                         smoothness=values["smoothness"][i], norm=1)
+        self.assert_same(self.container, self.reference)
+        self.assertEqual([spectrum.smoothness for spectrum in self.container],
+                         values["smoothness"])
+
+    def test_signals(self):
+        """set_spectra emits one batch with a change per spectrum."""
+        signals = []
+        self.container.subscribe(
+            lambda keyword, obj, **kwargs: signals.append((keyword, kwargs)))
+        self.container.set_spectra(self.container[:3], smoothness=4)
+        self.assertEqual(len(signals), 1)
+        keyword, kwargs = signals[0]
+        self.assertEqual(keyword, "batch")
+        changed = [obj for (keyword, obj, _kwargs) in kwargs["events"]
+                   if keyword == "changed_spectrum"]
+        self.assertEqual(changed, self.container[:3])
+
+    def test_remove_and_compact(self):
+        """Removed spectra keep their data, the remaining rows survive
+        the compaction of the matrix."""
+        # pylint: disable=protected-access
+        removed = [self.container[i] for i in range(4)]
+        intensities = [spectrum.intensity.copy() for spectrum in removed]
+        for spectrum in removed:
+            self.container.remove(spectrum)
+        matrix = list(self.container.matrices.values())[0]
+        self.assertEqual(matrix.raw.shape[0], 2)
+        for spectrum, intensity in zip(removed, intensities):
+            self.assertFalse(np.shares_memory(spectrum._intensity,
+                                              matrix.raw))
+            np.testing.assert_array_equal(spectrum.intensity, intensity)
+        self.container.set_spectra(self.container, smoothness=4)
+        for spectrum in self.reference[4:]:
+            spectrum.set(smoothness=4)
+        self.assert_same(self.container, self.reference[4:])
+
+    def test_outdated_job(self):
+        """A job prepared before the spectrum changed is not applied."""
+        job, = self.container.prepare_spectra(self.container, smoothness=4)
+        matrix = list(self.container.matrices.values())[0]
+        matrix.compute(job)
+        self.container[0].set(calibration=1)
+        self.assertFalse(matrix.apply(job))
+        self.assertEqual(self.container[1].smoothness, 0)
+
+    def test_other_grid(self):
+        """Spectra on other grids get their own matrix, set_spectra still
+        handles them."""
+        energy = np.linspace(0, 10, 11)
+        other = Spectrum(energy=energy, intensity=energy ** 2)
+        self.container.append(other)
+        self.assertEqual(len(self.container.matrices), 2)
+        self.container.set_spectra([self.container[0], other], norm=1)
+        np.testing.assert_allclose(other.intensity, energy ** 2 / 100)
+
+
+class BatchTest(unittest.TestCase):
+    """Signals inside SpectrumContainer.batch()."""
+    def setUp(self):
+        self.container = SpectrumContainer()
+        self.container.extend(make_spectra(2))
+        self.signals = []
+        self.immediate = []
+        self.container.subscribe(
+            lambda keyword, obj, **kwargs:
+            self.signals.append((keyword, obj, kwargs)))
+        self.container.subscribe(
+            lambda keyword, obj, **kwargs: self.immediate.append(keyword),
+            batched=False)
+
+    def test_merge_changes(self):
+        """Changes of the same object are merged in place of the first,
+        other signals keep their order."""
+        spectrum, other = self.container
+        region = spectrum.regions[0]
+        with self.container.batch():
+            spectrum.set(notes="a")
+            region.add_peak(center=290, fwhm=1, area=10)
+            other.set(name="b")
+            spectrum.set(name="c", notes="d")
+            region.set(emin=285)
+            region.remove_peak(region.peaks[0])
+            region.set(emax=295)
+            self.assertEqual(self.signals, [])
+        self.assertEqual(len(self.signals), 1)
+        keyword, obj, kwargs = self.signals[0]
+        self.assertEqual((keyword, obj), ("batch", self.container))
+        self.assertEqual(
+            [event for event in kwargs["events"]
+             if event[0] not in ("add_peak", "remove_peak")],
+            [("changed_spectrum", spectrum, {"notes": "d", "name": "c"}),
+             ("changed_spectrum", other, {"name": "b"}),
+             ("changed_region", region, {"emin": 285, "emax": 295})])
+        self.assertEqual(
+            [keyword for (keyword, _obj, _kwargs) in kwargs["events"]],
+            ["changed_spectrum", "add_peak", "changed_spectrum",
+             "changed_region", "remove_peak"])
+        self.assertEqual(self.immediate.count("changed_spectrum"), 3)
+
+    def test_nested(self):
+        """Only the outermost batch emits."""
+        with self.container.batch():
+            with self.container.batch():
+                self.container[0].set(notes="a")
+            self.assertEqual(self.signals, [])
+        self.assertEqual(len(self.signals), 1)
+
+    def test_structural_signals(self):
+        """Structural signals flush the batch and are emitted at once."""
+        spectrum = self.container[0]
+        with self.container.batch():
+            spectrum.set(notes="a")
+            self.container.remove(spectrum)
+            self.assertEqual(
+                [keyword for (keyword, _obj, _kwargs) in self.signals],
+                ["batch", "remove_spectrum"])
+        self.assertEqual(len(self.signals), 2)
+
+
+class CombineSpectraTest(unittest.TestCase):
+    """Sum, average and subtraction of spectra."""
+    def setUp(self):
+        self.energy = np.linspace(280, 300, 201)
+        self.first = Spectrum(energy=self.energy, name="a", sweeps=1,
+                              dwelltime=1, passenergy=20,
+                              intensity=np.full(201, 1.))
+        self.second = Spectrum(energy=self.energy, name="b", sweeps=3,
+                               dwelltime=1, passenergy=20,
+                               intensity=np.linspace(0, 20, 201))
+
+    def test_same_grid(self):
+        """Sum and weighted average on the shared grid."""
+        total, = combine_spectra([self.first, self.second], "sum")
+        np.testing.assert_allclose(total.energy, self.energy)
+        np.testing.assert_allclose(total.intensity,
+                                   1 + np.linspace(0, 20, 201))
+        self.assertEqual((total.sweeps, total.passenergy), (4, 20))
+        average, = combine_spectra([self.first, self.second])
+        np.testing.assert_allclose(
+            average.intensity, (1 + 3 * np.linspace(0, 20, 201)) / 4)
+
+    def test_calibrated(self):
+        """Calibrated spectra are resampled on their common range."""
+        self.second.set(calibration=0.25)
+        total, = combine_spectra([self.first, self.second], "sum")
+        self.assertAlmostEqual(total.energy.min(), 280.25)
+        self.assertAlmostEqual(total.energy.max(), 300)
+        np.testing.assert_allclose(
+            total.intensity, 1 + np.interp(
+                total.energy, self.energy + 0.25, np.linspace(0, 20, 201)))
+
+    def test_subtract(self):
+        """Every spectrum minus the reference, the reference itself is
+        skipped."""
+        results = combine_spectra([self.first, self.second], "subtract",
+                                  reference=self.first)
+        self.assertEqual([result.name for result in results], ["b - a"])
+        np.testing.assert_allclose(results[0].intensity,
+                                   np.linspace(0, 20, 201) - 1)
+        with self.assertRaises(ValueError):
+            combine_spectra([self.first], "subtract")
+        with self.assertRaises(ValueError):
+            combine_spectra([self.first], "multiply")
+
+    def test_no_common_range(self):
+        """Spectra without overlap cannot be combined."""
+        other = Spectrum(energy=self.energy + 100, intensity=self.energy)
+        with self.assertRaises(ValueError):
+            combine_spectra([self.first, other], "sum")
+
+    def test_resample(self):
+        """resample matches np.interp for rows of different lengths and
+        directions, nan outside."""
+        energies = [np.linspace(0, 10, 11), np.linspace(12, 2, 31)]
+        intensities = [energy ** 2 for energy in energies]
+        grid = np.linspace(-1, 13, 57)
+        resampled = resample(energies, intensities, grid)
+        for row, energy, intensity in zip(resampled, energies, intensities):
+            order = np.argsort(energy)
+            inside = (grid >= energy.min()) & (grid <= energy.max())
+            np.testing.assert_allclose(row[inside], np.interp(
+                grid[inside], energy[order], intensity[order]))
+            self.assertTrue(np.all(np.isnan(row[~inside])))
+
+
+if __name__ == "__main__":
+    unittest.main()
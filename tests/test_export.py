@@ -0,0 +1,126 @@
+"""Round trip of the bulk export: the CSV and .npz files contain the same
+curves as the container."""
+
+import csv
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from npl.containers import Spectrum, SpectrumContainer
+from npl.fileio import DataExporter
+
+
+class DataExporterTest(unittest.TestCase):
+    """Exports two spectra, one with a fitted and an empty region."""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        energy = np.linspace(280, 300, 201)
+        self.container = SpectrumContainer()
+        for name, center in (("C1s", 290), ("O1s", 287)):
+            self.container.append(Spectrum(
+                energy=energy, name=name, sweeps=2, passenergy="abc",
+                intensity=100 * np.exp(-(energy - center) ** 2) + energy))
+        spectrum = self.container[0]
+        spectrum.add_region(emin=284, emax=296, bgtype="linear")
+        spectrum.add_region(emin=281, emax=283, bgtype="linear")
+        spectrum.regions[0].add_peak(center=290, fwhm=1.5, area=150)
+        spectrum.regions[0].add_peak(center=292, fwhm=1, area=20)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def expected_curves(self):
+        """Returns {(spectrum index, region, curve): intensity}."""
+        curves = {}
+        for idx, spectrum in enumerate(self.container):
+            for region, curve, _energy, intensity in (
+                    DataExporter.iter_curves(spectrum)):
+                curves[(idx, region, curve)] = intensity
+        return curves
+
+    def test_envelope_includes_background(self):
+        """Envelope and peaks are exported as plotted."""
+        region = self.container[0].regions[0]
+        curves = self.expected_curves()
+        np.testing.assert_allclose(
+            curves[(0, "Region 1", "envelope")],
+            region.fit_intensity + region.background)
+        np.testing.assert_allclose(
+            curves[(0, "Region 1", "peak A")],
+            region.peaks[0].fit_intensity + region.background)
+        self.assertNotIn((0, "Region 2", "envelope"), curves)
+
+    def test_csv(self):
+        """The CSV has one row per point and curve."""
+        fname = os.path.join(self.tmpdir, "export.csv")
+        DataExporter(self.container).export(fname)
+        with open(fname, newline="") as csvfile:
+            reader = csv.reader(csvfile)
+            self.assertEqual(next(reader), [
+                "spectrum", "name", "region", "curve", "energy",
+                "intensity"])
+            found = {}
+            for row in reader:
+                found.setdefault((int(row[0]), row[2], row[3]), []).append(
+                    float(row[5]))
+        expected = self.expected_curves()
+        self.assertEqual(set(found), set(expected))
+        for key, intensity in expected.items():
+            np.testing.assert_allclose(found[key], intensity)
+
+    def test_npz(self):
+        """Tables and data columns of the .npz bundle fit together."""
+        fname = os.path.join(self.tmpdir, "export.npz")
+        DataExporter(self.container).export(fname)
+        with np.load(fname) as bundle:
+            spectra = bundle["spectra"]
+            regions = bundle["regions"]
+            peaks = bundle["peaks"]
+            self.assertEqual(list(spectra["name"]), ["C1s", "O1s"])
+            self.assertEqual(list(spectra["sweeps"]), [2, 2])
+            self.assertTrue(np.all(np.isnan(spectra["passenergy"])))
+            for row, spectrum in zip(spectra, self.container):
+                part = slice(row["offset"], row["offset"] + row["length"])
+                np.testing.assert_allclose(
+                    bundle["energy"][part], spectrum.energy)
+                np.testing.assert_allclose(
+                    bundle["intensity"][part], spectrum.intensity)
+
+            all_regions = self.container[0].regions
+            self.assertEqual(len(regions), 2)
+            for row, region in zip(regions, all_regions):
+                part = slice(row["offset"], row["offset"] + row["length"])
+                np.testing.assert_allclose(
+                    bundle["region_energy"][part], region.energy)
+                np.testing.assert_allclose(
+                    bundle["background"][part], region.background)
+            region = all_regions[0]
+            part = slice(regions[0]["offset"],
+                         regions[0]["offset"] + regions[0]["length"])
+            np.testing.assert_allclose(
+                bundle["envelope"][part],
+                region.fit_intensity + region.background)
+            part = slice(regions[1]["offset"],
+                         regions[1]["offset"] + regions[1]["length"])
+            self.assertTrue(np.all(np.isnan(bundle["envelope"][part])))
+
+            self.assertEqual(list(peaks["name"]), ["A", "B"])
+            np.testing.assert_allclose(peaks["area"], [150, 20])
+            for row, peak in zip(peaks, region.peaks):
+                part = slice(row["offset"], row["offset"] + row["length"])
+                np.testing.assert_allclose(
+                    bundle["peak_intensity"][part],
+                    peak.fit_intensity + region.background)
+
+    def test_unknown_format(self):
+        """Other extensions are refused."""
+        with self.assertRaises(ValueError):
+            DataExporter(self.container).export(
+                os.path.join(self.tmpdir, "export.txt"))
+
+
+if __name__ == "__main__":
+    unittest.main()
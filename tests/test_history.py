@@ -0,0 +1,129 @@
+"""Undo and redo of changes to a SpectrumContainer."""
+
+import unittest
+
+import numpy as np
+
+from npl.containers import Spectrum, SpectrumContainer
+from npl.history import UndoHistory
+
+
+def make_spectrum(name):
+    """Returns a spectrum with a peak."""
+    energy = np.linspace(280, 300, 201)
+    spectrum = Spectrum(energy=energy, name=name,
+                        intensity=100 * np.exp(-(energy - 290) ** 2) + 10)
+    spectrum.add_region(emin=284, emax=296, bgtype="linear")
+    spectrum.regions[0].add_peak(center=290, fwhm=1.5, area=150)
+    return spectrum
+
+
+def get_state(container):
+    """Returns everything the history restores."""
+    return [(spectrum.sid, spectrum.name, spectrum.smoothness,
+             spectrum.calibration,
+             [(region.sid, region.emin, region.emax, region.bgtype,
+               [(peak.sid, peak.area, peak.center, peak.fwhm)
+                for peak in region.peaks])
+              for region in spectrum.regions])
+            for spectrum in container]
+
+
+class UndoHistoryTest(unittest.TestCase):
+    """Records steps, undoes all of them and redoes them again."""
+    def setUp(self):
+        self.container = SpectrumContainer()
+        self.container.append(make_spectrum("a"))
+        self.history = UndoHistory()
+        self.history.attach(self.container)
+
+    def record(self, changes):
+        """Does every change as one step and returns the states in
+        between."""
+        states = [get_state(self.container)]
+        for change in changes:
+            change()
+            states.append(get_state(self.container))
+        return states
+
+    def test_undo_redo(self):
+        """Every step is reverted and repeated exactly."""
+        spectrum = self.container[0]
+        region = spectrum.regions[0]
+
+        def batch():
+            """Changes several objects in one step."""
+            with self.container.batch():
+                spectrum.set(name="c", smoothness=4)
+                region.peaks[0].set(area=50)
+                region.set(emin=285)
+
+        states = self.record([
+            lambda: spectrum.set(calibration=0.5),
+            lambda: region.add_peak(center=292, fwhm=1, area=20),
+            batch,
+            lambda: region.remove_peak(region.peaks[0]),
+            lambda: spectrum.add_region(emin=286, emax=288),
+            lambda: self.container.append(make_spectrum("b")),
+            lambda: self.container.remove(spectrum),
+            lambda: self.container.extend(
+                [make_spectrum("d"), make_spectrum("e")]),
+            self.container.clear])
+        self.assertEqual(len(self.history.undo_steps), len(states) - 1)
+        for state in reversed(states[:-1]):
+            self.assertTrue(self.history.undo())
+            self.assertEqual(get_state(self.container), state)
+        self.assertFalse(self.history.undo())
+        for state in states[1:]:
+            self.assertTrue(self.history.redo())
+            self.assertEqual(get_state(self.container), state)
+        self.assertFalse(self.history.redo())
+
+    def test_new_step_drops_redo(self):
+        """A new change after undo cannot be redone over."""
+        self.container[0].set(name="b")
+        self.history.undo()
+        self.assertTrue(self.history.can_redo())
+        self.container[0].set(name="c")
+        self.assertFalse(self.history.can_redo())
+        self.history.undo()
+        self.assertEqual(self.container[0].name, "a")
+
+    def test_objects_come_back(self):
+        """Undo brings back the removed objects themselves instead of
+        copies."""
+        spectrum = self.container[0]
+        intensity = spectrum.intensity
+        spectrum.set(smoothness=4)
+        self.assertIsNot(spectrum.intensity, intensity)
+        self.history.undo()
+        self.container.remove(spectrum)
+        self.history.undo()
+        self.assertIs(self.container[0], spectrum)
+        self.assertEqual(spectrum.smoothness, 0)
+
+    def test_limits(self):
+        """The oldest steps are dropped beyond max_steps and max_bytes."""
+        self.history.max_steps = 3
+        for calibration in range(1, 6):
+            self.container[0].set(calibration=calibration)
+        self.assertEqual(len(self.history.undo_steps), 3)
+        self.history.max_bytes = 1
+        self.container[0].set(calibration=0)
+        self.assertEqual(len(self.history.undo_steps), 0)
+
+    def test_suspended_clear(self):
+        """Loading a project (suspended, then clear) leaves no steps."""
+        self.history.is_suspended = True
+        self.container.clear()
+        self.container.append(make_spectrum("b"))
+        self.history.is_suspended = False
+        self.history.clear()
+        self.assertFalse(self.history.can_undo())
+        self.container[0].set(name="c")
+        self.history.undo()
+        self.assertEqual(self.container[0].name, "b")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+"""Round trip of the change journal: compact into a project file, journal
+more changes, load the project and replay the journal."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from npl.containers import Spectrum, SpectrumContainer
+from npl.fileio import ChangeJournal, DBHandler
+
+
+class ChangeJournalTest(unittest.TestCase):
+    """Compacts and replays a container with regions and peaks."""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.recovery = os.path.join(self.tmpdir, "autosave.npl")
+        self.journal = ChangeJournal(
+            os.path.join(self.tmpdir, "npl.journal"),
+            recovery_fname=self.recovery)
+        self.project = os.path.join(self.tmpdir, "project.npl")
+        energy = np.linspace(280, 300, 201)
+        intensity = 100 * np.exp(-(energy - 290) ** 2) + 10
+        self.container = SpectrumContainer()
+        self.container.append(Spectrum(
+            energy=energy, intensity=intensity, name="C1s"))
+        self.journal.attach(self.container)
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.tmpdir)
+
+    def recover(self):
+        """Loads the journal base and replays the records."""
+        self.journal.flush()
+        base, _project, records = self.journal.read()
+        container = DBHandler().load(base)
+        with self.journal.suspended():
+            self.journal.replay(container, records)
+        return container
+
+    def assert_same(self, container):
+        """Compares container with self.container."""
+        self.assertEqual(len(container), len(self.container))
+        for old, new in zip(self.container, container):
+            for attr in ("calibration", "smoothness", "norm", "name"):
+                self.assertEqual(getattr(new, attr), getattr(old, attr))
+            np.testing.assert_allclose(new.energy, old.energy)
+            np.testing.assert_allclose(new.intensity, old.intensity)
+            self.assertEqual(len(new.regions), len(old.regions))
+            for old_region, new_region in zip(old.regions, new.regions):
+                for attr in ("name", "emin", "emax", "bgtype"):
+                    self.assertEqual(getattr(new_region, attr),
+                                     getattr(old_region, attr))
+                self.assertEqual(
+                    [(peak.name, peak.area, peak.fwhm, peak.center)
+                     for peak in new_region.peaks],
+                    [(peak.name, peak.area, peak.fwhm, peak.center)
+                     for peak in old_region.peaks])
+
+    def test_compact_and_replay(self):
+        """Changes before and after compaction survive a recovery."""
+        spectrum = self.container[0]
+        spectrum.set(calibration=0.5, smoothness=4)
+        spectrum.add_region(emin=284, emax=296)
+        spectrum.regions[0].set(bgtype="linear")
+        spectrum.regions[0].add_peak(center=290, fwhm=1.5, area=150)
+        self.journal.compact(self.container, self.project)
+
+        spectrum.regions[0].add_peak(center=292, fwhm=1, area=20)
+        spectrum.regions[0].set(emin=285)
+        spectrum.regions[0].peaks[0].set(area=120)
+        spectrum.set(norm=1)
+        spectrum.add_region(emin=281, emax=283)
+        self.assert_same(self.recover())
+
+    def test_snapshot_is_taken_on_compact(self):
+        """Changes after compact() do not leak into the snapshot."""
+        spectrum = self.container[0]
+        spectrum.add_region(emin=284, emax=296)
+        self.journal.compact(self.container, self.project)
+        with self.journal.suspended():
+            spectrum.regions[0].set(emin=290)
+        self.journal.flush()
+        self.assertEqual(DBHandler().load(self.project)[0].regions[0].emin,
+                         284)
+
+    def test_autosave_leaves_project_alone(self):
+        """Autosaving writes the recovery file, not the project file."""
+        spectrum = self.container[0]
+        self.journal.compact(self.container, self.project, self.project)
+        spectrum.add_region(emin=284, emax=296)
+        self.journal.autosave(self.container)
+        self.journal.flush()
+        self.assertEqual(len(DBHandler().load(self.project)[0].regions), 0)
+        self.assertEqual(len(DBHandler().load(self.recovery)[0].regions), 1)
+        self.assertEqual(self.journal.read()[:2],
+                         (self.recovery, self.project))
+        self.assertTrue(self.journal.needs_recovery())
+        self.assert_same(self.recover())
+
+    def test_needs_recovery(self):
+        """A saved project without further changes needs no recovery."""
+        self.journal.compact(self.container, self.project, self.project)
+        self.journal.flush()
+        self.assertFalse(self.journal.needs_recovery())
+        self.container[0].set(norm=1)
+        self.journal.flush()
+        self.assertTrue(self.journal.needs_recovery())
+
+
+if __name__ == "__main__":
+    unittest.main()
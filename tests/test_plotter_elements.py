@@ -0,0 +1,147 @@
+"""Level-of-detail data of the plotter: the decimated lines keep the
+extrema of every pixel column, the image pyramid averages blocks."""
+
+import unittest
+
+import numpy as np
+
+from npl.plotter_elements import (
+    MinMaxPyramid, ImagePyramid, decimate_rows)
+
+
+def column_extrema(xdata, ydata, xmin, xmax, ncols):
+    """Returns min and max of ydata in every visible pixel column, nan for
+    empty columns."""
+    cols = MinMaxPyramid.get_columns(xdata, xmin, xmax, ncols)
+    colmin = np.full(ncols, np.nan)
+    colmax = np.full(ncols, np.nan)
+    for col in range(ncols):
+        values = ydata[cols == col]
+        if values.size:
+            colmin[col], colmax[col] = values.min(), values.max()
+    return colmin, colmax
+
+
+class MinMaxPyramidTest(unittest.TestCase):
+    """Compares the decimated line with the full data."""
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.xdata = np.linspace(0, 100, 100000)
+        self.ydata = np.cumsum(rng.normal(size=self.xdata.size))
+        self.pyramid = MinMaxPyramid(self.xdata, self.ydata)
+
+    def assert_same_extrema(self, xmin, xmax, ncols):
+        """Every visible column has the extrema of the full data."""
+        xdec, ydec = self.pyramid.decimate(xmin, xmax, ncols)
+        expected = column_extrema(self.xdata, self.ydata, xmin, xmax, ncols)
+        found = column_extrema(xdec, ydec, xmin, xmax, ncols)
+        np.testing.assert_array_equal(found[0], expected[0])
+        np.testing.assert_array_equal(found[1], expected[1])
+        return xdec
+
+    def test_extrema(self):
+        """Column extrema survive for several ranges and widths."""
+        for xmin, xmax, ncols in ((10, 20, 50), (0, 100, 7), (0, 100, 640),
+                                  (33.3, 33.9, 3), (-5, 105, 101)):
+            xdec = self.assert_same_extrema(xmin, xmax, ncols)
+            self.assertLess(xdec.size, 4 * ncols + 200)
+
+    def test_leaves_view(self):
+        """The points next to the range are kept so lines leave the
+        view."""
+        xdec, _ydec = self.pyramid.decimate(10, 20, 50)
+        self.assertLess(xdec[0], 10)
+        self.assertGreater(xdec[-1], 20)
+
+    def test_descending(self):
+        """Descending x values (binding energy) are handled."""
+        pyramid = MinMaxPyramid(self.xdata[::-1], self.ydata[::-1])
+        xdec, ydec = pyramid.decimate(20, 10, 50)
+        expected = column_extrema(self.xdata, self.ydata, 10, 20, 50)
+        found = column_extrema(xdec, ydec, 10, 20, 50)
+        np.testing.assert_array_equal(found[0], expected[0])
+        np.testing.assert_array_equal(found[1], expected[1])
+
+    def test_small_data(self):
+        """Few points are returned unchanged."""
+        pyramid = MinMaxPyramid(self.xdata[:50], self.ydata[:50])
+        xdec, _ydec = pyramid.decimate(0, 1, 100)
+        np.testing.assert_array_equal(xdec, self.xdata[:50])
+
+
+class DecimateRowsTest(unittest.TestCase):
+    """Decimates several lines sharing their x values at once."""
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.xdata = np.linspace(0, 100, 20000)
+        self.ydata = np.cumsum(rng.normal(size=(5, self.xdata.size)), axis=1)
+
+    def test_extrema(self):
+        """Every row keeps min and max of every visible column."""
+        xdec, ydec = decimate_rows(self.xdata, self.ydata, 10, 60, 40)
+        self.assertEqual(ydec.shape, (5, xdec.size))
+        self.assertLessEqual(xdec.size, 2 * 42)
+        for row, row_dec in zip(self.ydata, ydec):
+            expected = column_extrema(self.xdata, row, 10, 60, 40)
+            found = column_extrema(xdec, row_dec, 10, 60, 40)
+            np.testing.assert_array_equal(found[0], expected[0])
+            np.testing.assert_array_equal(found[1], expected[1])
+
+    def test_descending(self):
+        """Descending x values are reversed, 1d data becomes one row."""
+        xdec, ydec = decimate_rows(self.xdata[::-1], self.ydata[0, ::-1],
+                                   60, 10, 40)
+        self.assertEqual(ydec.shape, (1, xdec.size))
+        self.assertTrue(np.all(np.diff(xdec) >= 0))
+
+    def test_small_data(self):
+        """Few points are returned unchanged."""
+        xdec, ydec = decimate_rows(self.xdata[:30], self.ydata[:, :30],
+                                   0, 1, 100)
+        np.testing.assert_array_equal(xdec, self.xdata[:30])
+        np.testing.assert_array_equal(ydec, self.ydata[:, :30])
+
+
+class ImagePyramidTest(unittest.TestCase):
+    """Downsampled levels and views of an image."""
+    def setUp(self):
+        rng = np.random.default_rng(2)
+        self.data = rng.random((37, 300))
+        self.pyramid = ImagePyramid(self.data)
+
+    def test_level(self):
+        """Level (1, 1) averages blocks of 2 x 2, an odd last row is
+        averaged alone."""
+        level = self.pyramid.get_level(1, 1)
+        self.assertEqual(level.shape, (19, 150))
+        np.testing.assert_allclose(
+            level[:18], self.data[:36].reshape(18, 2, 150, 2).mean(
+                axis=(1, 3)))
+        np.testing.assert_allclose(
+            level[18], self.data[36].reshape(150, 2).mean(axis=1))
+
+    def test_nan_is_ignored(self):
+        """nan does not spread into the averages."""
+        data = self.data.copy()
+        data[0, 0] = np.nan
+        level = ImagePyramid(data).get_level(1, 0)
+        self.assertEqual(level[0, 0], data[0, 1])
+
+    def test_view(self):
+        """The view has about one image pixel per screen pixel and
+        covers the requested range."""
+        view, (col1, col2, row1, row2) = self.pyramid.get_view(
+            10, 290, 0, 36, 70, 40)
+        self.assertEqual(view.shape[0], 37)
+        self.assertGreaterEqual(view.shape[1], 70)
+        self.assertLess(view.shape[1], 2 * 70 + 2)
+        self.assertLessEqual(col1, 10)
+        self.assertGreaterEqual(col2, 290)
+        self.assertEqual((row1, row2), (0, 37))
+        view, extent = self.pyramid.get_view(0, 300, 0, 37, 1000, 1000)
+        np.testing.assert_array_equal(view, self.data)
+        self.assertEqual(extent, (0, 300, 0, 37))
+
+
+if __name__ == "__main__":
+    unittest.main()
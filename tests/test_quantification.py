@@ -0,0 +1,83 @@
+"""Quantification of fitted peak areas with the RSF library shipped with
+npl."""
+
+import os
+import unittest
+
+import numpy as np
+
+import npl
+from npl.containers import Spectrum
+from npl.fileio import RSFHandler
+from npl.quantification import Quantifier
+
+
+RSF_FILE = os.path.join(os.path.dirname(npl.__file__), "rsf.db")
+
+
+def make_spectrum(peaks, **kwargs):
+    """Returns a spectrum with one region holding the peaks given as
+    (name, center, area) tuples."""
+    energy = np.linspace(0, 800, 801)
+    spectrum = Spectrum(energy=energy, intensity=np.linspace(2, 1, 801),
+                        **kwargs)
+    spectrum.add_region(emin=0, emax=800)
+    for name, center, area in peaks:
+        spectrum.regions[0].add_peak(
+            name=name, center=center, area=area, fwhm=1.5)
+    return spectrum
+
+
+class QuantifierTest(unittest.TestCase):
+    """Checks atomic percentages against hand calculated values, the
+    transmission is switched off."""
+    def setUp(self):
+        self.quantifier = Quantifier(
+            RSFHandler(RSF_FILE), source="Al",
+            transmission=lambda kinetic_energy, passenergy: 1)
+
+    def test_quantify(self):
+        """Areas are divided by RSF, doublets by the summed RSF."""
+        spectrum = make_spectrum(
+            [("C 1s", 284, 100), ("O 1s", 532, 293),
+             ("Au 4f7/2", 83, 958), ("Au 4f5/2", 87, 754)], name="one")
+        groups, elements, percent = self.quantifier.quantify([spectrum])
+        self.assertEqual(groups, ["one"])
+        self.assertEqual(elements, ["Au", "C", "O"])
+        np.testing.assert_allclose(percent, [[100 / 3] * 3])
+
+    def test_groups_and_timing(self):
+        """Spectra of a group are summed, areas are divided by sweeps
+        times dwell time."""
+        carbon = make_spectrum([("C 1s", 284, 300)], name="C",
+                               sweeps=3, dwelltime=1)
+        oxygen = make_spectrum([("O 1s", 532, 293)], name="O",
+                               sweeps=1, dwelltime=1)
+        carbon2 = make_spectrum([("C 1s", 284, 100)], name="C2")
+        groups, elements, percent = self.quantifier.quantify(
+            [carbon, oxygen, carbon2], groups=["a", "a", "b"])
+        self.assertEqual(groups, ["a", "b"])
+        self.assertEqual(elements, ["C", "O"])
+        np.testing.assert_allclose(percent, [[50, 50], [100, 0]])
+
+    def test_assignment_by_center(self):
+        """Peaks without a line name are assigned by their center, the
+        assignment follows renamed peaks."""
+        spectrum = make_spectrum([("A", 284, 100), ("B", 532, 100)])
+        peak = spectrum.regions[0].peaks[0]
+        line = self.quantifier.get_line(peak)
+        lines = self.quantifier.rsfhandler.get_lines_near(284, 1.5, "Al")
+        self.assertEqual(line[1], lines["fullname"][0])
+        peak.name = "C 1s"
+        self.assertEqual(self.quantifier.get_line(peak), ("C", "C 1s", 1.))
+
+    def test_nothing_assigned(self):
+        """Spectra without peaks give an empty result."""
+        spectrum = make_spectrum([], name="empty")
+        groups, elements, percent = self.quantifier.quantify([spectrum])
+        self.assertEqual((groups, elements), (["empty"], []))
+        self.assertEqual(percent.shape, (1, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
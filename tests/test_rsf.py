@@ -0,0 +1,88 @@
+"""Lookups in the RSF library shipped with npl."""
+
+import os
+import sqlite3
+import unittest
+
+import numpy as np
+
+import npl
+from npl.fileio import RSFHandler
+
+
+RSF_FILE = os.path.join(os.path.dirname(npl.__file__), "rsf.db")
+
+
+class RSFHandlerTest(unittest.TestCase):
+    """Compares the in-memory tables with plain SQL queries."""
+    def setUp(self):
+        self.rsfhandler = RSFHandler(RSF_FILE)
+
+    @staticmethod
+    def query_lines(source):
+        """Returns (fullname, BE, RSF) of all lines for source, Auger
+        lines converted to binding energy."""
+        k_alpha = RSFHandler.k_alpha[source]
+        with sqlite3.connect(RSF_FILE) as rsfbase:
+            rows = rsfbase.execute(
+                """SELECT Fullname, IsAuger, BE, RSF FROM Peak
+                   WHERE Source=? OR Source='Any'""", (source, )).fetchall()
+        return [(name, k_alpha - energy if is_auger else energy, rsf)
+                for (name, is_auger, energy, rsf) in rows]
+
+    def test_lines_near(self):
+        """get_lines_near finds the same lines as a linear scan, ranked
+        by RSF."""
+        for source in RSFHandler.k_alpha:
+            lines = self.query_lines(source)
+            for energy, delta in ((84, 2), (285, 5), (531, 0.5), (-10, 1)):
+                found = self.rsfhandler.get_lines_near(energy, delta, source)
+                expected = [line for line in lines
+                            if abs(line[1] - energy) <= delta]
+                self.assertEqual(sorted(found["fullname"]),
+                                 sorted(line[0] for line in expected))
+                self.assertTrue(np.all(np.diff(found["RSF"]) <= 0))
+
+    def test_unknown_source(self):
+        """An unknown source yields an empty table."""
+        self.assertEqual(len(self.rsfhandler.get_lines_near(84, 2, "Xx")), 0)
+
+    def test_score_elements(self):
+        """An element whose lines are all found scores 1, a missing line
+        lowers the score, a missing strongest core level zeroes it."""
+        table = self.rsfhandler.get_element_table("Au", "Al")
+        scores = dict(self.rsfhandler.score_elements(
+            table["BE"], "Al", (0, 1400)))
+        self.assertEqual(scores["Au"], 1)
+
+        core = table[~table["is_auger"]]
+        weakest = np.argmin(core["RSF"])
+        scores = dict(self.rsfhandler.score_elements(
+            np.delete(core["BE"], weakest), "Al", (0, 1400), min_score=0))
+        self.assertLess(scores["Au"], 1)
+        self.assertGreater(scores["Au"], 0.9)
+
+        strongest = np.argmax(core["RSF"])
+        scores = dict(self.rsfhandler.score_elements(
+            np.delete(core["BE"], strongest), "Al", (0, 1400),
+            min_score=0))
+        self.assertEqual(scores["Au"], 0)
+
+    def test_score_outside_span(self):
+        """Lines outside the measured span do not count."""
+        table = self.rsfhandler.get_element_table("Au", "Al")
+        inside = table[(table["BE"] >= 0) & (table["BE"] <= 400)]
+        scores = dict(self.rsfhandler.score_elements(
+            inside["BE"], "Al", (0, 400)))
+        self.assertEqual(scores["Au"], 1)
+
+    def test_score_nothing(self):
+        """No peaks or an unknown source give no elements."""
+        self.assertEqual(self.rsfhandler.score_elements([], "Al", (0, 1)),
+                         [])
+        self.assertEqual(
+            self.rsfhandler.score_elements([84.], "Xx", (0, 1400)), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+"""Incremental search index of the spectrum view."""
+
+import unittest
+
+import numpy as np
+
+from npl.containers import Spectrum, SpectrumContainer
+
+try:
+    from npl.gui_treeview import SearchIndex
+except (ImportError, ValueError):
+    SearchIndex = None
+
+
+def make_spectrum(name, notes="", passenergy=0):
+    """Returns a small spectrum with metadata."""
+    return Spectrum(energy=np.arange(3.), intensity=np.ones(3), name=name,
+                    notes=notes, passenergy=passenergy)
+
+
+@unittest.skipIf(SearchIndex is None, "GTK is not available")
+class SearchIndexTest(unittest.TestCase):
+    """Compares the index with plain substring and range checks."""
+    def setUp(self):
+        self.container = SpectrumContainer()
+        self.container.extend([
+            make_spectrum("C1s", "clean surface", 20),
+            make_spectrum("O1s", "after sputtering", 50),
+            make_spectrum("Survey", "clean, sputtered", 100),
+            make_spectrum("Au4f", "reference", "abc")])
+        self.index = SearchIndex(self.container)
+
+    def search(self, attr, term):
+        """Returns the names of the matching spectra."""
+        self.index.set_query(attr, term)
+        return sorted(spectrum.name for spectrum in self.container
+                      if self.index.is_visible(spectrum.sid))
+
+    def test_substring(self):
+        """Terms of any length match case insensitively."""
+        self.assertEqual(self.search("notes", "CLEAN"), ["C1s", "Survey"])
+        self.assertEqual(self.search("notes", "sputter"), ["O1s", "Survey"])
+        self.assertEqual(self.search("notes", "sputtere"), ["Survey"])
+        self.assertEqual(self.search("notes", "e"),
+                         ["Au4f", "C1s", "O1s", "Survey"])
+        self.assertEqual(self.search("notes", "xyz"), [])
+        self.assertEqual(len(self.search("notes", "")), 4)
+
+    def test_range(self):
+        """Numeric attributes take ranges, unconvertible values match
+        none of them."""
+        self.assertEqual(self.search("passenergy", "20..50"), ["C1s", "O1s"])
+        self.assertEqual(self.search("passenergy", ">50"), ["Survey"])
+        self.assertEqual(self.search("passenergy", "<= 20"), ["C1s"])
+        self.assertEqual(self.search("passenergy", "100"), ["Survey"])
+        self.assertEqual(self.search("passenergy", ".."),
+                         ["C1s", "O1s", "Survey"])
+
+    def test_updates(self):
+        """Changed, added and removed spectra update the current
+        result."""
+        self.assertEqual(self.search("notes", "clean"), ["C1s", "Survey"])
+        self.container[1].set(notes="cleaned")
+        self.container.append(make_spectrum("N1s", "Clean"))
+        self.container.remove(self.container[0])
+        self.assertEqual(
+            sorted(spectrum.name for spectrum in self.container
+                   if self.index.is_visible(spectrum.sid)),
+            ["N1s", "O1s", "Survey"])
+        self.container.clear()
+        self.container.append(make_spectrum("C1s", "clean"))
+        self.assertEqual(self.search("notes", "clean"), ["C1s"])
+
+
+if __name__ == "__main__":
+    unittest.main()